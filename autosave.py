@@ -0,0 +1,195 @@
+# Saves the footprint being edited every so often, without holding up the
+# editor. The GTK thread only hands over a dictionary snapshot of the
+# footprint (see ObjectManager.to_dict); turning it into JSON and writing it
+# happens on a thread of its own.
+
+import fcntl
+import gobject
+import hashlib
+import itertools
+import json
+import os
+import stat
+import tempfile
+import threading
+
+from logging_utils import io_log
+
+# How long to wait after the last change before autosaving, in milliseconds.
+DEFAULT_DELAY_MS = 2000
+# Where footprints that haven't been saved yet are autosaved: the first of
+# these, filled in with "", "-2", "-3" and so on, that no other editor has
+# locked; see untitled_autosave_filename.
+UNTITLED_AUTOSAVE = os.path.join(os.path.expanduser("~"),
+                                 ".fpgen-untitled%s.fpg.autosave")
+# The filename we've claimed from UNTITLED_AUTOSAVE, and the open lock file
+# that keeps it ours.
+_untitled_autosave = None
+
+def untitled_autosave_filename():
+    '''
+    Where this editor autosaves footprints that haven't been saved yet.
+
+    Each editor running at once gets a different file, and holds a lock on
+    it until it exits. The lock goes however the editor exits, so one
+    started after a crash gets the same file back, and can offer to
+    recover what's in it.
+    '''
+    global _untitled_autosave
+    if _untitled_autosave is None:
+        for n in itertools.count(1):
+            filename = UNTITLED_AUTOSAVE % ("-%d" % n if n > 1 else "")
+            lock = open(filename + ".lock", "a")
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock.close()
+                continue
+            _untitled_autosave = (filename, lock)
+            break
+    return _untitled_autosave[0]
+
+def autosave_filename(filename):
+    '''
+    Where to autosave a footprint saved as filename (None if it hasn't been
+    saved yet).
+    '''
+    if filename is None:
+        return untitled_autosave_filename()
+    return filename + ".autosave"
+
+# The process's umask. Reading it means setting it, which isn't safe once
+# other threads might be creating files, so it's done once, on import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def atomic_write(filename, text):
+    '''
+    Write text to filename by writing a temporary file next to it and
+    renaming that into place, so a crash part way through never leaves a
+    truncated file behind. The file keeps its permissions, or gets the
+    usual ones if it's new.
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    fd, temp_path = tempfile.mkstemp(dir=directory,
+                                     prefix=os.path.basename(filename),
+                                     suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            # mkstemp makes the file readable only by us.
+            os.fchmod(f.fileno(), mode)
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, filename)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class AutoSaver(object):
+    '''
+    Call changed() whenever the footprint changes. Once there have been no
+    changes for delay_ms, get_snapshot() is called on the GTK main loop for
+    a dictionary to save, and get_filename() for where to save it; either
+    can return None to skip this autosave. The snapshot must not be changed
+    afterwards.
+
+    Only the latest snapshot is written: if several are waiting for the
+    writer, the older ones are dropped. A snapshot that's the same as the
+    last one written isn't written again.
+    '''
+    def __init__(self, get_snapshot, get_filename, delay_ms=DEFAULT_DELAY_MS):
+        self._get_snapshot = get_snapshot
+        self._get_filename = get_filename
+        self.delay_ms = delay_ms
+        # The gobject source id of the pending timeout, if any.
+        self._timeout = None
+        self._condition = threading.Condition()
+        # The (filename, snapshot) waiting to be written, if any; a snapshot
+        # of None means to remove the file.
+        self._pending = None
+        # The filename and digest of the last thing written.
+        self._last_written = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def changed(self, *args):
+        '''
+        Note that the footprint has changed. Takes (and ignores) any
+        arguments, so it can be connected to signals directly.
+        '''
+        if self._timeout is not None:
+            gobject.source_remove(self._timeout)
+        self._timeout = gobject.timeout_add(self.delay_ms, self._fire)
+
+    def _fire(self):
+        self._timeout = None
+        filename = self._get_filename()
+        if filename is None:
+            return False
+        snapshot = self._get_snapshot()
+        if snapshot is not None:
+            self._submit(filename, snapshot)
+        return False
+
+    def discard(self):
+        '''
+        Cancel any autosave that hasn't happened yet, and remove the
+        autosave file; call this after saving for real.
+        '''
+        if self._timeout is not None:
+            gobject.source_remove(self._timeout)
+            self._timeout = None
+        filename = self._get_filename()
+        if filename is not None:
+            self._submit(filename, None)
+
+    def _submit(self, filename, snapshot):
+        with self._condition:
+            self._pending = (filename, snapshot)
+            self._condition.notify()
+
+    def flush(self):
+        '''
+        Wait until everything submitted has been written.
+        '''
+        with self._condition:
+            while self._pending is not None:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                pending = self._pending
+            filename, snapshot = pending
+            try:
+                self._write(filename, snapshot)
+            except Exception:
+                io_log.exception("Autosave to %s failed", filename)
+            with self._condition:
+                # Unless something newer came in while we were writing.
+                if self._pending is pending:
+                    self._pending = None
+                self._condition.notify_all()
+
+    def _write(self, filename, snapshot):
+        if snapshot is None:
+            self._last_written = None
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+        text = json.dumps(snapshot)
+        written = (filename, hashlib.sha1(text.encode('utf-8')).digest())
+        if written == self._last_written:
+            return
+        atomic_write(filename, text)
+        self._last_written = written
+        io_log.info("Autosaved %s", filename)
@@ -0,0 +1,74 @@
+# Runs the solver on a worker thread, so that big footprints don't freeze
+# the UI while they're being solved.
+
+import gobject
+import threading
+
+from logging_utils import solver_log
+from solve_cache import cached_solve
+from solver import SolveCancelled
+
+class BackgroundSolver(object):
+    '''
+    Solves SolveRequests one at a time on a worker thread.
+
+    Only the most recently submitted request matters: submitting a new one
+    replaces any request that hasn't started yet, and makes a solve that's
+    already running give up. When a request has been solved, callback is
+    called on the GTK main loop as callback(request, result, error), where
+    result is the SolveResult (None if the constraints are overconstrained)
+    and error is an exception raised by the solver, if any.
+    '''
+    def __init__(self, callback):
+        self._callback = callback
+        self._condition = threading.Condition()
+        # The (request_id, request) pair waiting to be solved, if any.
+        self._pending = None
+        # The id of the latest request. Anything with an older id is stale.
+        self._current_id = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        with self._condition:
+            self._current_id += 1
+            self._pending = (self._current_id, request)
+            self._condition.notify()
+
+    def cancel(self):
+        '''
+        Forget about all outstanding requests; their callbacks won't be
+        called.
+        '''
+        with self._condition:
+            self._current_id += 1
+            self._pending = None
+
+    def _stale(self, request_id):
+        return request_id != self._current_id
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                request_id, request = self._pending
+                self._pending = None
+            try:
+                result = cached_solve(
+                    request, cancelled=lambda: self._stale(request_id))
+                error = None
+            except SolveCancelled:
+                continue
+            except Exception as e:
+                solver_log.exception("Background solve failed")
+                result = None
+                error = e
+            gobject.idle_add(self._deliver, request_id, request, result, error)
+
+    def _deliver(self, request_id, request, result, error):
+        # Called on the main loop.
+        if not self._stale(request_id):
+            self._callback(request, result, error)
+        return False
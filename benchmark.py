@@ -0,0 +1,373 @@
+# Solver performance benchmarks.
+#
+# This builds synthetic footprints out of the real primitives (without any
+# dialogs or windows), times the operations the editor spends its time on,
+# and writes the results to a JSON file. Given the results of an earlier run
+# as a baseline, it also reports anything that got slower than the baseline
+# by more than a tolerance, and exits with a non-zero status if so.
+#
+# Usage:
+#   python benchmark.py [--sizes 2,5,10] [--output results.json]
+#                       [--baseline old_results.json] [--tolerance 0.2]
+#   python benchmark.py --fill-report [--sizes 2,5,10]
+#
+# --fill-report doesn't time anything; it solves each footprint once with
+# each pivot rule and reports how sparse the elimination stayed.
+#
+# --session SESSION (which can be given more than once) also replays an
+# editing session recorded in the editor, and reports the median time of
+# each kind of operation in it; see session.py. --sizes '' leaves out the
+# synthetic footprints.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from StringIO import StringIO
+
+from geda_out import GedaOut
+from instrumentation import SolveProbe
+from object_manager import ObjectManager
+from primitives import (
+    BallArray,
+    CenterPoint,
+    Coincident,
+    HorizDistance,
+    HorizontalDrawnLine,
+    MeasuredHorizDistance,
+    MeasuredVertDistance,
+    PadArray,
+    PinArray,
+    SameDistance,
+    VertDistance,
+    VerticalDrawnLine,
+)
+from session import load_session, replay
+from solver import PIVOT_LOWEST, PIVOT_MARKOWITZ, solve
+from units import UnitNumber
+
+DEFAULT_SIZES = [2, 5, 10, 20, 40, 60]
+# Number of steps in a simulated drag.
+DRAG_STEPS = 20
+# Timings below this many seconds are too noisy to call a regression.
+NOISE_FLOOR = 0.001
+
+class _Quiet(object):
+    '''
+    Context manager that swallows anything printed to stdout.
+    '''
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = StringIO()
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self._stdout
+        return False
+
+def new_object_manager(name):
+    object_manager = ObjectManager(
+        fp_name=name,
+        default_clearance=UnitNumber(12, 'mil'),
+        default_mask=UnitNumber(2, 'mil'),
+    )
+    CenterPoint.new(object_manager)
+    return object_manager
+
+def _add(object_manager, primitive):
+    object_manager.add_primitive(primitive, check_overconstraints=False)
+    return primitive
+
+def _distance(object_manager, cls, p1, p2, dist):
+    # Same point ordering as DistanceConstraint.new.
+    if cls.horiz and (p1.x > p2.x) or not cls.horiz and (p1.y > p2.y):
+        p1, p2 = p2, p1
+    return _add(object_manager,
+                cls(object_manager, p1, p2, UnitNumber(dist, 'mil'), 10))
+
+def array_footprint(array_cls, n, lattice=False):
+    '''
+    A single n x n array of pads, pins or balls.
+    '''
+    object_manager = new_object_manager("%s-%dx%d" % (array_cls.NAME, n, n))
+    array_cls.new(object_manager, 0, 0, dict(nx=n, ny=n, lattice=lattice))
+    object_manager.update_points()
+    return object_manager
+
+def _pad_row(object_manager, n, x, y, horizontal):
+    if horizontal:
+        PadArray.new(object_manager, x, y, dict(nx=n, ny=1))
+    else:
+        PadArray.new(object_manager, x, y, dict(nx=1, ny=n))
+    return object_manager.primitives[-1]
+
+def qfn_footprint(n):
+    '''
+    A QFN-style footprint with n pads on each side, dimensioned with
+    distance constraints, with a silkscreen outline and equal-size groups.
+    '''
+    object_manager = new_object_manager("QFN-%d" % n)
+    span = 30 * (n + 4)
+    rows = [
+        _pad_row(object_manager, n, 0, -span/2, True),
+        _pad_row(object_manager, n, 0, span/2, True),
+        _pad_row(object_manager, n, -span/2, 0, False),
+        _pad_row(object_manager, n, span/2, 0, False),
+    ]
+    top, bottom, left, right = rows
+
+    # Pitch and pad size of the top row and the left column.
+    for row, cls in ((top, HorizDistance), (left, VertDistance)):
+        first = row.elements[0]
+        if n > 1:
+            _distance(object_manager, cls,
+                      first.center_point(), row.elements[1].center_point(),
+                      20)
+        _distance(object_manager, HorizDistance,
+                  first.point(0, 0), first.point(2, 0), 10)
+        _distance(object_manager, VertDistance,
+                  first.point(0, 0), first.point(0, 2), 30)
+    # Distance between opposite rows.
+    _distance(object_manager, VertDistance,
+              top.elements[0].center_point(),
+              bottom.elements[0].center_point(), span)
+    _distance(object_manager, HorizDistance,
+              left.elements[0].center_point(),
+              right.elements[0].center_point(), span)
+
+    # The other rows have the same pad sizes as the ones we dimensioned.
+    for (this_row, other_row) in ((top, bottom), (left, right)):
+        this_pad = this_row.elements[0]
+        other_pad = other_row.elements[0]
+        for measured_cls, corner in ((MeasuredHorizDistance, (2, 0)),
+                                     (MeasuredVertDistance, (0, 2))):
+            measured = [
+                _add(object_manager,
+                     measured_cls(object_manager,
+                                  pad.point(0, 0), pad.point(*corner), 10))
+                for pad in (this_pad, other_pad)
+            ]
+            SameDistance.new(object_manager, 0, 0, set(measured))
+
+    # Silkscreen outline: four lines joined at the corners.
+    outline = span/2 + 40
+    thickness = dict(thickness=UnitNumber(10, 'mil'))
+    HorizontalDrawnLine.new(object_manager, 0, -outline, thickness)
+    top_line = object_manager.primitives[-1]
+    HorizontalDrawnLine.new(object_manager, 0, outline, thickness)
+    bottom_line = object_manager.primitives[-1]
+    VerticalDrawnLine.new(object_manager, -outline, 0, thickness)
+    left_line = object_manager.primitives[-1]
+    VerticalDrawnLine.new(object_manager, outline, 0, thickness)
+    right_line = object_manager.primitives[-1]
+    for (line1, end1), (line2, end2) in (
+            ((top_line, '_p1points'), (left_line, '_p1points')),
+            ((top_line, '_p2points'), (right_line, '_p1points')),
+            ((bottom_line, '_p1points'), (left_line, '_p2points')),
+            ((bottom_line, '_p2points'), (right_line, '_p2points'))):
+        _add(object_manager,
+             Coincident(object_manager, [getattr(line1, end1)[2],
+                                         getattr(line2, end2)[2]]))
+
+    object_manager.update_points()
+    return object_manager
+
+def footprints(sizes):
+    '''
+    Yield (name, factory) pairs for every footprint we benchmark.
+    '''
+    for n in sizes:
+        for array_cls in (PadArray, BallArray, PinArray):
+            yield ("%s-%dx%d" % (array_cls.__name__, n, n),
+                   lambda array_cls=array_cls, n=n:
+                       array_footprint(array_cls, n))
+        yield ("BallArray-lattice-%dx%d" % (n, n),
+               lambda n=n: array_footprint(BallArray, n, lattice=True))
+        yield ("QFN-%d" % n, lambda n=n: qfn_footprint(n))
+
+def drag_target(object_manager):
+    '''
+    Pick something to drag: the center point of the last pad, pin or ball.
+    '''
+    for primitive in reversed(object_manager.primitives):
+        if hasattr(primitive, 'center_point') and primitive.center_point():
+            return primitive.center_point()
+
+def delete_target(object_manager):
+    '''
+    Pick something to delete: the last distance constraint if there is
+    one, and otherwise the last array.
+    '''
+    for cls in ((HorizDistance, VertDistance), (PadArray, PinArray, BallArray)):
+        for primitive in reversed(object_manager.primitives):
+            if isinstance(primitive, cls):
+                return primitive
+
+def timed(func, repeat, setup=None):
+    '''
+    Run func repeat times, returning the minimum and median times taken.
+    If given, setup is called before each run (untimed), and its result is
+    passed to func.
+    '''
+    times = []
+    for _ in xrange(repeat):
+        arg = setup() if setup else None
+        start = time.time()
+        if setup:
+            func(arg)
+        else:
+            func()
+        times.append(time.time() - start)
+    times.sort()
+    return dict(
+        min=times[0],
+        median=times[len(times) // 2],
+        runs=repeat,
+    )
+
+def benchmark_footprint(factory, repeat):
+    results = {}
+    results['build'] = timed(factory, repeat)
+    object_manager = factory()
+    fp_dict = object_manager.to_dict()
+
+    results['update_points'] = timed(object_manager.update_points, repeat)
+
+    def drag_session():
+        target = drag_target(object_manager)
+        target.drag(0, 0)
+        object_manager.update_points(target)
+        for _ in xrange(DRAG_STEPS):
+            if target.drag(1, 1):
+                object_manager.update_all_point_coords()
+    results['drag_session'] = timed(drag_session, repeat)
+
+    results['to_dict'] = timed(object_manager.to_dict, repeat)
+    results['from_dict'] = timed(lambda: ObjectManager.from_dict(fp_dict),
+                                 repeat)
+
+    def delete(copy):
+        copy.delete_primitive(delete_target(copy))
+    results['delete_primitive'] = timed(
+        delete, repeat, setup=lambda: ObjectManager.from_dict(fp_dict))
+
+    results['geda_write'] = timed(lambda: GedaOut.write(object_manager),
+                                  repeat)
+    return results
+
+def run(sizes, repeat, log):
+    results = {}
+    for name, factory in footprints(sizes):
+        with _Quiet():
+            footprint_results = benchmark_footprint(factory, repeat)
+        for operation, timing in sorted(footprint_results.iteritems()):
+            key = "%s/%s" % (name, operation)
+            results[key] = timing
+            print("%-40s %10.4fs" % (key, timing['median']), file=log)
+    return results
+
+def run_sessions(filenames, repeat, log):
+    '''
+    Replay each recorded session repeat times.
+    '''
+    results = {}
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        with _Quiet():
+            summary = replay(load_session(filename), repeat)
+        for operation, timing in sorted(summary.iteritems()):
+            key = "session-%s/%s" % (name, operation)
+            results[key] = timing
+            print("%-40s %10.4fs (p90 %.4fs, %d runs)" % (
+                key, timing['median'], timing['p90'], timing['runs']),
+                  file=log)
+    return results
+
+def fill_report(sizes, log):
+    '''
+    Solve each footprint once with each pivot rule, and report the fill-in
+    of the explicit constraints, the size of the solution map and how many
+    row updates the elimination needed.
+    '''
+    print("%-32s %-10s %8s %8s %8s %8s %10s" % (
+        "footprint", "pivots", "rows", "input", "fill-in", "inverse",
+        "updates"), file=log)
+    for name, factory in footprints(sizes):
+        with _Quiet():
+            object_manager = factory()
+        for pivot_rule in (PIVOT_LOWEST, PIVOT_MARKOWITZ):
+            request = object_manager.solve_request()
+            request.pivot_rule = pivot_rule
+            # Factor from scratch, rather than reusing the factorization
+            # left over from building the footprint.
+            request.primary = None
+            request.probe = probe = SolveProbe()
+            solve(request)
+            print("%-32s %-10s %8d %8d %8d %8d %10d" % (
+                name, pivot_rule, probe.rows, probe.input_nonzeros,
+                probe.fill_in, probe.inverse_nonzeros, probe.row_updates),
+                  file=log)
+
+def regressions(results, baseline, tolerance):
+    '''
+    Return (key, baseline_time, time) for everything that got slower than
+    the baseline by more than the tolerance (a fraction of the baseline).
+    '''
+    slower = []
+    for key, timing in sorted(results.iteritems()):
+        if key not in baseline:
+            continue
+        old = baseline[key]['median']
+        new = timing['median']
+        if new > old * (1 + tolerance) and new - old > NOISE_FLOOR:
+            slower.append((key, old, new))
+    return slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="fpgen solver benchmarks")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated array sizes (n for n x n)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per operation; the median is reported")
+    parser.add_argument('--output', default='bench_results.json',
+                        help="where to write the results")
+    parser.add_argument('--baseline',
+                        help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown relative to the baseline")
+    parser.add_argument('--fill-report', action='store_true',
+                        help="compare pivot rules instead of timing")
+    parser.add_argument('--session', action='append', default=[],
+                        help="a recorded editing session to replay")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    if args.fill_report:
+        fill_report(sizes, sys.stdout)
+        return 0
+    results = run(sizes, args.repeat, sys.stdout)
+    results.update(run_sessions(args.session, args.repeat, sys.stdout))
+    with open(args.output, 'w') as f:
+        json.dump(dict(
+            python=platform.python_version(),
+            sizes=sizes,
+            repeat=args.repeat,
+            results=results,
+        ), f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(results, baseline, args.tolerance)
+        for key, old, new in slower:
+            print("REGRESSION %s: %.4fs -> %.4fs" % (key, old, new))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
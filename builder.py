@@ -0,0 +1,232 @@
+'''
+Build footprints from code instead of through the GUI.
+
+    builder = FootprintBuilder("SOIC-8", unit="mm")
+    pads = builder.array(PadArray, 0, 0, nx=4, ny=1, pitch=(1.27, None),
+                         width=0.6, height=1.5)
+    ...
+    object_manager = builder.solve()
+
+Nothing is solved until solve() is called, and constraints aren't checked
+for overconstraints as they're added; if the finished footprint is
+overconstrained, solve() raises OverconstrainedException naming the
+conflicting primitives.
+'''
+
+from defaults import (
+    DEFAULT_DEFAULT_CLEARANCE_MILS,
+    DEFAULT_DEFAULT_MASK_MILS,
+)
+from object_manager import ObjectManager
+from primitives import (
+    Ball,
+    CenterPoint,
+    Coincident,
+    DrawnLine,
+    HorizDistance,
+    Horizontal,
+    HorizontalDrawnLine,
+    MarkedLine,
+    MeasuredHorizDistance,
+    MeasuredVertDistance,
+    Pad,
+    PadArray,
+    Pin,
+    SameDistance,
+    VertDistance,
+    Vertical,
+    VerticalDrawnLine,
+)
+from units import UNITS, UnitNumber
+
+class FootprintBuilder(object):
+    def __init__(self, fp_name="", unit="mil", clearance=None, mask=None,
+                 object_manager=None):
+        '''
+        Start a new footprint, or add to object_manager if it's given.
+        Plain numbers passed to any method are taken to be in unit;
+        UnitNumbers can be passed anywhere a length is expected.
+        '''
+        assert unit in UNITS
+        self.unit = unit
+        if object_manager is None:
+            if clearance is None:
+                clearance = UnitNumber(DEFAULT_DEFAULT_CLEARANCE_MILS, 'mil')
+            if mask is None:
+                mask = UnitNumber(DEFAULT_DEFAULT_MASK_MILS, 'mil')
+            object_manager = ObjectManager(
+                fp_name=fp_name,
+                default_clearance=self.length(clearance),
+                default_mask=self.length(mask),
+            )
+            CenterPoint.new(object_manager)
+        self.object_manager = object_manager
+
+    def length(self, value):
+        '''
+        value as a UnitNumber, taking plain numbers to be in our unit.
+        '''
+        if isinstance(value, UnitNumber):
+            return value
+        return UnitNumber(value, self.unit)
+
+    def _iu(self, value):
+        return self.length(value).to("iu")
+
+    # Things with pads.
+
+    def pad(self, x, y, w, h, number=None, clearance=None, mask=None):
+        '''
+        A w by h pad centered on (x, y). Its size isn't held by anything;
+        use distance constraints for that.
+        '''
+        pad = Pad.new(self.object_manager, self._iu(x), self._iu(y),
+                      Pad.configure([], w=self._iu(w), h=self._iu(h)))
+        self._set_attributes(pad, number, clearance, mask)
+        return pad
+
+    def pin(self, x, y, drill, ring, number=None, clearance=None, mask=None):
+        '''
+        A through-hole pin centered on (x, y), with the given hole and ring
+        diameters.
+        '''
+        pin = Pin.new(self.object_manager, self._iu(x), self._iu(y), None,
+                      hr=self._iu(drill), rr=self._iu(ring))
+        self._set_attributes(pin, number, clearance, mask)
+        return pin
+
+    def ball(self, x, y, diameter, number=None, clearance=None, mask=None):
+        ball = Ball.new(self.object_manager, self._iu(x), self._iu(y), None,
+                        r=self._iu(diameter))
+        self._set_attributes(ball, number, clearance, mask)
+        return ball
+
+    def _set_attributes(self, primitive, number, clearance, mask):
+        if number is None and clearance is None and mask is None:
+            return
+        primitive.set_attributes(
+            number,
+            self.length(clearance) if clearance is not None else None,
+            self.length(mask) if mask is not None else None,
+        )
+
+    def array(self, array_cls, x, y, nx, ny, pitch=None, lattice=False,
+              numbering=None, width=None, height=None):
+        '''
+        An nx by ny PadArray, PinArray or BallArray centered on (x, y).
+        pitch is (x pitch, y pitch); either may be None. A given pitch is
+        held with a distance constraint between the centers of the first
+        element and its neighbor. For a PadArray, width and height give the
+        size of each pad; like pad(), nothing holds it.
+        '''
+        pitch_x, pitch_y = pitch if pitch is not None else (None, None)
+        configuration = dict(nx=nx, ny=ny, lattice=lattice)
+        if width is not None or height is not None:
+            if not issubclass(array_cls, PadArray):
+                raise ValueError("Only a PadArray's elements have a width "
+                                 "and height")
+            if width is not None:
+                configuration['w'] = self._iu(width)
+            if height is not None:
+                configuration['h'] = self._iu(height)
+        if pitch_x is not None:
+            configuration['pitch_x'] = self._iu(pitch_x)
+        if pitch_y is not None:
+            configuration['pitch_y'] = self._iu(pitch_y)
+        array = array_cls.new(self.object_manager,
+                              self._iu(x), self._iu(y), configuration)
+        if numbering is not None:
+            array.numbering = numbering
+        first = array.elements[0].center_point()
+        # Elements are stored a column at a time.
+        if pitch_x is not None and nx > 1:
+            self.horiz_distance(first, array.elements[ny].center_point(),
+                                pitch_x)
+        if pitch_y is not None and ny > 1:
+            self.vert_distance(first, array.elements[1].center_point(),
+                               pitch_y)
+        return array
+
+    # Drawing.
+
+    def line(self, x1, y1, x2, y2, thickness=None):
+        '''
+        A silkscreen line from (x1, y1) to (x2, y2), thickness wide. Lines
+        that start out horizontal or vertical are constrained to stay that
+        way.
+        '''
+        if y1 == y2:
+            cls = HorizontalDrawnLine
+        elif x1 == x2:
+            cls = VerticalDrawnLine
+        else:
+            cls = DrawnLine
+        x1, y1, x2, y2 = [self._iu(v) for v in (x1, y1, x2, y2)]
+        if thickness is not None:
+            # DrawnLine's "thickness" is really the distance from the middle
+            # of the line to its edge.
+            thickness = self.length(thickness)
+            thickness = UnitNumber(thickness.value / 2., thickness.unit)
+        configuration = dict(
+            thickness=thickness,
+            offset=((x2 - x1) / 2., (y2 - y1) / 2.),
+        )
+        return cls.new(self.object_manager,
+                       (x1 + x2) / 2., (y1 + y2) / 2., configuration)
+
+    def marked_line(self, x, y, fraction=0.5):
+        return MarkedLine.new(self.object_manager, self._iu(x), self._iu(y),
+                              fraction)
+
+    # Constraints. These all take Point primitives, such as
+    # pad.center_point() or line.endpoints()[0].
+
+    def horizontal(self, p1, p2):
+        return Horizontal.new(self.object_manager, 0, 0,
+                              Horizontal.configure([p1, p2]),
+                              check_overconstraints=False)
+
+    def vertical(self, p1, p2):
+        return Vertical.new(self.object_manager, 0, 0,
+                            Vertical.configure([p1, p2]),
+                            check_overconstraints=False)
+
+    def coincident(self, p1, p2):
+        return Coincident.new(self.object_manager, 0, 0,
+                              Coincident.configure([p1, p2]),
+                              check_overconstraints=False)
+
+    def _distance(self, cls, p1, p2, dist):
+        return cls.new(self.object_manager, 0, 0,
+                       dict(p1=p1, p2=p2, dist=self.length(dist)),
+                       check_overconstraints=False)
+
+    def horiz_distance(self, p1, p2, dist):
+        return self._distance(HorizDistance, p1, p2, dist)
+
+    def vert_distance(self, p1, p2, dist):
+        return self._distance(VertDistance, p1, p2, dist)
+
+    def measured_horiz_distance(self, p1, p2):
+        return MeasuredHorizDistance.new(
+            self.object_manager, 0, 0, dict(objects=[p1, p2]),
+            check_overconstraints=False)
+
+    def measured_vert_distance(self, p1, p2):
+        return MeasuredVertDistance.new(
+            self.object_manager, 0, 0, dict(objects=[p1, p2]),
+            check_overconstraints=False)
+
+    def same_distance(self, measured):
+        '''
+        Make all of the given measured distances the same.
+        '''
+        return SameDistance.new(self.object_manager, 0, 0, set(measured),
+                                check_overconstraints=False)
+
+    def solve(self):
+        '''
+        Solve everything added so far, and return the ObjectManager.
+        '''
+        self.object_manager.update_points()
+        return self.object_manager
@@ -61,3 +61,21 @@ def constrain_ball(points):
             eq_vert_constraints +
             eq_constraints)
 
+
+def derive_ball(points, radius):
+    '''
+    Given a list of five points (top, left, center, right, bottom) and the
+    index of a radius scalar, return derived point expressions placing the
+    outer four points around the center.
+    '''
+    center = points[2].point()
+    derived = {}
+    for point, (dx, dy) in ((points[0], (0, -1)),
+                            (points[1], (-1, 0)),
+                            (points[3], (1, 0)),
+                            (points[4], (0, 1))):
+        derived[point.point()] = (
+            ([(center, 1, 0), (radius, dx)], 0),
+            ([(center, 0, 1), (radius, dy)], 0),
+        )
+    return derived
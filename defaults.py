@@ -1,2 +1,9 @@
+import os
+import tempfile
+
 DEFAULT_DEFAULT_CLEARANCE_MILS = 12.0
 DEFAULT_DEFAULT_MASK_MILS = 2.0
+
+# Where solve_server.py listens, and solve_client.py connects, by default.
+DEFAULT_SOLVE_SOCKET = os.path.join(tempfile.gettempdir(),
+                                    "fpgen-solve-%d.sock" % os.getuid())
@@ -0,0 +1,173 @@
+# A disjoint-set (union-find) structure that also indexes the members of
+# each set, and can record how to roll back changes.
+
+class DisjointSet(object):
+    '''
+    Groups items into disjoint classes.
+
+    Each class has a root item, which represents it, and a label; labels are
+    always the integers 0 to (number of classes - 1), so they can be shown
+    to the user. Every item's root is stored directly, and merging two
+    classes moves the members of the smaller into the larger, so finding
+    an item's root or class members is O(1), and each item is moved at most
+    O(log n) times overall.
+
+    Changes can be undone: between begin(journal) and commit(), a function
+    that undoes each change is appended to journal, a list belonging to
+    something else (see ObjectManager.transaction), which calls them in
+    reverse order to roll back. Undoing costs time proportional to what
+    changed.
+    '''
+    def __init__(self):
+        # Map from each item to the root of its class.
+        self._root = {}
+        # Map from each root to the set of members of its class.
+        self._members = {}
+        # Map from each root to its class's label, and from each label to
+        # the root of the class with that label.
+        self._labels = {}
+        self._by_label = []
+        # List to append functions that undo our changes to, or None if
+        # we're not journaling.
+        self._journal = None
+
+    def begin(self, journal):
+        assert self._journal is None
+        self._journal = journal
+
+    def commit(self):
+        self._journal = None
+
+    def _undo(self, func):
+        if self._journal is not None:
+            self._journal.append(func)
+
+    def __contains__(self, item):
+        return item in self._root
+
+    def __len__(self):
+        return len(self._by_label)
+
+    def find(self, item):
+        return self._root[item]
+
+    def members(self, item):
+        '''
+        The members of item's class. This shouldn't be modified.
+        '''
+        return self._members[self._root[item]]
+
+    def label(self, item):
+        return self._labels[self._root[item]]
+
+    def roots(self):
+        return list(self._by_label)
+
+    def add(self, item):
+        '''
+        Add item in a new class of its own.
+        '''
+        assert item not in self._root
+        self._set_root(item, item)
+        self._members[item] = set([item])
+        self._undo(lambda: self._members.pop(item))
+        self._set_label(item, len(self._by_label))
+
+    def union(self, item1, item2):
+        '''
+        Merge the classes of the two items. The merged class gets the lower
+        of the two labels. Returns its root.
+        '''
+        root1 = self._root[item1]
+        root2 = self._root[item2]
+        if root1 is root2:
+            return root1
+        if len(self._members[root1]) < len(self._members[root2]):
+            root1, root2 = root2, root1
+        label = min(self._labels[root1], self._labels[root2])
+        freed_label = max(self._labels[root1], self._labels[root2])
+
+        moved = self._members.pop(root2)
+        self._undo(lambda: self._members.__setitem__(root2, moved))
+        for item in moved:
+            self._set_root(item, root1)
+        members = self._members[root1]
+        members.update(moved)
+        self._undo(lambda: members.difference_update(moved))
+
+        self._unset_label(root1)
+        self._unset_label(root2)
+        self._set_label(root1, label)
+        self._free_label(freed_label)
+        return root1
+
+    def remove(self, item):
+        '''
+        Remove item. If it was its class's root, another member becomes the
+        root; if it was the only member, the class goes away.
+        '''
+        root = self._root[item]
+        self._unset_root(item)
+        members = self._members[root]
+        members.remove(item)
+        self._undo(lambda: members.add(item))
+        if root is not item:
+            return
+
+        self._members.pop(root)
+        self._undo(lambda: self._members.__setitem__(root, members))
+        label = self._labels[root]
+        self._unset_label(root)
+        if not members:
+            self._free_label(label)
+            return
+
+        new_root = next(iter(members))
+        self._members[new_root] = members
+        self._undo(lambda: self._members.pop(new_root))
+        for member in members:
+            self._set_root(member, new_root)
+        self._set_label(new_root, label)
+
+    def _set_root(self, item, root):
+        if item in self._root:
+            old_root = self._root[item]
+            self._undo(lambda: self._root.__setitem__(item, old_root))
+        else:
+            self._undo(lambda: self._root.pop(item))
+        self._root[item] = root
+
+    def _unset_root(self, item):
+        old_root = self._root.pop(item)
+        self._undo(lambda: self._root.__setitem__(item, old_root))
+
+    def _set_label(self, root, label):
+        '''
+        Give label to root, which shouldn't currently have one. The label
+        must either be unused or be the next unused label.
+        '''
+        self._labels[root] = label
+        self._undo(lambda: self._labels.pop(root))
+        if label == len(self._by_label):
+            self._by_label.append(root)
+            self._undo(lambda: self._by_label.pop())
+        else:
+            old_root = self._by_label[label]
+            self._by_label[label] = root
+            self._undo(lambda: self._by_label.__setitem__(label, old_root))
+
+    def _unset_label(self, root):
+        label = self._labels.pop(root)
+        self._undo(lambda: self._labels.__setitem__(root, label))
+
+    def _free_label(self, label):
+        '''
+        Stop using label, which no class has any more. To keep labels
+        contiguous, the class with the highest label takes its place.
+        '''
+        last = len(self._by_label) - 1
+        last_root = self._by_label.pop()
+        self._undo(lambda: self._by_label.append(last_root))
+        if label != last:
+            self._unset_label(last_root)
+            self._set_label(last_root, label)
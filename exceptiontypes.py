@@ -1,2 +1,9 @@
 class OverconstrainedException(Exception):
-    pass
+    '''
+    Raised when constraints can't all hold. conflicting_primitives is a
+    small set of primitives whose constraints can't all hold together, if
+    we know of one.
+    '''
+    def __init__(self, conflicting_primitives=()):
+        super(OverconstrainedException, self).__init__()
+        self.conflicting_primitives = list(conflicting_primitives)
@@ -0,0 +1,381 @@
+import csv
+import io
+import json
+import threading
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from geda_out import GedaOut
+from logging_utils import io_log
+from primitives import (
+    Ball,
+    DrawnLine,
+    Pad,
+    Pin,
+)
+from units import UNITS
+
+# All geometry in a snapshot is in mils. Clearance and mask are per side,
+# as they're entered in the UI.
+PadRow = namedtuple('PadRow',
+                    ['x0', 'y0', 'x1', 'y1', 'number', 'clearance', 'mask'])
+PinRow = namedtuple('PinRow',
+                    ['x', 'y', 'ring_r', 'hole_r', 'number', 'clearance',
+                     'mask'])
+BallRow = namedtuple('BallRow',
+                     ['x', 'y', 'r', 'number', 'clearance', 'mask'])
+LineRow = namedtuple('LineRow', ['x1', 'y1', 'x2', 'y2', 'thickness'])
+
+KINDS = (
+    ('pads', Pad, PadRow),
+    ('pins', Pin, PinRow),
+    ('balls', Ball, BallRow),
+    ('lines', DrawnLine, LineRow),
+)
+# The kinds that are pads of some sort, rather than drawn lines.
+PAD_KINDS = KINDS[:3]
+
+MM_PER_MIL = 0.0254
+
+def _mils(unit_number):
+    return float(unit_number.to("mil"))
+
+def _columns(row_type, rows):
+    '''
+    Turn a list of rows into a single row_type whose fields are tuples
+    holding that column of every row.
+    '''
+    if not rows:
+        return row_type(*([()] * len(row_type._fields)))
+    return row_type(*zip(*rows))
+
+def _pad_row(pad):
+    return PadRow(pad.x0, pad.y0, pad.x1, pad.y1, pad.number(),
+                  _mils(pad.clearance()), _mils(pad.mask()))
+
+def _pin_row(pin):
+    return PinRow(pin.x, pin.y, pin.ring_r, pin.hole_r, pin.number(),
+                  _mils(pin.clearance()), _mils(pin.mask()))
+
+def _ball_row(ball):
+    return BallRow(ball.x, ball.y, ball.r, ball.number(),
+                   _mils(ball.clearance()), _mils(ball.mask()))
+
+def _line_row(line):
+    return LineRow(line.x1, line.y1, line.x2, line.y2, line.thickness)
+
+_ROW_FUNCS = {
+    'pads': _pad_row,
+    'pins': _pin_row,
+    'balls': _ball_row,
+    'lines': _line_row,
+}
+
+class GeometrySnapshot(object):
+    '''
+    The exportable geometry of a footprint, read out of the ObjectManager
+    once so that any number of emitters can use it.
+
+    pads, pins, balls and lines are each a row namedtuple (PadRow, etc.)
+    whose fields are tuples: snapshot.pads.x0 is the x0 of every pad. Use
+    rows() to go through them a primitive at a time. order lists
+    (kind, index) in the order the primitives appear in the ObjectManager.
+
+    Nothing in a snapshot refers back to the ObjectManager, and it can't be
+    changed, so it's safe to hand to other threads.
+    '''
+    __slots__ = ('fp_name', 'pads', 'pins', 'balls', 'lines', 'order')
+
+    def __init__(self, fp_name, pads, pins, balls, lines, order):
+        set_field = super(GeometrySnapshot, self).__setattr__
+        set_field('fp_name', fp_name)
+        set_field('pads', pads)
+        set_field('pins', pins)
+        set_field('balls', balls)
+        set_field('lines', lines)
+        set_field('order', order)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("GeometrySnapshot is immutable")
+
+    @classmethod
+    def new(cls, object_manager):
+        '''
+        Take a snapshot of object_manager's unsuppressed exportable
+        primitives. The points should already be solved.
+        '''
+        rows = dict((kind, []) for kind, _, _ in KINDS)
+        order = []
+        for primitive in object_manager.primitives:
+            if primitive.is_suppressed():
+                continue
+            for kind, ty, _ in KINDS:
+                if isinstance(primitive, ty):
+                    order.append((kind, len(rows[kind])))
+                    rows[kind].append(_ROW_FUNCS[kind](primitive))
+        columns = dict((kind, _columns(row_type, rows[kind]))
+                       for kind, _, row_type in KINDS)
+        return cls(object_manager.fp_name, order=tuple(order), **columns)
+
+    def count(self, kind):
+        return len(getattr(self, kind)[0])
+
+    def rows(self, kind):
+        '''
+        Iterate over the rows (PadRow, etc.) of kind, one of 'pads', 'pins',
+        'balls' or 'lines'.
+        '''
+        columns = getattr(self, kind)
+        row_type = type(columns)
+        for values in zip(*columns):
+            yield row_type(*values)
+
+    def ordered_rows(self):
+        '''
+        Iterate over (kind, row) for every primitive, in ObjectManager order.
+        '''
+        for kind, idx in self.order:
+            columns = getattr(self, kind)
+            yield kind, type(columns)(*(column[idx] for column in columns))
+
+def _number_str(number):
+    return number if number is not None else ''
+
+def emit_geda(snapshot):
+    return GedaOut.format_snapshot(snapshot)
+
+def _mm(mils):
+    return "{:.6f}".format(mils * MM_PER_MIL).rstrip('0').rstrip('.')
+
+def emit_kicad_mod(snapshot):
+    '''
+    A KiCad footprint (.kicad_mod). Pads and balls are SMD pads on the top,
+    pins are plated through holes, and lines go on the silkscreen.
+    '''
+    lines = ['(module "{}" (layer F.Cu)'.format(snapshot.fp_name)]
+    for kind, row in snapshot.ordered_rows():
+        if kind == 'pads':
+            lines.append(
+                '  (pad "{}" smd rect (at {} {}) (size {} {}) '
+                '(layers F.Cu F.Paste F.Mask) '
+                '(solder_mask_margin {}) (clearance {}))'.format(
+                    _number_str(row.number),
+                    _mm((row.x0 + row.x1) / 2.), _mm((row.y0 + row.y1) / 2.),
+                    _mm(row.x1 - row.x0), _mm(row.y1 - row.y0),
+                    _mm(row.mask), _mm(row.clearance)))
+        elif kind == 'pins':
+            lines.append(
+                '  (pad "{}" thru_hole circle (at {} {}) (size {} {}) '
+                '(drill {}) (layers *.Cu *.Mask) '
+                '(solder_mask_margin {}) (clearance {}))'.format(
+                    _number_str(row.number),
+                    _mm(row.x), _mm(row.y),
+                    _mm(row.ring_r * 2), _mm(row.ring_r * 2),
+                    _mm(row.hole_r * 2),
+                    _mm(row.mask), _mm(row.clearance)))
+        elif kind == 'balls':
+            lines.append(
+                '  (pad "{}" smd circle (at {} {}) (size {} {}) '
+                '(layers F.Cu F.Paste F.Mask) '
+                '(solder_mask_margin {}) (clearance {}))'.format(
+                    _number_str(row.number),
+                    _mm(row.x), _mm(row.y),
+                    _mm(row.r * 2), _mm(row.r * 2),
+                    _mm(row.mask), _mm(row.clearance)))
+        elif kind == 'lines':
+            lines.append(
+                '  (fp_line (start {} {}) (end {} {}) '
+                '(layer F.SilkS) (width {}))'.format(
+                    _mm(row.x1), _mm(row.y1), _mm(row.x2), _mm(row.y2),
+                    _mm(row.thickness)))
+    lines.append(')')
+    lines.append('')
+    return "\n".join(lines)
+
+CSV_FIELDS = ['kind', 'number', 'x', 'y', 'width', 'height', 'drill',
+              'clearance', 'mask']
+
+def _table_row(kind, row):
+    '''
+    A dict with the center and size of a pad, pin or ball row, in mils, or
+    None for lines.
+    '''
+    if kind == 'pads':
+        return dict(kind='pad', number=row.number,
+                    x=(row.x0 + row.x1) / 2., y=(row.y0 + row.y1) / 2.,
+                    width=row.x1 - row.x0, height=row.y1 - row.y0,
+                    drill=None, clearance=row.clearance, mask=row.mask)
+    elif kind == 'pins':
+        return dict(kind='pin', number=row.number, x=row.x, y=row.y,
+                    width=row.ring_r * 2, height=row.ring_r * 2,
+                    drill=row.hole_r * 2,
+                    clearance=row.clearance, mask=row.mask)
+    elif kind == 'balls':
+        return dict(kind='ball', number=row.number, x=row.x, y=row.y,
+                    width=row.r * 2, height=row.r * 2, drill=None,
+                    clearance=row.clearance, mask=row.mask)
+    return None
+
+def _table_rows(snapshot):
+    '''
+    One dict per pad, pin or ball; see _table_row.
+    '''
+    for kind, row in snapshot.ordered_rows():
+        table_row = _table_row(kind, row)
+        if table_row is not None:
+            yield table_row
+
+def emit_csv(snapshot):
+    '''
+    A table of pads, pins and balls, in mils, for assembly tools.
+    '''
+    out = io.BytesIO() if str is bytes else io.StringIO()
+    writer = csv.DictWriter(out, CSV_FIELDS, lineterminator="\n")
+    writer.writeheader()
+    for row in _table_rows(snapshot):
+        writer.writerow(dict((k, '' if v is None else v)
+                             for k, v in row.items()))
+    return out.getvalue()
+
+def emit_json(snapshot):
+    '''
+    The same table as emit_csv, plus the drawn lines, as JSON.
+    '''
+    return json.dumps(dict(
+        name=snapshot.fp_name,
+        units="mil",
+        pads=list(_table_rows(snapshot)),
+        lines=[row._asdict() for row in snapshot.rows('lines')],
+    ), indent=2, sort_keys=True)
+
+# The fields of the array geometry_arrays returns. Lengths are floats in
+# the requested unit; drill is NaN for anything that isn't a pin.
+ARRAY_DTYPE = [
+    ('kind', 'U4'),
+    ('number', object),
+    ('x', float),
+    ('y', float),
+    ('width', float),
+    ('height', float),
+    ('drill', float),
+    ('clearance', float),
+    ('mask', float),
+    ('suppressed', bool),
+]
+
+def geometry_arrays(object_manager, unit="iu"):
+    '''
+    Return a NumPy structured array (see ARRAY_DTYPE) with a record for
+    every pad, pin and ball in object_manager, suppressed or not, in the
+    order they appear. Lengths are converted to unit, one of units.UNITS.
+
+    This needs NumPy, which fpgen doesn't otherwise depend on.
+    '''
+    if numpy is None:
+        raise ImportError("geometry_arrays needs NumPy")
+    assert unit in UNITS
+    scale = 1. / UNITS[unit]
+    nan = float('nan')
+    records = []
+    for primitive in object_manager.primitives:
+        for kind, ty, _ in PAD_KINDS:
+            if isinstance(primitive, ty):
+                row = _table_row(kind, _ROW_FUNCS[kind](primitive))
+                drill = row['drill']
+                records.append((
+                    row['kind'],
+                    row['number'],
+                    row['x'] * scale,
+                    row['y'] * scale,
+                    row['width'] * scale,
+                    row['height'] * scale,
+                    drill * scale if drill is not None else nan,
+                    row['clearance'] * scale,
+                    row['mask'] * scale,
+                    primitive.is_suppressed(),
+                ))
+    return numpy.array(records, dtype=ARRAY_DTYPE)
+
+# Map from format names to functions taking a GeometrySnapshot and
+# returning the text of the file. Add to this with register_emitter.
+EMITTERS = {
+    'geda': emit_geda,
+    'kicad_mod': emit_kicad_mod,
+    'csv': emit_csv,
+    'json': emit_json,
+}
+
+# File extensions for each format, used to guess a format from a filename.
+EXTENSIONS = {
+    'geda': '.fp',
+    'kicad_mod': '.kicad_mod',
+    'csv': '.csv',
+    'json': '.json',
+}
+
+def register_emitter(name, emitter, extension=None):
+    EMITTERS[name] = emitter
+    if extension is not None:
+        EXTENSIONS[name] = extension
+
+def format_for_filename(filename):
+    '''
+    Guess the export format from filename's extension; None if there's no
+    match.
+    '''
+    for name, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return name
+    return None
+
+def _write_one(snapshot, fmt, filename, results):
+    text = EMITTERS[fmt](snapshot)
+    if filename is not None:
+        with open(filename, "w") as f:
+            f.write(text)
+        io_log.info("Exported %s as %s", filename, fmt)
+    results[fmt, filename] = text
+
+def export(snapshot, targets, concurrent=False):
+    '''
+    Write snapshot in several formats. targets is a list of
+    (format, filename) pairs; a filename of None just formats the text.
+    Returns a dict mapping (format, filename) to the text.
+
+    If concurrent is set, each target is formatted and written on its own
+    thread. This mostly helps when the files are on slow storage; the
+    formatting itself still takes turns on the interpreter lock.
+    '''
+    for fmt, _ in targets:
+        if fmt not in EMITTERS:
+            raise ValueError("Unknown export format: {}".format(fmt))
+    results = {}
+    if not concurrent:
+        for fmt, filename in targets:
+            _write_one(snapshot, fmt, filename, results)
+        return results
+    errors = []
+    def run(fmt, filename):
+        try:
+            _write_one(snapshot, fmt, filename, results)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=target)
+               for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def export_object_manager(object_manager, targets, concurrent=False):
+    '''
+    Snapshot object_manager and export it to targets; see export().
+    '''
+    return export(GeometrySnapshot.new(object_manager), targets, concurrent)
@@ -6,8 +6,10 @@ import gobject
 import gtk
 import itertools
 
+from background_solver import BackgroundSolver
 from exceptiontypes import OverconstrainedException
 from geda_out import GedaOut
+from logging_utils import ui_log
 from math_utils import point_dist
 from object_manager import ObjectManager
 from primitives import (
@@ -16,8 +18,13 @@ from primitives import (
     Pad,
     Vertical,
 )
+from session import SessionRecorder
 from ui_utils import do_configuration
 
+# Pointer motion smaller than this many pixels (in both directions) since the
+# last motion we handled is ignored.
+MIN_MOTION_PIXELS = 0.5
+
 class FPArea(gtk.DrawingArea):
     __gsignals__ = {
         # Emitted when there's a (possible) change to the number
@@ -31,6 +38,11 @@ class FPArea(gtk.DrawingArea):
 
         'modified': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
                      (bool,)),
+
+        # Emitted with True when a background solve starts, and False when
+        # we're no longer waiting on one.
+        'solving': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                    (bool,)),
     }
 
     def __init__(self, object_manager):
@@ -53,6 +65,12 @@ class FPArea(gtk.DrawingArea):
         # Where we last saw the mouse.
         self.x = 0
         self.y = 0
+        # Pointer motion is handled at most once per frame: motion events
+        # just record where the pointer is (in screen coordinates), and an
+        # idle callback catches up with the latest position.
+        self._pending_pointer = None
+        self._handled_pointer = None
+        self._motion_source = None
         # Where a "select other" in progress was started.
         self.active_x = None
         self.active_y = None
@@ -69,8 +87,21 @@ class FPArea(gtk.DrawingArea):
         self.active_object = None
         self.dragging_object = None
         self.selected_primitives = set()
+        # Primitives whose constraints conflicted the last time something
+        # was overconstrained. They're drawn highlighted until the next
+        # successful solve.
+        self.conflicting_primitives = set()
         self.buttons = {}
 
+        # Solves run in the background; see recalculate.
+        self._solver = BackgroundSolver(self._solve_finished)
+        self.solving = False
+        # Whether to take an undo snapshot once the pending solve is done.
+        self._snapshot_after_solve = False
+
+        # A session.SessionRecorder while recording; see start_recording.
+        self.recorder = None
+
         # Create the center point
         self.deselect_all()
 
@@ -82,10 +113,23 @@ class FPArea(gtk.DrawingArea):
 
         self.snapshot()
 
+    def start_recording(self):
+        '''
+        Start recording what the user does, for replaying later.
+        '''
+        self.recorder = SessionRecorder(self.object_manager, (self.x, self.y))
+
+    def stop_recording(self):
+        '''
+        Stop recording, and return the session.SessionRecorder.
+        '''
+        recorder, self.recorder = self.recorder, None
+        return recorder
+
     def scroll_event(self, _, event):
         # When the scroll wheel is used, zoom in or out.
         x, y = self.coord_map(event.x, event.y)
-        print(x, y)
+        ui_log.debug("Scroll at (%s, %s)", x, y)
         if event.direction == gtk.gdk.SCROLL_UP:
             self.scale_factor *= 1.3
         elif event.direction == gtk.gdk.SCROLL_DOWN:
@@ -93,14 +137,77 @@ class FPArea(gtk.DrawingArea):
         self.scale_x = event.x / self.scale_factor - x
         self.scale_y = event.y / self.scale_factor - y
 
-        print(self.scale_factor, self.scale_x, self.scale_y)
+        ui_log.debug("Scale %s, offset (%s, %s)",
+                     self.scale_factor, self.scale_x, self.scale_y)
+        self.queue_draw()
+
+    def recalculate(self, snapshot=False):
+        '''
+        Re-solve the constraints in the background. The result is applied
+        once the solve finishes (superseding any solve still pending), and
+        if snapshot is set an undo snapshot is taken after that.
+        '''
+        request = self.object_manager.solve_request(self.dragging_object)
+        self._snapshot_after_solve = self._snapshot_after_solve or snapshot
+        self.set_solving(True)
+        self._solver.submit(request)
+        self.update_closest()
         self.queue_draw()
 
-    def recalculate(self):
-        self.object_manager.update_points(self.dragging_object)
+    def _solve_finished(self, request, result, error):
+        self.set_solving(False)
+        if error is not None:
+            self._snapshot_after_solve = False
+            return
+        if result is None:
+            self._snapshot_after_solve = False
+            self.show_conflict(
+                self.object_manager.conflicting_primitives(request))
+            return
+        self.conflicting_primitives.clear()
+        applied = self.object_manager.apply_solution(request, result)
+        # Even if the solution is out of date, the factorization is kept.
+        self.update_buttons()
+        if not applied:
+            # Something changed while we were solving, and whatever changed
+            # it has solved again since. Any snapshot waits for that.
+            return
+        if self._snapshot_after_solve:
+            self._snapshot_after_solve = False
+            self.snapshot()
         self.update_closest()
         self.queue_draw()
 
+    def show_conflict(self, primitives):
+        '''
+        Report that something is overconstrained, highlighting the given
+        primitives as the cause.
+        '''
+        if primitives:
+            ui_log.warning("Overconstrained by: %s",
+                           ", ".join(primitive.NAME
+                                     for primitive in primitives))
+        else:
+            ui_log.warning("Overconstrained!")
+        self.conflicting_primitives = set(primitives)
+        self.queue_draw()
+
+    def set_solving(self, solving):
+        if solving != self.solving:
+            self.solving = solving
+            self.emit("solving", solving)
+            if solving:
+                self.update_buttons()
+
+    def snapshot_when_solved(self):
+        '''
+        Take an undo snapshot, waiting for any pending solve first.
+        '''
+        if self.solving:
+            self._snapshot_after_solve = True
+        else:
+            self.snapshot()
+
     def deselect_all(self):
         self.selected_primitives.clear()
         self.update_buttons()
@@ -116,27 +223,31 @@ class FPArea(gtk.DrawingArea):
             'd': HorizDistance,
         }
         keyname = gtk.gdk.keyval_name(event.keyval)
-        print(keyname)
+        ui_log.debug("Key press: %s", keyname)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.key(keyname, self.active_object)
         if keyname == 'a':
             config = Pad.configure([])
+            if recorder is not None:
+                recorder.dialog(config)
             if config is not False:
                 p = Pad.new(self.object_manager, self.x, self.y, config)
                 #p = Ball(self.object_manager, self.x, self.y, 100)
                 self.recalculate()
         elif keyname == 'Delete':
-            print(self.active_object)
+            ui_log.debug("Delete %r", self.active_object)
             if self.active_object is not None:
                 self.object_manager.delete_primitive(self.active_object)
             self.active_object = None
-            self.recalculate()
-            self.snapshot()
+            self.recalculate(snapshot=True)
         elif keyname == 'dd':
             if len(self.selected_primitives) == 2:
                 l = list(self.selected_primitives)
                 p = HorizDistance(self.object_manager, l[0], l[1], 100, 30)
                 self.selected_primitives.clear()
             else:
-                print("Select two points.")
+                ui_log.info("Select two points.")
             self.recalculate()
         elif keyname == 'space':
             if self.active_object is not None:
@@ -152,58 +263,72 @@ class FPArea(gtk.DrawingArea):
         elif keyname == 'r':
             if self.active_object:
                 res = do_configuration(self.active_object)
-                self.recalculate()
-                if res:
-                    self.snapshot()
+                if recorder is not None:
+                    recorder.reconfigured(res)
+                self.recalculate(snapshot=res)
         elif keyname == 'Tab':
             obj = self.active_object
             if obj:
                 while obj:
                     if obj.exportable():
                         self.object_manager.toggle_suppressed(obj)
-                        self.snapshot()
+                        self.snapshot_when_solved()
                         break
                     else:
                         obj = obj.parent()
         else:
             cls = primitive_table.get(keyname)
             if cls:
-                if cls.can_create(self.selected_primitives):
+                if self.can_create(cls):
                     configuration = cls.configure(self.selected_primitives)
+                    if recorder is not None:
+                        recorder.dialog(configuration)
                     if configuration:
                         p = cls.new(self.object_manager,
                                     0, 0,
                                     configuration)
                         self.deselect_all()
                 else:
-                    print("Cannot create constraint.")
+                    ui_log.info("Cannot create constraint.")
             self.recalculate()
         self.update_closest()
         self.queue_draw()
 
     def set_object_manager(self, object_manager):
+        # Results for the old object manager are no use to us now.
+        self._solver.cancel()
+        self._snapshot_after_solve = False
+        self.set_solving(False)
         self.object_manager = object_manager
+        if self.recorder is not None:
+            self.recorder.object_manager = object_manager
         self.selected_primitives.clear()
+        self.conflicting_primitives.clear()
         self.update_buttons()
         self.recalculate()
         self.update_closest()
         self.queue_draw()
 
     def add_new(self, primitive_type):
-        if primitive_type.can_create(self.selected_primitives):
+        snapshot = False
+        if self.recorder is not None:
+            self.recorder.add(primitive_type)
+        if self.can_create(primitive_type):
             configuration = primitive_type.configure(self.selected_primitives)
+            if self.recorder is not None:
+                self.recorder.dialog(configuration)
             if configuration is not False:
                 # TODO: x and y coords
                 try:
                     primitive_type.new(self.object_manager, 0, 0, configuration)
-                except OverconstrainedException:
-                    print("Overconstrained!")
+                except OverconstrainedException as e:
+                    self.show_conflict(e.conflicting_primitives)
                 else:
                     self.deselect_all()
-                    self.snapshot()
+                    snapshot = True
         else:
-            print("Cannot create constraint.")
-        self.recalculate()
+            ui_log.info("Cannot create constraint.")
+        self.recalculate(snapshot=snapshot)
         self.update_closest()
         self.queue_draw()
 
@@ -283,8 +408,11 @@ class FPArea(gtk.DrawingArea):
         for primitive in primitives:
 
             cr.save()
+            # Conflicting primitives are drawn as though they were active,
+            # which makes most of them red.
             primitive.draw(cr,
-                           primitive is self.active_object,
+                           primitive is self.active_object
+                           or primitive in self.conflicting_primitives,
                            primitive in self.selected_primitives)
             cr.restore()
         if self.object_manager.point_coords:
@@ -315,6 +443,24 @@ class FPArea(gtk.DrawingArea):
             x = event.x
             y = event.y
 
+        self._pending_pointer = (x, y)
+        if self._motion_source is None:
+            # This runs after all pending events have been handled, but
+            # before the next redraw.
+            self._motion_source = gobject.idle_add(
+                self._process_motion, priority=gobject.PRIORITY_HIGH_IDLE)
+        return True
+
+    def _process_motion(self):
+        self._motion_source = None
+        x, y = self._pending_pointer
+        if self._handled_pointer is not None:
+            last_x, last_y = self._handled_pointer
+            if (abs(x - last_x) < MIN_MOTION_PIXELS and
+                abs(y - last_y) < MIN_MOTION_PIXELS):
+                return False
+        self._handled_pointer = (x, y)
+
         orig_x, orig_y = self.x, self.y
         self.x, self.y = self.coord_map(x, y)
         self.emit("cursor-motion", self.x, self.y)
@@ -322,20 +468,27 @@ class FPArea(gtk.DrawingArea):
             self.scale_x += (self.x - orig_x)
             self.scale_y += (self.y - orig_y)
             self.x, self.y = self.coord_map(x, y)
+        if self.recorder is not None:
+            self.recorder.motion(self.x - orig_x, self.y - orig_y)
         if self.dragging_object is not None:
             result = self.dragging_object.drag(self.x - orig_x, self.y - orig_y)
-            if result:
+            # While a solve is pending, the solution map is out of date (or
+            # gone, if points have come or gone). The rest of the points
+            # catch up when the solve that started the drag is applied.
+            if result and not self.solving:
                 self.object_manager.update_all_point_coords()
         if self.active_x is not None and (
                 self.dragging or self.dragging_object is not None):
             self.active_x += (self.x - orig_x)
             self.active_y += (self.y - orig_y)
         self.queue_draw()
-        return True
+        return False
 
     def select_other(self, menuitem, state, primitive):
         if state == gtk.STATE_NORMAL:
-            print(primitive)
+            ui_log.debug("Select %r", primitive)
+            if self.recorder is not None:
+                self.recorder.select(primitive)
             self.active_object = primitive
             x, y = self.get_pointer()
             self.x, self.y = self.coord_map(x, y)
@@ -367,6 +520,13 @@ class FPArea(gtk.DrawingArea):
         del self._redo_list[:]
         self.emit("modified", True)
 
+    def current_snapshot(self):
+        '''
+        The dictionary (from ObjectManager.to_dict) of the last undo
+        snapshot. It isn't changed afterwards.
+        '''
+        return self._undo_list[-1][0]
+
     def can_undo(self):
         return len(self._undo_list) > 1
 
@@ -374,6 +534,8 @@ class FPArea(gtk.DrawingArea):
         return len(self._redo_list) > 0
 
     def undo(self):
+        if self.recorder is not None:
+            self.recorder.undo()
         self._redo_list.append(self._undo_list.pop())
         (last_fp, last_modified) = self._undo_list[-1]
         new_object_manager = ObjectManager.from_dict(last_fp)
@@ -381,6 +543,8 @@ class FPArea(gtk.DrawingArea):
         self.emit("modified", last_modified)
 
     def redo(self):
+        if self.recorder is not None:
+            self.recorder.redo()
         (next_fp, next_modified) = self._redo_list.pop()
         self._undo_list.append((next_fp, next_modified))
         new_object_manager = ObjectManager.from_dict(next_fp)
@@ -390,12 +554,12 @@ class FPArea(gtk.DrawingArea):
     def click_event(self, _, event):
         x, y = self.coord_map(event.x, event.y)
 
-        print(event.button)
-
-        print("Click %s %s" % (x, y))
+        ui_log.debug("Click (button %s) at (%s, %s)", event.button, x, y)
+        if self.recorder is not None:
+            self.recorder.click(event.button, self.active_object)
         if event.button == 1:
             if self.active_object is not None:
-                print("Start drag")
+                ui_log.debug("Start drag of %r", self.active_object)
                 self.dragging_object = self.active_object
                 drag_result = self.dragging_object.drag(0, 0)
                 self.active_x = self.x
@@ -419,18 +583,35 @@ class FPArea(gtk.DrawingArea):
         return True
 
     def release_event(self, _, event):
-        print(event)
+        ui_log.debug("Release (button %s)", event.button)
+        if self.recorder is not None:
+            self.recorder.release(event.button)
         if event.button == 1:
-            print("Relase drag")
             if self.dragging_object is not None:
-                self.snapshot()
+                self.snapshot_when_solved()
             self.dragging_object = None
         elif event.button == 2:
             self.dragging = False
 
+    def can_create(self, primitive_type):
+        '''
+        Whether a primitive_type can be created from the selection without
+        overconstraining anything.
+
+        Checking needs the constraints factored. Rather than do that here,
+        on the main loop, this says no until the background solve has done
+        it; update_buttons is called again then.
+        '''
+        if not primitive_type.can_create(self.selected_primitives):
+            return False
+        constraints = primitive_type.preview_constraints(
+            self.object_manager, self.selected_primitives)
+        if constraints is None:
+            return True
+        if self.solving or not self.object_manager.primary_factored():
+            return False
+        return self.object_manager.constraints_independent(constraints)
+
     def update_buttons(self):
         for button, buttoncls in self.buttons.iteritems():
-            if buttoncls.can_create(self.selected_primitives):
-                button.set_sensitive(True)
-            else:
-                button.set_sensitive(False)
+            button.set_sensitive(self.can_create(buttoncls))
@@ -1,3 +1,6 @@
+import sys
+from weakref import WeakKeyDictionary
+
 from primitives import (
     Ball,
     DrawnLine,
@@ -5,80 +8,173 @@ from primitives import (
     Pin,
 )
 
+ELEMENT_FORMAT = """Element [0x00 "{0}" "{0}" "{0}" 0.000000mil 0.000000mil 0.000000mil 0.000000mil 0 100 0x00]"""
+BALL_FORMAT = """Pad [ {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "{}" "{}" "" ]"""
+HORIZ_PAD_FORMAT = """Pad [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" 0x101]"""
+VERT_PAD_FORMAT = """Pad [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" 0x4101]"""
+PIN_FORMAT = """Pin [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" "via"]"""
+LINE_FORMAT = """ElementLine [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil ]"""
+
+def _number_str(number):
+    return number if number is not None else ''
+
+def _number(primitive):
+    return _number_str(primitive.number())
+
 class GedaOut(object):
+    '''
+    Writes footprints as gEDA PCB elements.
+
+    Each primitive's line is cached along with the geometry and attributes
+    it was made from, so writing again after a small change only formats
+    the primitives that changed.
+    '''
+    # Map from primitives to (key, line), where key is everything line was
+    # made from.
+    _lines = WeakKeyDictionary()
+
+    @staticmethod
+    def _cached_line(primitive, key, format_line):
+        '''
+        Return the cached line for primitive if it was made from key, and
+        otherwise format_line(*key), which is cached.
+        '''
+        cached = GedaOut._lines.get(primitive)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        line = format_line(*key)
+        GedaOut._lines[primitive] = (key, line)
+        return line
+
     @staticmethod
-    def write_ball(ball):
-        mask = float(ball.mask().to("mil")) * 2
-        clearance = float(ball.clearance().to("mil")) * 2
+    def format_ball(ball):
+        key = (ball.x, ball.y, ball.r,
+               float(ball.clearance().to("mil")) * 2,
+               float(ball.mask().to("mil")) * 2,
+               _number(ball))
+        return GedaOut._cached_line(ball, key, GedaOut._ball_line)
 
-        print """Pad [ {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "{}" "{}" "" ]""".format(
-            ball.x, ball.y, ball.x, ball.y,
-            ball.r*2, # Thickness
+    @staticmethod
+    def _ball_line(x, y, r, clearance, mask, number):
+        return BALL_FORMAT.format(
+            x, y, x, y,
+            r*2, # Thickness
             clearance, # Clearance
-            ball.r*2 + mask, # Mask
-            ball.number() if ball.number() is not None else '',
-            ball.number() if ball.number() is not None else '',
+            r*2 + mask, # Mask
+            number,
+            number,
         )
 
     @staticmethod
-    def write_pad(pad):
-        mask = float(pad.mask().to("mil")) * 2
-        clearance = float(pad.clearance().to("mil")) * 2
-        if pad.w > pad.h:
-            x0 = pad.x0 + pad.h/2.
-            x1 = pad.x1 - pad.h/2.
-            y = (pad.y0 + pad.y1)/2.
-            print """Pad [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" 0x101]""".format(
-                x0, y, x1, y,
-                pad.h, # Thickness
+    def format_pad(pad):
+        key = (pad.x0, pad.x1, pad.y0, pad.y1,
+               float(pad.clearance().to("mil")) * 2,
+               float(pad.mask().to("mil")) * 2,
+               _number(pad))
+        return GedaOut._cached_line(pad, key, GedaOut._pad_line)
+
+    @staticmethod
+    def _pad_line(x0, x1, y0, y1, clearance, mask, number):
+        w = x1 - x0
+        h = y1 - y0
+        if w > h:
+            y = (y0 + y1)/2.
+            return HORIZ_PAD_FORMAT.format(
+                x0 + h/2., y, x1 - h/2., y,
+                h, # Thickness
                 clearance, # Clearance
-                pad.h + mask, # Mask
-                pad.number() if pad.number() is not None else '')
+                h + mask, # Mask
+                number)
         else:
-            y0 = pad.y0 + pad.w/2.
-            y1 = pad.y1 - pad.w/2.
-            x = (pad.x0 + pad.x1)/2.
-            print """Pad [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" 0x4101]""".format(
-                x, y0, x, y1,
-                pad.w, # Thickness
+            x = (x0 + x1)/2.
+            return VERT_PAD_FORMAT.format(
+                x, y0 + w/2., x, y1 - w/2.,
+                w, # Thickness
                 clearance, # Clearance
-                pad.w + mask, # Mask
-                pad.number() if pad.number() is not None else '')
+                w + mask, # Mask
+                number)
+
+    @staticmethod
+    def format_pin(pin):
+        key = (pin.x, pin.y, pin.ring_r, pin.hole_r,
+               pin.clearance().to("mil") * 2,
+               pin.mask().to("mil") * 2,
+               _number(pin))
+        return GedaOut._cached_line(pin, key, GedaOut._pin_line)
 
     @staticmethod
-    def write_pin(pin):
-        mask = pin.mask().to("mil") * 2
-        clearance = pin.clearance().to("mil") * 2
-        print """Pin [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil "" "{}" "via"]""".format(
-            pin.x, pin.y,
-            pin.ring_r * 2,
+    def _pin_line(x, y, ring_r, hole_r, clearance, mask, number):
+        return PIN_FORMAT.format(
+            x, y,
+            ring_r * 2,
             clearance,
             mask,
-            pin.hole_r * 2,
-            pin.number() if pin.number() is not None else ''
+            hole_r * 2,
+            number,
         )
 
     @staticmethod
-    def write_line(line):
-        print """ElementLine [{:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil {:.6f}mil ]""".format(
-            line.x1, line.y1, line.x2, line.y2, line.thickness
-            )
+    def format_line(line):
+        key = (line.x1, line.y1, line.x2, line.y2, line.thickness)
+        return GedaOut._cached_line(line, key, LINE_FORMAT.format)
 
     @staticmethod
-    def write(object_manager):
+    def format(object_manager):
+        '''
+        Return the footprint as the text of a gEDA PCB element.
+        '''
         fp_name = object_manager.fp_name
-        primitive_list = object_manager.primitives
-        print """Element [0x00 "{}" "{}" "{}" 0.000000mil 0.000000mil 0.000000mil 0.000000mil 0 100 0x00]""".format(fp_name, fp_name, fp_name)
-        print "("
+        lines = [ELEMENT_FORMAT.format(fp_name), "("]
         functab = [
-            (Ball, GedaOut.write_ball),
-            (Pad, GedaOut.write_pad),
-            (Pin, GedaOut.write_pin),
-            (DrawnLine, GedaOut.write_line),
+            (Ball, GedaOut.format_ball),
+            (Pad, GedaOut.format_pad),
+            (Pin, GedaOut.format_pin),
+            (DrawnLine, GedaOut.format_line),
         ]
-        for primitive in primitive_list:
+        for primitive in object_manager.primitives:
             if not primitive.is_suppressed():
                 for ty, func in functab:
                     if isinstance(primitive, ty):
-                        func(primitive)
-        print ")"
+                        lines.append(func(primitive))
+        lines.append(")")
+        lines.append("")
+        return "\n".join(lines)
+
+    @staticmethod
+    def format_snapshot(snapshot):
+        '''
+        Return the text of a gEDA PCB element for an export.GeometrySnapshot.
+        '''
+        lines = [ELEMENT_FORMAT.format(snapshot.fp_name), "("]
+        for kind, row in snapshot.ordered_rows():
+            if kind == 'balls':
+                lines.append(GedaOut._ball_line(
+                    row.x, row.y, row.r, row.clearance * 2, row.mask * 2,
+                    _number_str(row.number)))
+            elif kind == 'pads':
+                lines.append(GedaOut._pad_line(
+                    row.x0, row.x1, row.y0, row.y1,
+                    row.clearance * 2, row.mask * 2,
+                    _number_str(row.number)))
+            elif kind == 'pins':
+                lines.append(GedaOut._pin_line(
+                    row.x, row.y, row.ring_r, row.hole_r,
+                    row.clearance * 2, row.mask * 2,
+                    _number_str(row.number)))
+            elif kind == 'lines':
+                lines.append(LINE_FORMAT.format(*row))
+        lines.append(")")
+        lines.append("")
+        return "\n".join(lines)
+
+    @staticmethod
+    def write(object_manager, out=None):
+        '''
+        Write the footprint to out, a file-like object (standard output by
+        default), in a single write. Returns the text.
+        '''
+        text = GedaOut.format(object_manager)
+        if out is None:
+            out = sys.stdout
+        out.write(text)
+        return text
@@ -0,0 +1,140 @@
+# Optional instrumentation of the solver. None of this is used unless it's
+# switched on with ObjectManager.enable_instrumentation; when it's off, the
+# solver skips all of it.
+
+import time
+from collections import defaultdict
+
+# The phases of a solve, in order:
+#   gather: collecting constraints from primitives (solve_request).
+#   primary: eliminating the explicit constraints.
+#   secondary: eliminating secondary constraints and pinning points.
+#   inverse: assembling the solution map.
+#   update: computing new point coordinates from the solution map.
+PHASES = ('gather', 'primary', 'secondary', 'inverse', 'update')
+
+class SolveProbe(object):
+    '''
+    Measurements for a single solve, filled in as the solve goes.
+    '''
+    def __init__(self):
+        self.phase_times = {}
+        self._phase = None
+        self._phase_start = None
+        # Constraint rows given to the solver.
+        self.rows = 0
+        # Nonzero coefficients in the explicit constraints, before and after
+        # elimination. The difference is the fill-in.
+        self.input_nonzeros = 0
+        self.factor_nonzeros = 0
+        # Nonzero coefficients in the solution map.
+        self.inverse_nonzeros = 0
+        # Rows that were used as pivots.
+        self.pivots = 0
+        # Existing rows that had to be updated when a pivot was added.
+        self.row_updates = 0
+        # Secondary constraints and point pins that were skipped because
+        # they were dependent on earlier rows.
+        self.dependent_rows = 0
+        self.degrees_of_freedom = None
+
+    def start(self, phase):
+        now = time.time()
+        self._finish(now)
+        self._phase = phase
+        self._phase_start = now
+
+    def stop(self):
+        self._finish(time.time())
+        self._phase = None
+
+    def _finish(self, now):
+        if self._phase is not None:
+            self.phase_times[self._phase] = (
+                self.phase_times.get(self._phase, 0.0)
+                + now - self._phase_start)
+
+    @property
+    def fill_in(self):
+        return self.factor_nonzeros - self.input_nonzeros
+
+    def as_dict(self):
+        return dict(
+            phase_times=dict(self.phase_times),
+            rows=self.rows,
+            input_nonzeros=self.input_nonzeros,
+            factor_nonzeros=self.factor_nonzeros,
+            fill_in=self.fill_in,
+            inverse_nonzeros=self.inverse_nonzeros,
+            pivots=self.pivots,
+            row_updates=self.row_updates,
+            dependent_rows=self.dependent_rows,
+            degrees_of_freedom=self.degrees_of_freedom,
+        )
+
+class SolverStats(object):
+    '''
+    Totals over all solves since the last reset, plus cache hit counts.
+
+    Trace callbacks, if any, are called with a dictionary describing each
+    event as it happens.
+    '''
+    def __init__(self):
+        self.trace_callbacks = []
+        self.reset()
+
+    def reset(self):
+        self.solves = 0
+        self.phase_times = dict((phase, 0.0) for phase in PHASES)
+        self.rows = 0
+        self.fill_in = 0
+        self.pivots = 0
+        self.row_updates = 0
+        self.dependent_rows = 0
+        self.cache_hits = defaultdict(int)
+        self.cache_misses = defaultdict(int)
+
+    def add_probe(self, probe):
+        self.solves += 1
+        for phase, phase_time in probe.phase_times.iteritems():
+            self.phase_times[phase] += phase_time
+        self.rows += probe.rows
+        self.fill_in += probe.fill_in
+        self.pivots += probe.pivots
+        self.row_updates += probe.row_updates
+        self.dependent_rows += probe.dependent_rows
+        if self.trace_callbacks:
+            event = probe.as_dict()
+            event['event'] = 'solve'
+            self.trace(event)
+
+    def hit(self, cache):
+        self.cache_hits[cache] += 1
+
+    def miss(self, cache):
+        self.cache_misses[cache] += 1
+
+    def hit_rate(self, cache):
+        hits = self.cache_hits[cache]
+        total = hits + self.cache_misses[cache]
+        if not total:
+            return None
+        return hits / float(total)
+
+    def trace(self, event):
+        for callback in self.trace_callbacks:
+            callback(event)
+
+    def as_dict(self):
+        caches = set(self.cache_hits) | set(self.cache_misses)
+        return dict(
+            solves=self.solves,
+            phase_times=dict(self.phase_times),
+            rows=self.rows,
+            fill_in=self.fill_in,
+            pivots=self.pivots,
+            row_updates=self.row_updates,
+            dependent_rows=self.dependent_rows,
+            cache_hit_rates=dict((cache, self.hit_rate(cache))
+                                 for cache in caches),
+        )
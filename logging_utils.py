@@ -0,0 +1,65 @@
+# Logging. Each subsystem has its own logger:
+#   solver: the constraint solver and the ObjectManager.
+#   ui: the editor and its event handlers.
+#   io: loading, saving and exporting footprints.
+#
+# By default only warnings and errors are logged. Levels can be set per
+# subsystem with set_levels, or through the FPGEN_LOG environment variable,
+# for example FPGEN_LOG="solver=debug,ui=info", or FPGEN_LOG=debug for
+# everything.
+#
+# Log calls should pass their arguments separately rather than formatting
+# the message themselves, so that nothing is formatted when the message's
+# level is disabled.
+
+import logging
+import os
+import sys
+
+SUBSYSTEMS = ('solver', 'ui', 'io')
+
+solver_log = logging.getLogger('fpgen.solver')
+ui_log = logging.getLogger('fpgen.ui')
+io_log = logging.getLogger('fpgen.io')
+
+_fpgen_log = logging.getLogger('fpgen')
+_fpgen_log.setLevel(logging.WARNING)
+# Without a handler, Python complains the first time something is logged.
+_fpgen_log.addHandler(logging.NullHandler())
+
+LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s: %(message)s"
+
+def set_levels(spec):
+    '''
+    Set log levels from a string like "solver=debug,ui=info". A level
+    without a subsystem applies to all of them.
+    '''
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            subsystem, level_name = item.split('=', 1)
+            subsystem = subsystem.strip()
+            if subsystem not in SUBSYSTEMS:
+                raise ValueError("Unknown subsystem: %s" % subsystem)
+            logger = logging.getLogger('fpgen.' + subsystem)
+        else:
+            level_name = item
+            logger = _fpgen_log
+        level = logging.getLevelName(level_name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level: %s" % level_name)
+        logger.setLevel(level)
+
+def configure(stream=None):
+    '''
+    Send log messages to the given stream (stderr by default), with levels
+    taken from FPGEN_LOG.
+    '''
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _fpgen_log.addHandler(handler)
+    spec = os.environ.get('FPGEN_LOG')
+    if spec:
+        set_levels(spec)
@@ -2,14 +2,24 @@ from __future__ import print_function
 
 import pygtk
 pygtk.require('2.0')
+import gobject
 import gtk
 import json
+import os
 
+from autosave import AutoSaver, atomic_write, autosave_filename
 from defaults import (
     DEFAULT_DEFAULT_CLEARANCE_MILS,
     DEFAULT_DEFAULT_MASK_MILS,
 )
+from export import (
+    EMITTERS,
+    EXTENSIONS,
+    export_object_manager,
+    format_for_filename,
+)
 from fparea import FPArea
+from logging_utils import configure as configure_logging, io_log
 from object_manager import ObjectManager
 from primitives import (
     Ball,
@@ -27,11 +37,13 @@ from primitives import (
     PadArray,
     Pin,
     PinArray,
+    RigidGroup,
     SameDistance,
     VertDistance,
     Vertical,
     VerticalDrawnLine,
 )
+from solve_cache import SolveCache
 from ui_utils import (
     configuration_widget,
     StringEntry,
@@ -51,7 +63,7 @@ class MainWindow(gtk.Window):
 
         self.set_geometry_hints(min_width=300, min_height=300)
         self.set_default_size(800, 600)
-        self.connect("delete-event", gtk.main_quit)
+        self.connect("delete-event", self.do_quit)
 
         if filename:
             object_manager = self.load_file(filename)
@@ -60,6 +72,9 @@ class MainWindow(gtk.Window):
 
         fparea = FPArea(object_manager)
         fparea.connect("modified", self.set_modified)
+        self.autosaver = AutoSaver(self.autosave_snapshot,
+                                   lambda: autosave_filename(self._filename))
+        fparea.connect("modified", self.autosaver.changed)
         fparea.show()
         self.fparea = fparea
         fparea.set_flags(gtk.CAN_FOCUS)
@@ -83,6 +98,10 @@ class MainWindow(gtk.Window):
         status_hbox.pack_end(coord_label)
         fparea.connect("cursor-motion", self.fparea_cursor_motion, coord_label)
 
+        solving_label = gtk.Label("Solving...")
+        status_hbox.pack_end(solving_label, False, False, 0)
+        fparea.connect("solving", self.update_solving, solving_label)
+
         area_vbox.pack_end(status_hbox, False, False, 0)
         dof_label.show()
         dof_contents_label.show()
@@ -95,6 +114,44 @@ class MainWindow(gtk.Window):
         self.add(vbox)
 
         self.update_title()
+        if not filename:
+            self.offer_recovery()
+
+    def offer_recovery(self):
+        '''
+        If an editor that didn't exit cleanly left an untitled footprint
+        behind, offer to carry on with it.
+        '''
+        autosave_path = autosave_filename(None)
+        if not os.path.exists(autosave_path):
+            return
+        dialog = gtk.MessageDialog(
+            self, gtk.DIALOG_MODAL, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+            "An unsaved footprint was left behind by an editor that didn't "
+            "exit cleanly. Recover it?")
+        response = dialog.run()
+        dialog.destroy()
+        if response != gtk.RESPONSE_YES:
+            os.remove(autosave_path)
+            return
+        try:
+            with open(autosave_path) as f:
+                d = json.load(f)
+            object_manager = ObjectManager.from_dict(d)
+        except Exception:
+            io_log.exception("Couldn't recover %s", autosave_path)
+            return
+        io_log.info("Recovered %s", autosave_path)
+        self.fparea.set_object_manager(object_manager)
+        self.fparea.clear_undo_buffer()
+        # It still hasn't been saved.
+        self.fparea.emit("modified", True)
+
+    def do_quit(self, *args):
+        # The autosave is only for recovering from a crash.
+        self.autosaver.discard()
+        self.autosaver.flush()
+        gtk.main_quit()
 
     def update_title(self):
         if self._modified:
@@ -110,10 +167,18 @@ class MainWindow(gtk.Window):
     def update_dof(self, _, dof, dof_label):
         dof_label.set_text(str(dof))
 
+    def update_solving(self, _, solving, solving_label):
+        if solving:
+            solving_label.show()
+        else:
+            solving_label.hide()
+
     def fparea_cursor_motion(self, _, x, y, coord_label):
         x = UnitNumber(x, "iu").to(self._default_units)
         y = UnitNumber(y, "iu").to(self._default_units)
-        coord_label.set_text("({:.3f}, {:.3f})".format(x, y))
+        text = "({:.3f}, {:.3f})".format(x, y)
+        if text != coord_label.get_text():
+            coord_label.set_text(text)
 
     def new_blank_object_manager(self):
         object_manager = ObjectManager(
@@ -129,13 +194,21 @@ class MainWindow(gtk.Window):
         with open(filename) as f:
             contents = f.read()
         d = json.loads(contents)
+        io_log.info("Loaded %s", filename)
         new_object_manager = ObjectManager.from_dict(d)
         self.fparea.set_object_manager(new_object_manager)
 
     def save_file(self, filename):
         d = self.fparea.object_manager.to_dict()
-        with open(filename, "w") as f:
-            f.write(json.dumps(d))
+        atomic_write(filename, json.dumps(d))
+        io_log.info("Saved %s", filename)
+        # Under the name it had until now, for Save As.
+        self.autosaver.discard()
+
+    def autosave_snapshot(self):
+        if not self._modified:
+            return None
+        return self.fparea.current_snapshot()
 
     def load_save_dialog(self, action):
         chooser = gtk.FileChooserDialog(
@@ -168,6 +241,8 @@ class MainWindow(gtk.Window):
             self.load_file(fname)
             self._filename = fname
             self.fparea.clear_undo_buffer()
+            if self.fparea.recorder is not None:
+                self.fparea.recorder.load(self.fparea.object_manager)
             self.update_title()
 
         chooser.destroy()
@@ -193,6 +268,31 @@ class MainWindow(gtk.Window):
         else:
             return self.do_saveas(_)
 
+    def do_export(self, _):
+        chooser = gtk.FileChooserDialog(
+            title="Export",
+            action=gtk.FILE_CHOOSER_ACTION_SAVE,
+            buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                     gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+        chooser.set_default_response(gtk.RESPONSE_OK)
+        chooser.set_do_overwrite_confirmation(True)
+        for fmt in sorted(EMITTERS):
+            fmt_filter = gtk.FileFilter()
+            fmt_filter.set_name(fmt)
+            if fmt in EXTENSIONS:
+                fmt_filter.add_pattern("*" + EXTENSIONS[fmt])
+            chooser.add_filter(fmt_filter)
+        response = chooser.run()
+        if response == gtk.RESPONSE_OK:
+            fname = chooser.get_filename()
+            # The extension decides the format, if it names one; otherwise
+            # go by the selected filter.
+            fmt = format_for_filename(fname)
+            if fmt is None:
+                fmt = chooser.get_filter().get_name()
+            export_object_manager(self.fparea.object_manager, [(fmt, fname)])
+        chooser.destroy()
+
     def do_fp_settings(self, _):
         fparea = self.fparea
         dialog = gtk.Dialog("Footprint settings")
@@ -223,9 +323,31 @@ class MainWindow(gtk.Window):
                 fparea.object_manager.fp_name = fp_name
                 fparea.object_manager.default_clearance = clearance
                 fparea.object_manager.default_mask = mask
+                if fparea.recorder is not None:
+                    fparea.recorder.settings(fp_name, clearance, mask)
             break
         dialog.destroy()
 
+    def do_record(self, item):
+        if item.get_active():
+            self.fparea.start_recording()
+            return
+        recorder = self.fparea.stop_recording()
+        if recorder is None:
+            return
+        chooser = gtk.FileChooserDialog(
+            title="Save recorded session",
+            action=gtk.FILE_CHOOSER_ACTION_SAVE,
+            buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                     gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+        chooser.set_default_response(gtk.RESPONSE_OK)
+        chooser.set_do_overwrite_confirmation(True)
+        if chooser.run() == gtk.RESPONSE_OK:
+            fname = chooser.get_filename()
+            recorder.save(fname)
+            io_log.info("Saved session %s", fname)
+        chooser.destroy()
+
     def update_undo_redo(self, _, __, undo_item, redo_item):
         undo_item.set_sensitive(self.fparea.can_undo())
         redo_item.set_sensitive(self.fparea.can_redo())
@@ -245,20 +367,29 @@ class MainWindow(gtk.Window):
         open_item = gtk.ImageMenuItem(gtk.STOCK_OPEN, accel_group)
         save_item = gtk.ImageMenuItem(gtk.STOCK_SAVE, accel_group)
         saveas_item = gtk.ImageMenuItem(gtk.STOCK_SAVE_AS, accel_group)
+        export_item = gtk.ImageMenuItem(gtk.STOCK_CONVERT, accel_group)
+        export_item.set_label("Export...")
+        record_item = gtk.CheckMenuItem("Record session")
         quit_sep = gtk.SeparatorMenuItem()
         quit_item = gtk.ImageMenuItem(gtk.STOCK_QUIT, accel_group)
         open_item.connect("activate", self.do_load)
         save_item.connect("activate", self.do_save)
         saveas_item.connect("activate", self.do_saveas)
-        quit_item.connect("activate", gtk.main_quit)
+        export_item.connect("activate", self.do_export)
+        record_item.connect("toggled", self.do_record)
+        quit_item.connect("activate", self.do_quit)
         file_menu.append(open_item)
         file_menu.append(save_item)
         file_menu.append(saveas_item)
+        file_menu.append(export_item)
+        file_menu.append(record_item)
         file_menu.append(quit_sep)
         file_menu.append(quit_item)
         open_item.show()
         save_item.show()
         saveas_item.show()
+        export_item.show()
+        record_item.show()
         quit_sep.show()
         quit_item.show()
 
@@ -324,6 +455,7 @@ class MainWindow(gtk.Window):
         ("HCons", MeasuredHorizDistance),
         ("VCons", MeasuredVertDistance),
         ("==", SameDistance),
+        ("Group", RigidGroup),
     ]
 
     def create_button_bar(self):
@@ -346,7 +478,10 @@ class MainWindow(gtk.Window):
 
 
 if __name__ == "__main__":
+    configure_logging()
+    ObjectManager.solve_cache = SolveCache()
+    # The solver runs on a separate thread.
+    gobject.threads_init()
     main_window = MainWindow()
     main_window.present()
-    print(main_window.focus_widget)
     gtk.main()
@@ -1,20 +1,42 @@
 # This file keeps track of what objects we have, and is responsible for
 # calculating positions and enforcing constraints on those objects.
-# Eventually, the core solver should be moved to a new file.
+# The core solver itself lives in solver.py.
 # Actually, the solver should be entirely rewritten.
 
-from collections import defaultdict
-from copy import deepcopy
+from contextlib import contextmanager
 
 from exceptiontypes import OverconstrainedException
+from export import geometry_arrays
+from instrumentation import SolveProbe, SolverStats
+from logging_utils import solver_log
 from primitives import PRIMITIVE_TYPES, Point
+from solve_cache import cached_solve
+from solver import (
+    SolveRequest,
+    constraint_to_row,
+    expand_derived,
+    expression_to_columns,
+    factor_constraints,
+    scalar_column,
+)
 from units import UnitNumber
 
+# Stands for a point or scalar that didn't exist, in the journal.
+_MISSING = object()
+
 class ObjectManager(object):
+    # A solve_cache.SolveCache shared by every ObjectManager (so that, say,
+    # undoing back to an earlier state reuses its solution), or None.
+    solve_cache = None
+
     def __init__(self, fp_name, default_clearance, default_mask):
+        # Incremented whenever something changes that could change the
+        # number, clearance or mask a primitive inherits; primitives cache
+        # these until then.
+        self.attribute_generation = 0
         self.fp_name = fp_name
-        self.default_clearance = default_clearance
-        self.default_mask = default_mask
+        self._default_clearance = default_clearance
+        self._default_mask = default_mask
 
         # Points are each assigned a number; next_point_idx contains the number
         # to assign to the next point we allocate.
@@ -30,11 +52,30 @@ class ObjectManager(object):
         # dragging points: we'll try harder to keep more recently moved
         # points where they are.
         self._point_lru = []
+        # Scalars are unknowns that aren't coordinates of points, like radii
+        # and widths. Like points, they're identified by numbers;
+        # _scalar_values maps each one to its current value.
+        self._next_scalar_idx = 0
+        self._scalar_values = {}
         # Caches of various internal things I should really document
         # at some point.
         self._cached_matrix = None
+        # The derived columns that went with _cached_matrix; see
+        # Primitive.derived_points.
+        self._cached_derived = {}
+        # The explicit constraints and derived columns of the last solve,
+        # and the solver.Elimination of them, so that later solves with the
+        # same constraints can start from it.
+        self._primary = None
+        # Incremented whenever the set of points or primitives changes, or
+        # we solve synchronously. A solve requested before that can no
+        # longer be applied.
+        self._solve_generation = 0
         # All primitives we have. TODO: make these sets
         self.primitives = []
+        # Map from primitives to their indices in primitives, rebuilt by
+        # primitive_idx when it's found to be out of date.
+        self._primitive_indices = {}
         # All primitives that should be drawn on the screen.
         self.draw_primitives = []
         # All primitives whose constraints we should consider.
@@ -46,6 +87,148 @@ class ObjectManager(object):
         self.degrees_of_freedom = 0
         # Global storage for each class.
         self.clsdata = {}
+        # A SolverStats if instrumentation is enabled; see
+        # enable_instrumentation.
+        self.instrumentation = None
+        # List of functions that undo the changes made in the current
+        # transaction, or None if there isn't one; see transaction.
+        self._journal = None
+        # Structures (like SameDistance's DisjointSet) that are recording
+        # their changes in our journal; see share_journal.
+        self._journal_sharers = []
+
+    @property
+    def default_clearance(self):
+        return self._default_clearance
+
+    @default_clearance.setter
+    def default_clearance(self, clearance):
+        self.set_attribute(self, '_default_clearance', clearance)
+        self.invalidate_attributes()
+
+    @property
+    def default_mask(self):
+        return self._default_mask
+
+    @default_mask.setter
+    def default_mask(self, mask):
+        self.set_attribute(self, '_default_mask', mask)
+        self.invalidate_attributes()
+
+    def invalidate_attributes(self):
+        self.attribute_generation += 1
+
+    # Transactions. Changes made through our methods while a transaction is
+    # open are journaled, so that if something fails part way through (a
+    # trial solve turns out to be overconstrained, say) everything can be
+    # put back in time proportional to what changed, without saving or
+    # copying anything up front.
+    #
+    # That's all they're for. Changes are made in place, so a transaction
+    # is not a snapshot that anything else could keep reading, and the
+    # editor's undo history is kept with to_dict/from_dict as before.
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Context manager: if the block raises, undo everything it changed
+        before passing the exception on.
+
+            with object_manager.transaction():
+                SomePrimitive.new(object_manager, ...)
+                object_manager.update_points()
+
+        Transactions can be nested; an inner one that fails only undoes its
+        own changes.
+
+        This covers points, scalars, the primitive lists, suppression, the
+        solution and the footprint's defaults. Changes to a primitive's own
+        attributes are only undone if they're made with set_attribute.
+        '''
+        outermost = self._journal is None
+        if outermost:
+            self._journal = []
+        mark = len(self._journal)
+        # The solution and its caches are replaced rather than changed, so
+        # this is all it takes to put them back.
+        saved = (self._cached_matrix, self._cached_derived, self._primary,
+                 self.degrees_of_freedom)
+        def put_back():
+            (self._cached_matrix, self._cached_derived, self._primary,
+             self.degrees_of_freedom) = saved
+        self._journal.append(put_back)
+        try:
+            yield
+        except:
+            self._rollback_to(mark)
+            if outermost:
+                self._end_transaction()
+            raise
+        if outermost:
+            self._end_transaction()
+
+    def set_attribute(self, obj, name, value):
+        '''
+        Set obj's attribute name to value, such that a failed transaction
+        sets it back.
+        '''
+        old_value = getattr(obj, name)
+        self.journal(lambda: setattr(obj, name, old_value))
+        setattr(obj, name, value)
+
+    def journal(self, func):
+        '''
+        If a transaction is open, arrange for func to be called (to undo
+        some change) if it fails.
+        '''
+        if self._journal is not None:
+            self._journal.append(func)
+
+    def share_journal(self, structure):
+        '''
+        If a transaction is open, have structure, which has begin(journal)
+        and commit() methods like DisjointSet, record how to undo its
+        changes in our journal until the transaction ends.
+        '''
+        if self._journal is not None \
+           and structure not in self._journal_sharers:
+            structure.begin(self._journal)
+            self._journal_sharers.append(structure)
+
+    def _rollback_to(self, mark):
+        journal = self._journal
+        # Undoing a change can mean making another, which mustn't be
+        # journaled in turn.
+        self._journal = None
+        try:
+            while len(journal) > mark:
+                journal.pop()()
+        finally:
+            self._journal = journal
+        # Whatever was worked out from what we've just undone is stale.
+        self._primitive_indices.clear()
+        self.invalidate_attributes()
+        self._solve_generation += 1
+
+    def _end_transaction(self):
+        for structure in self._journal_sharers:
+            structure.commit()
+        del self._journal_sharers[:]
+        self._journal = None
+
+    def enable_instrumentation(self, trace=None):
+        '''
+        Start collecting solver statistics in self.instrumentation. If trace
+        is given, it's called with a dictionary describing each solve.
+        '''
+        if self.instrumentation is None:
+            self.instrumentation = SolverStats()
+        if trace is not None:
+            self.instrumentation.trace_callbacks.append(trace)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        self.instrumentation = None
 
     def to_dict(self):
         # Note: a lot of stuff here could be made more efficient, but there's
@@ -61,7 +244,11 @@ class ObjectManager(object):
             default_clearance=self.default_clearance.to_dict(),
             next_point_idx=self._next_point_idx,
             all_points=list(self._all_points),
-            point_coords=deepcopy(self._point_coords),
+            # The coordinates are tuples, so this can't be changed under
+            # the copy.
+            point_coords=dict(self._point_coords),
+            next_scalar_idx=self._next_scalar_idx,
+            scalar_values=dict(self._scalar_values),
             primitives=primitive_dicts,
             draw_primitives=[self.primitive_idx(primitive)
                              for primitive in self.draw_primitives],
@@ -81,12 +268,21 @@ class ObjectManager(object):
             UnitNumber.from_dict(dictionary['default_mask']),
         )
         object_manager._all_points = set(dictionary['all_points'])
-        object_manager._point_lru = dictionary['all_points']
+        # A copy: the dictionary may be an undo snapshot, which mustn't
+        # change as we move points.
+        object_manager._point_lru = list(dictionary['all_points'])
         object_manager._next_point_idx = dictionary['next_point_idx']
         object_manager._point_coords = {
             int(point): tuple(pc)
             for point, pc in dictionary['point_coords'].iteritems()
         }
+        # Older files don't have scalars; their primitives allocate them as
+        # they're loaded.
+        object_manager._next_scalar_idx = dictionary.get('next_scalar_idx', 0)
+        object_manager._scalar_values = {
+            int(scalar): value
+            for scalar, value in dictionary.get('scalar_values', {}).iteritems()
+        }
 
         # Create the actual primitives. This requires a topological sort, which
         # can be done more efficiently than this but there's no good reason to.
@@ -106,6 +302,8 @@ class ObjectManager(object):
                     primitive_dict['primitive_dict']
                 )
                 object_manager.primitives[primitive_dict['index']] = primitive
+        for primitive_cls in object_manager.clsdata.keys():
+            primitive_cls.finish_loading(object_manager)
         object_manager.draw_primitives = [
             object_manager.primitives[idx]
             for idx in dictionary['draw_primitives']
@@ -124,12 +322,19 @@ class ObjectManager(object):
         return object_manager
 
     def primitive_idx(self, primitive):
-        for i, this_primitive in enumerate(self.primitives):
-            if primitive == this_primitive:
-                return i
-        return None
+        indices = self._primitive_indices
+        idx = indices.get(primitive)
+        if idx is None or idx >= len(self.primitives) \
+           or self.primitives[idx] is not primitive:
+            # Out of date, or primitive isn't one of ours.
+            indices.clear()
+            indices.update((this_primitive, i) for i, this_primitive
+                           in enumerate(self.primitives))
+            idx = indices.get(primitive)
+        return idx
 
     def update_parent_map(self):
+        self.invalidate_attributes()
         self.parent_map.clear()
         for primitive in self.primitives:
             for child in primitive.children():
@@ -160,25 +365,54 @@ class ObjectManager(object):
 
     def add_primitive(self, primitive, draw=True, constraining=True,
                       check_overconstraints=True):
+        '''
+        Add a primitive. If check_overconstraints is set, first check that
+        its constraints don't overconstrain anything, and raise
+        OverconstrainedException (without adding it) if they do. This
+        doesn't solve the new constraints; call update_points for that.
+        '''
+        if check_overconstraints and constraining:
+            conflict = self.find_conflict(primitive.constraints())
+            if conflict is not None:
+                solver_log.info("Adding %r would overconstrain %r",
+                                primitive, conflict)
+                raise OverconstrainedException(conflict)
+        self._solve_generation += 1
         self.primitives.append(primitive)
+        self.journal(lambda: self.primitives.pop())
         if draw:
             self.draw_primitives.append(primitive)
+            # The editor sorts draw_primitives as it draws, so this might
+            # not be at the end any more.
+            self.journal(lambda: self.draw_primitives.remove(primitive))
         if constraining:
             self.constraining_primitives.append(primitive)
-        if check_overconstraints:
-            try:
-                self.update_points()
-            except OverconstrainedException:
-                print "OVERCONSTRAINED"
-                self.primitives.pop()
-                if draw:
-                    self.draw_primitives.pop()
-                if constraining:
-                    self.constraining_primitives.pop()
-                raise
-        # Note: we don't need to recompute the entire primitive map here, but it
-        # shouldn't be a bottleneck.
-        self.update_parent_map()
+            self.journal(lambda: self.constraining_primitives.pop())
+        # Children are always added before their parents, so only the new
+        # primitive's entries in the parent map can change. Rebuilding the
+        # whole map each time made building big footprints quadratic.
+        self.invalidate_attributes()
+        for child in primitive.children():
+            self._set_parent(child, primitive)
+
+    def _set_parent(self, child, parent):
+        if self._journal is not None:
+            if child in self.parent_map:
+                old_parent = self.parent_map[child]
+                self._journal.append(
+                    lambda: self.parent_map.__setitem__(child, old_parent))
+            else:
+                self._journal.append(lambda: self.parent_map.pop(child))
+        self.parent_map[child] = parent
+
+    def _unset_parent(self, child):
+        parent = self.parent_map.pop(child)
+        self.journal(lambda: self.parent_map.__setitem__(child, parent))
+
+    def _list_remove(self, items, item):
+        idx = items.index(item)
+        del items[idx]
+        self.journal(lambda: items.insert(idx, item))
 
     def delete_primitive(self, obj):
         to_remove = set([obj])
@@ -202,8 +436,12 @@ class ObjectManager(object):
                 break
         if any(not x.can_delete() for x in to_remove):
             return
+        # Everything goes before any delete method runs: some of those
+        # delete other primitives in turn, which solves, and that mustn't
+        # see primitives whose points are already gone.
         for p in to_remove:
             self.remove_primitive(p)
+        for p in to_remove:
             p.delete()
 
         self.update_points()
@@ -213,12 +451,19 @@ class ObjectManager(object):
         Remove the primitive directly, without removing dependencies
         or calling the delete method.
         '''
-        self.primitives.remove(obj)
+        self._solve_generation += 1
+        self._list_remove(self.primitives, obj)
         # TODO: these should be sets.
         if obj in self.draw_primitives:
-            self.draw_primitives.remove(obj)
+            self._list_remove(self.draw_primitives, obj)
         if obj in self.constraining_primitives:
-            self.constraining_primitives.remove(obj)
+            self._list_remove(self.constraining_primitives, obj)
+        self.invalidate_attributes()
+        if obj in self.parent_map:
+            self._unset_parent(obj)
+        for child in obj.children():
+            if self.parent_map.get(child) is obj:
+                self._unset_parent(child)
 
     def alloc_point(self, x, y):
         old = self._next_point_idx
@@ -226,25 +471,75 @@ class ObjectManager(object):
         self._all_points.add(old)
         self._point_lru.append(old)
         self._cached_matrix = None
+        self._cached_derived = {}
+        self._solve_generation += 1
         self._point_coords[old] = (x, y)
+        if self._journal is not None:
+            def undo():
+                self._next_point_idx = old
+                self._all_points.remove(old)
+                self._point_lru.remove(old)
+                del self._point_coords[old]
+            self._journal.append(undo)
 
         return old
 
     def free_point(self, point_idx):
         self._all_points.remove(point_idx)
-        self._point_lru.remove(point_idx)
-        del self._point_coords[point_idx]
+        lru_idx = self._point_lru.index(point_idx)
+        del self._point_lru[lru_idx]
+        coords = self._point_coords.pop(point_idx)
         self._cached_matrix = None
+        self._cached_derived = {}
+        self._solve_generation += 1
+        if self._journal is not None:
+            def undo():
+                self._all_points.add(point_idx)
+                self._point_lru.insert(lru_idx, point_idx)
+                self._point_coords[point_idx] = coords
+            self._journal.append(undo)
+
+    def alloc_scalar(self, value):
+        old = self._next_scalar_idx
+        self._next_scalar_idx += 1
+        self._scalar_values[old] = value
+        self._cached_matrix = None
+        self._cached_derived = {}
+        self._solve_generation += 1
+        if self._journal is not None:
+            def undo():
+                self._next_scalar_idx = old
+                del self._scalar_values[old]
+            self._journal.append(undo)
+
+        return old
+
+    def free_scalar(self, scalar):
+        value = self._scalar_values.pop(scalar)
+        self._cached_matrix = None
+        self._cached_derived = {}
+        self._solve_generation += 1
+        self.journal(lambda: self._scalar_values.__setitem__(scalar, value))
+
+    def scalar_value(self, scalar):
+        return self._scalar_values[scalar]
 
     def _lru_update(self, p):
         for i in range(len(self._point_lru)):
             if self._point_lru[i] == p:
+                # The old list is left alone, so it's all it takes to undo
+                # this.
+                old_lru = self._point_lru
+                self.journal(lambda: setattr(self, '_point_lru', old_lru))
                 self._point_lru = ([p] + self._point_lru[0:i]
                                    + self._point_lru[i+1:])
                 break
 
     def set_point_coords(self, point, x, y):
         self._lru_update(point)
+        old_coords = self._point_coords[point]
+        self.journal(lambda: self._point_coords.__setitem__(point,
+                                                            old_coords))
         self._point_coords[point] = (x, y)
 
     def point_x(self, point):
@@ -261,147 +556,30 @@ class ObjectManager(object):
             self.suppressed_primitives.remove(primitive)
         else:
             self.suppressed_primitives.add(primitive)
+        self.journal(lambda: self.toggle_suppressed(primitive))
 
     def is_suppressed(self, primitive):
         return primitive in self.suppressed_primitives
 
-    @classmethod
-    def eliminate(cls, current, new, mins, inv, target_pt, target_val):
-        '''
-        Gaussian elimination.
-
-        current: list of maps from column indices to coefficients.
-        new: a constraint to be added.
-        mins: dictionary of index->row index.
-        inv: same as current; will end up with the inverse of the matrix.
-        '''
-        remaining = list(new)
-        new_inv = defaultdict(int)
-        new_inv[target_pt] = target_val
-        while remaining:
-            # TODO: this could be done a lot better.
-            x = remaining.pop()
-            if x in mins:
-                i = mins[x]
-                factor = new[x]
-                for y, v in current[i].iteritems():
-                    new[y] -= v * factor
-                    if new[y]:
-                        remaining.append(y)
-                for y, v in inv[i].iteritems():
-                    if y not in new_inv:
-                        new_inv[y] = 0
-                    new_inv[y] -= v * factor
-
-        for x in list(new):
-            if round(new[x], 4) == 0:
-                del new[x]
-
-        try:
-            j = min(new)
-            assert j not in mins, new
-        except ValueError:
-            # Row is all zeros.
-            return False
-
-        v = new[j]
-        for x in new:
-            new[x] /= float(v)
-        for x in new_inv:
-            new_inv[x] /= float(v)
-
-        for x in list(new_inv):
-            if new_inv[x] == 0:
-                del new_inv[x]
-
-        assert new[j] == 1
-
-        count = 0
-        for idx, row in enumerate(current):
-            if j in row:
-                count += 1
-                inv_row = inv[idx]
-                factor = row[j]
-                for y, v in new.iteritems():
-                    if y not in row:
-                        row[y] = 0
-                    row[y] -= v * factor
-                for y, v in new_inv.iteritems():
-                    inv_row[y] -= v * factor
-                assert row[j] == 0
-                for i in list(row):
-                    if round(row[i], 4) == 0:
-                        del row[i]
-                for i in list(inv_row):
-                    if inv_row[i] == 0:
-                        del inv_row[i]
-
-        mins[j] = len(current)
-        current.append(new)
-        inv.append(new_inv)
-
-        return True
-
-    def build_matrix(self, constraints, secondary_constraints, points,
-                     dragging_point):
-        def constrain_point(pt, current_dictmat, current_mins, inv):
-            row1dict = defaultdict(int)
-            row2dict = defaultdict(int)
-            row1dict[2 * pt] = 1
-            row2dict[2 * pt + 1] = 1
-
-            self.eliminate(current_dictmat, row1dict, current_mins, inv,
-                           2 * pt, 1)
-            self.eliminate(current_dictmat, row2dict, current_mins, inv,
-                           2 * pt + 1, 1)
-
-        def constraint_to_row(coeffs, target):
-            rowdict = defaultdict(int)
-            for (pt, coeffx, coeffy) in coeffs:
-                rowdict[2 * pt] += coeffx
-                rowdict[2 * pt + 1] += coeffy
-            return rowdict
-
-        n = len(self._all_points)
-        targets = []
-        inv = []
-
-        current_dictmat = []
-        current_mins = {}
-
-        for (coeffs, target) in constraints:
-            rowdict = constraint_to_row(coeffs, target)
-            result = self.eliminate(current_dictmat, rowdict, current_mins, inv,
-                                    None, target)
-            if not result:
-                return False
-        # We now have a matrix with all explicit constraints.
-        print "Degrees of freedom: %d" % (2 * n - len(current_dictmat))
-        self.degrees_of_freedom = (2 * n - len(current_dictmat))
-
-        if dragging_point is not None:
-            constrain_point(dragging_point, current_dictmat, current_mins, inv)
-
-        for (coeffs, target) in secondary_constraints:
-            rowdict = constraint_to_row(coeffs, target)
-            self.eliminate(current_dictmat, rowdict, current_mins, inv,
-                           None, target)
-
-        for pt in points + self._point_lru:
-            constrain_point(pt, current_dictmat, current_mins, inv)
-
-            if len(current_dictmat) == 2 * n:
-                break
-
-        new_inv = {}
-        for pt_idx, row_idx in current_mins.iteritems():
-            new_inv[pt_idx] = inv[row_idx]
-
-        return new_inv
+    def pads_as_arrays(self, unit="iu"):
+        '''
+        Return the centers, sizes, numbers and suppression flags of every
+        pad, pin and ball as a NumPy structured array, with lengths in unit.
+        See export.geometry_arrays.
+        '''
+        return geometry_arrays(self, unit)
 
     def _coord(self, pt_ind):
+        if pt_ind < 0:
+            return self._scalar_values[-1 - pt_ind]
         return self.point_coords(pt_ind/2)[pt_ind%2]
 
+    def _derived_val(self, pt_ind):
+        pt_row = self._cached_derived[pt_ind]
+        return float(sum(self._coord(target_ind) * target_coeff
+                         if target_ind is not None else target_coeff
+                         for target_ind, target_coeff in pt_row.iteritems()))
+
     def _pt_val(self, pt_ind):
         pt_row = self._cached_matrix[pt_ind]
         pt_val = sum(self._coord(target_ind) * float(target_coeff)
@@ -411,12 +589,180 @@ class ObjectManager(object):
         return float(pt_val)
 
     def update_all_point_coords(self):
-        for point in self._all_points:
-            self._point_coords[point] = (self._pt_val(point * 2),
-                                         self._pt_val(point * 2 + 1))
+        if self.instrumentation is not None:
+            # Reusing the solution map rather than solving again.
+            self.instrumentation.hit('matrix')
+        self._update_all_point_coords()
+
+    def _update_all_point_coords(self):
+        derived = self._cached_derived
+        self._move_to(
+            dict((point, (self._pt_val(point * 2),
+                          self._pt_val(point * 2 + 1)))
+                 for point in self._all_points
+                 if point * 2 not in derived),
+            dict((scalar, self._pt_val(scalar_column(scalar)))
+                 for scalar in self._scalar_values
+                 if scalar_column(scalar) not in derived))
+        if not derived:
+            return
+        # Derived columns only depend on columns that aren't derived, so
+        # they can all be computed now.
+        self._move_to(
+            dict((point, (self._derived_val(point * 2),
+                          self._derived_val(point * 2 + 1)))
+                 for point in self._all_points
+                 if point * 2 in derived),
+            dict((scalar, self._derived_val(scalar_column(scalar)))
+                 for scalar in self._scalar_values
+                 if scalar_column(scalar) in derived))
+
+    def _gather_constraints(self):
+        '''
+        Return the explicit constraints of all primitives, and the derived
+        columns (see Primitive.derived_points) after expand_derived.
+
+        If more than one primitive derives the same point or scalar, the
+        earliest one wins. Anything else that derives a primitive's points,
+        like a RigidGroup, is made after it, so this leaves the primitive's
+        own derivations alone.
+        '''
+        derived = {}
+        for p in self.constraining_primitives:
+            for point, (x_expression, y_expression
+                        ) in p.derived_points().iteritems():
+                if point * 2 not in derived:
+                    derived[point * 2] = expression_to_columns(x_expression)
+                    derived[point * 2 + 1] = expression_to_columns(
+                        y_expression)
+            for scalar, expression in p.derived_scalars().iteritems():
+                if scalar_column(scalar) not in derived:
+                    derived[scalar_column(scalar)] = expression_to_columns(
+                        expression)
+        if derived:
+            derived = expand_derived(derived)
 
-    def update_points(self, dragging_object=None):
         constraints = []
+        for p in self.constraining_primitives:
+            constraints.extend(p.constraints())
+        return constraints, derived
+
+    def _cached_primary(self, constraints, derived):
+        if (self._primary is not None
+            and self._primary[0] == constraints
+            and self._primary[1] == derived):
+            return self._primary[2]
+        return None
+
+    def _constraint_owners(self, indices):
+        '''
+        Return the primitives whose constraints are at the given indices in
+        the constraints from _gather_constraints.
+        '''
+        indices = set(indices)
+        owners = []
+        start = 0
+        for p in self.constraining_primitives:
+            end = start + len(p.constraints())
+            if any(start <= i < end for i in indices):
+                owners.append(p)
+            start = end
+        return owners
+
+    def constraint_indices(self, primitive):
+        '''
+        Return the indices of primitive's constraints in the constraints
+        from _gather_constraints (and so in a SolveRequest's constraints).
+        '''
+        start = 0
+        for p in self.constraining_primitives:
+            count = len(p.constraints())
+            if p is primitive:
+                return range(start, start + count)
+            start += count
+        return []
+
+    def _primary_elimination(self):
+        '''
+        Return the solver.Elimination of the current explicit constraints,
+        the derived columns it uses, and, if the constraints are
+        overconstrained (in which case the Elimination is None), the
+        indices of some that conflict.
+        '''
+        constraints, derived = self._gather_constraints()
+        elimination = self._cached_primary(constraints, derived)
+        conflict = None
+        if elimination is None:
+            elimination, conflict = factor_constraints([
+                constraint_to_row(coeffs, target, derived)
+                for coeffs, target in constraints])
+            if elimination is not None:
+                self._primary = (constraints, derived, elimination)
+        return elimination, derived, conflict
+
+    def find_conflict(self, constraints):
+        '''
+        Check whether the given constraints, in the format of
+        Primitive.constraints, could be added without overconstraining
+        anything. Only which unknowns the constraints involve matters, not
+        their targets. Nothing is changed.
+
+        Returns None if they could. Otherwise, returns a list of existing
+        primitives whose constraints conflict with them (which may be
+        empty, if they conflict with each other).
+
+        The constraints may only refer to derived points that already
+        exist.
+        '''
+        elimination, derived, conflict = self._primary_elimination()
+        if elimination is None:
+            return self._constraint_owners(conflict)
+        dependency = elimination.find_dependency([
+            constraint_to_row(coeffs, target, derived)[0]
+            for coeffs, target in constraints])
+        if dependency is None:
+            return None
+        existing, _ = dependency
+        return self._constraint_owners(existing)
+
+    def primary_factored(self):
+        '''
+        Whether the current explicit constraints have already been factored
+        (usually by a solve), so that find_conflict won't need to.
+        '''
+        constraints, derived = self._gather_constraints()
+        return self._cached_primary(constraints, derived) is not None
+
+    def constraints_independent(self, constraints):
+        '''
+        Whether the given constraints could be added without
+        overconstraining anything; see find_conflict.
+        '''
+        return self.find_conflict(constraints) is None
+
+    def conflicting_primitives(self, request):
+        '''
+        Given a request that turned out to be overconstrained, return the
+        primitives whose constraints conflict, or an empty list if things
+        have changed since the request was made.
+        '''
+        if (request.generation != self._solve_generation
+            or not request.conflicting_constraints):
+            return []
+        return self._constraint_owners(request.conflicting_constraints)
+
+    def solve_request(self, dragging_object=None):
+        '''
+        Gather everything the solver needs into a SolveRequest. The request
+        doesn't refer back to us, so it can be solved on another thread.
+        '''
+        if self.instrumentation is not None:
+            probe = SolveProbe()
+            probe.start('gather')
+        else:
+            probe = None
+
+        constraints, derived = self._gather_constraints()
         secondary_constraints = []
         if dragging_object:
             (drag_constraints,
@@ -427,18 +773,113 @@ class ObjectManager(object):
             for p in self.constraining_primitives:
                 secondary_constraints.extend(p.secondary_constraints())
 
-        for p in self.constraining_primitives:
-            constraints.extend(p.constraints())
-
         if isinstance(dragging_object, Point):
             dragging_point = dragging_object.point()
         else:
             dragging_point = None
 
-        m = self.build_matrix(constraints, secondary_constraints, points,
-                              dragging_point)
-        if not m:
-            raise OverconstrainedException
-        self._cached_matrix = m
-        self.update_all_point_coords()
+        request = SolveRequest(constraints, secondary_constraints,
+                               list(points), dragging_point,
+                               list(self._all_points), list(self._point_lru),
+                               self._solve_generation, derived,
+                               sorted(self._scalar_values))
+        request.primary = self._cached_primary(constraints, derived)
+        request.cache = self.solve_cache
+        if self.instrumentation is not None:
+            if request.primary is not None:
+                self.instrumentation.hit('factorization')
+            else:
+                self.instrumentation.miss('factorization')
+        if probe is not None:
+            probe.stop()
+            request.probe = probe
+        return request
+
+    def apply_solution(self, request, result):
+        '''
+        Apply the result of solving a request from solve_request. Returns
+        False (and does nothing) if points or primitives have changed since
+        the request was made.
+        '''
+        # The factorization is still good for anything with the same
+        # constraints, even if the solution is out of date.
+        self._primary = (request.constraints, request.derived, result.primary)
+        if request.generation != self._solve_generation:
+            return False
+        self.degrees_of_freedom = result.degrees_of_freedom
+        probe = request.probe
+        if probe is not None:
+            probe.start('update')
+        self.set_solution_map(result.matrix, request.derived)
+        if probe is not None:
+            probe.stop()
+            if self.instrumentation is not None:
+                if request.cache_hit:
+                    # The solver didn't run, so there's no solve to count.
+                    self.instrumentation.hit('solve_cache')
+                else:
+                    if request.cache is not None:
+                        self.instrumentation.miss('solve_cache')
+                    self.instrumentation.miss('matrix')
+                    self.instrumentation.add_probe(probe)
+        return True
+
+    def set_solution_map(self, matrix, derived):
+        '''
+        Move every point and scalar to where matrix, a solution map from
+        SolveResult, and derived, the derived columns it was solved with,
+        put them.
+        '''
+        self._cached_matrix = matrix
+        self._cached_derived = derived
+        self._update_all_point_coords()
+
+    def _move_to(self, point_coords, scalar_values):
+        '''
+        Move the points and scalars in point_coords and scalar_values, maps
+        to their new coordinates and values. In a transaction, only what
+        actually moves is journaled.
+        '''
+        if self._journal is not None:
+            old = []
+            for (values, new_values) in ((self._point_coords, point_coords),
+                                         (self._scalar_values,
+                                          scalar_values)):
+                for key, value in new_values.iteritems():
+                    old_value = values.get(key, _MISSING)
+                    if old_value != value:
+                        old.append((values, key, old_value))
+            if old:
+                def undo():
+                    for values, key, old_value in old:
+                        if old_value is _MISSING:
+                            values.pop(key, None)
+                        else:
+                            values[key] = old_value
+                self._journal.append(undo)
+        self._point_coords.update(point_coords)
+        self._scalar_values.update(scalar_values)
+
+    def save_solution(self):
+        '''
+        Return everything set_solution_map changes, for restore_solution.
+        '''
+        return (self._cached_matrix, self._cached_derived,
+                dict(self._point_coords), dict(self._scalar_values))
+
+    def restore_solution(self, saved):
+        (self._cached_matrix, self._cached_derived,
+         point_coords, scalar_values) = saved
+        self._move_to(point_coords, scalar_values)
+
+    def update_points(self, dragging_object=None):
+        request = self.solve_request(dragging_object)
+        result = cached_solve(request)
+        if not result:
+            raise OverconstrainedException(
+                self.conflicting_primitives(request))
+        # Anything requested before now is out of date.
+        self._solve_generation += 1
+        request.generation = self._solve_generation
+        self.apply_solution(request, result)
         return True
@@ -2,15 +2,18 @@ import pygtk
 pygtk.require('2.0')
 import gtk
 import math
+from collections import defaultdict
 
 from constraint_utils import (
-    constrain_ball,
     constrain_horiz,
     constrain_vert,
+    derive_ball,
     equal_space_horiz,
     equal_space_vert,
 )
+from disjoint_set import DisjointSet
 from exceptiontypes import OverconstrainedException
+from logging_utils import ui_log
 from math_utils import (
     line_dist,
     point_dist,
@@ -21,6 +24,7 @@ from numbering import (
     NUMBER_CONST_WIDTH,
 )
 from ui_utils import (
+    BoolEntry,
     NumberEntry,
     StringEntry,
     UnitNumberEntry,
@@ -29,6 +33,7 @@ from ui_utils import (
     horiz_arrow,
     reconfigure,
     set_dampened_color,
+    text_extents,
     vert_arrow,
 )
 from units import UnitNumber
@@ -39,6 +44,10 @@ class Primitive(object):
         self._mask = mask
         self._object_manager = object_manager
         self._number = number
+        # Cached results of number(), clearance() and mask(), valid as long
+        # as the object manager's attribute generation is _resolved_generation.
+        self._resolved = {}
+        self._resolved_generation = None
 
     @classmethod
     def new(cls, object_manager, x, y, configuration,
@@ -55,6 +64,15 @@ class Primitive(object):
     def from_dict(cls, object_manager, dictionary):
         raise NotImplementedError()
 
+    @classmethod
+    def finish_loading(cls, object_manager):
+        '''
+        Called once ObjectManager.from_dict has made every primitive, for
+        each class with an entry in object_manager.clsdata, to drop whatever
+        it only kept for loading.
+        '''
+        pass
+
     def dependencies(self):
         '''
         All primitives we depend on. They might be able to exist independently
@@ -78,12 +96,41 @@ class Primitive(object):
         Note that the points here are actually indices of points in the
         ObjectManager, not Point objects. (So point1.x really means
         "the x coordinate of the point with index point1".)
+
+        A term can also be a pair (scalar, weight), where scalar is the
+        index of a scalar in the ObjectManager (see scalars()).
         '''
         return []
 
     def secondary_constraints(self):
         return []
 
+    def scalars(self):
+        '''
+        Indices of the scalars we own, such as radii or widths. These are
+        unknowns for the solver, just like point coordinates.
+        '''
+        return []
+
+    def derived_points(self):
+        '''
+        Return a map from indices of points whose positions follow entirely
+        from other unknowns to (x_expression, y_expression). Each expression
+        is a pair (terms, constant), with terms in the same format as in
+        constraints(); it represents
+            coordinate = terms + constant
+        Derived points aren't unknowns for the solver, so constraints that
+        already follow from their expressions shouldn't be returned by
+        constraints().
+        '''
+        return {}
+
+    def derived_scalars(self):
+        '''
+        Like derived_points, but a map from scalar indices to expressions.
+        '''
+        return {}
+
     def drag_constraints(self, child):
         parent = self.parent()
         if parent:
@@ -142,10 +189,43 @@ class Primitive(object):
     def can_create(cls, objects):
         return False
 
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        '''
+        Return the constraints, in the format of constraints(), that
+        creating this primitive from the given objects would add, or None if
+        that can't be known without creating it. Only which unknowns they
+        involve matters; the targets can be anything.
+        '''
+        return None
+
     def parent(self):
         return self._object_manager.parent_map.get(self)
 
+    def _resolve(self, name, compute):
+        '''
+        Return the cached value of the named attribute, computing it if it
+        isn't cached or anything it could depend on has changed since.
+        '''
+        generation = self._object_manager.attribute_generation
+        if self._resolved_generation != generation:
+            self._resolved = {}
+            self._resolved_generation = generation
+        if name not in self._resolved:
+            self._resolved[name] = compute()
+        return self._resolved[name]
+
+    def invalidate_attributes(self):
+        '''
+        Called when this primitive has been reconfigured; anything inherited
+        from it needs to be looked up again.
+        '''
+        self._object_manager.invalidate_attributes()
+
     def number(self):
+        return self._resolve('number', self._compute_number)
+
+    def _compute_number(self):
         if self._number is not None:
             # We're assigned a number directly, so return it.
             return self._number
@@ -159,6 +239,9 @@ class Primitive(object):
         return None
 
     def clearance(self):
+        return self._resolve('clearance', self._compute_clearance)
+
+    def _compute_clearance(self):
         if self._clearance is not None:
             return self._clearance
         else:
@@ -169,6 +252,9 @@ class Primitive(object):
                 return self._object_manager.default_clearance
 
     def mask(self):
+        return self._resolve('mask', self._compute_mask)
+
+    def _compute_mask(self):
         if self._mask is not None:
             return self._mask
         else:
@@ -178,6 +264,15 @@ class Primitive(object):
             else:
                 return self._object_manager.default_mask
 
+    def set_attributes(self, number=None, clearance=None, mask=None):
+        '''
+        Set our own number, clearance and mask. None means to inherit it.
+        '''
+        self._number = number
+        self._clearance = clearance
+        self._mask = mask
+        self.invalidate_attributes()
+
     def reconfiguration_widget(self):
         return None
 
@@ -324,10 +419,14 @@ class TileablePrimitive(Primitive):
 class Pad(TileablePrimitive):
     NAME = "Pad"
 
-    def __init__(self, object_manager, points, number=None,
+    def __init__(self, object_manager, points, width, height, number=None,
                  clearance=None, mask=None):
         super(Pad, self).__init__(object_manager, number, clearance, mask)
         self.points = points
+        # Everything but the center point is derived from the center and
+        # these width and height scalars.
+        self._width = width
+        self._height = height
 
     @classmethod
     def new(cls, object_manager, x, y, configuration,
@@ -343,7 +442,8 @@ class Pad(TileablePrimitive):
                               x + (i - 1) * w/2,
                               y + (j - 1) * h/2)
                 )
-        self = cls(object_manager, points)
+        self = cls(object_manager, points, object_manager.alloc_scalar(w),
+                   object_manager.alloc_scalar(h))
         object_manager.add_primitive(
             self,
             constraining=constraining,
@@ -427,41 +527,35 @@ class Pad(TileablePrimitive):
         else:
             return None
 
-    def constraints(self):
-        # Points in a row should be aligned horizontally; points in a column
-        # vertically.
-        constraints = []
-        for j in xrange(3):
-            constraints.extend(
-                constrain_horiz([self.point(i, j) for i in xrange(3)])
-            )
+    def scalars(self):
+        return [self._width, self._height]
+
+    def derived_points(self):
+        # The points are evenly spaced in a grid around the center.
+        center = self.p(1, 1)
+        derived = {}
         for i in xrange(3):
-            constraints.extend(
-                constrain_vert([self.point(i, j) for j in xrange(3)])
-            )
+            for j in xrange(3):
+                if i == j == 1:
+                    continue
+                derived[self.p(i, j)] = (
+                    ([(center, 1, 0), (self._width, (i - 1) / 2.)], 0),
+                    ([(center, 0, 1), (self._height, (j - 1) / 2.)], 0),
+                )
+        return derived
 
-        # Spacing should be equal, in the horizontal and vertical directions.
-        # (Note that this only needs to be applied to the first row/column;
-        # the horizontal/vertical constraints take care of the rest.)
-        constraints.extend(
-            equal_space_horiz([self.point(0, 0),
-                               self.point(1, 0),
-                               self.point(2, 0)])
-        )
-        constraints.extend(
-            equal_space_vert([self.point(0, 0),
-                              self.point(0, 1),
-                              self.point(0, 2)])
-        )
+    def _width_constraint(self):
+        return ([(self._width, 1)],
+                self._object_manager.scalar_value(self._width))
 
-        return constraints
+    def _height_constraint(self):
+        return ([(self._height, 1)],
+                self._object_manager.scalar_value(self._height))
 
     def secondary_constraints(self):
         return [
-            ([(self.p(0, 2),  0,  1),
-              (self.p(0, 0),  0, -1)], self.h),
-            ([(self.p(2, 0),  1,  0),
-              (self.p(0, 0), -1,  0)], self.w),
+            self._height_constraint(),
+            self._width_constraint(),
         ]
 
     def drag_constraints(self, child):
@@ -474,15 +568,9 @@ class Pad(TileablePrimitive):
                     if i == 1 or j == 1:
                         constraints = []
                         if i == 1:
-                            constraints.append(
-                                ([(self.p(2, 0),  1,  0),
-                                  (self.p(0, 0), -1,  0)], self.w)
-                            )
+                            constraints.append(self._width_constraint())
                         if j == 1:
-                            constraints.append(
-                                ([(self.p(0, 2),  0,  1),
-                                  (self.p(0, 0),  0, -1)], self.h)
-                            )
+                            constraints.append(self._height_constraint())
                         return (constraints, [self.p(2-i, 2-j)])
                     else:
                         return ([], [self.p(2-i, 2-j)])
@@ -501,12 +589,13 @@ class Pad(TileablePrimitive):
         cr.fill()
         cr.restore()
         cr.save()
-        if self.number() is not None:
-            extents = cr.text_extents(self.number())
+        number = self.number()
+        if number is not None:
+            extents = text_extents(cr, number)
             w, h = extents[2:4]
             cr.move_to(self.x0 + self.w/2 - w / 2, self.y0 + self.h/2  + h / 2)
             set_dampened_color(cr, 0, 0, 0, color_mult)
-            cr.show_text(self.number())
+            cr.show_text(number)
             cr.stroke()
         cr.restore()
 
@@ -518,34 +607,47 @@ class Pad(TileablePrimitive):
     def dimensions_to_constrain(self, multiplier=1):
         # When in an array, we want the height and width of all pads to
         # be equal.
-        return [[(self.p(0, 0), multiplier, 0),
-                 (self.p(2, 0), -multiplier, 0)],
-                [(self.p(0, 0), 0, multiplier),
-                 (self.p(0, 2), 0, -multiplier)]]
+        return [[(self._width, multiplier)],
+                [(self._height, multiplier)]]
 
     def center_point(self):
         return self.points[4]
 
+    def delete(self):
+        self._object_manager.free_scalar(self._width)
+        self._object_manager.free_scalar(self._height)
+
     def to_dict(self):
         point_indices = [
             self._object_manager.primitive_idx(point)
             for point in self.points]
         return dict(
             points=point_indices,
+            width=self._width,
+            height=self._height,
             deps=point_indices,
             number=self._number,
             clearance=self._clearance.to_dict() if self._clearance else None,
-            mask=self._mask.to_dict() if self._clearance else None,
+            mask=self._mask.to_dict() if self._mask else None,
         )
 
     @classmethod
     def from_dict(cls, object_manager, dictionary):
         clearance = dictionary['clearance']
         mask = dictionary['mask']
+        points = [object_manager.primitives[idx]
+                  for idx in dictionary['points']]
+        width = dictionary.get('width')
+        height = dictionary.get('height')
+        if width is None:
+            # Older files only have the points.
+            width = object_manager.alloc_scalar(points[2].x - points[0].x)
+            height = object_manager.alloc_scalar(points[6].y - points[0].y)
         return cls(
             object_manager,
-            [object_manager.primitives[idx]
-             for idx in dictionary['points']],
+            points,
+            width,
+            height,
             dictionary['number'],
             UnitNumber.from_dict(clearance) if clearance else None,
             UnitNumber.from_dict(mask) if mask else None
@@ -555,11 +657,16 @@ class Pin(TileablePrimitive):
     NAME = "Pin"
 
     def __init__(self, object_manager, hole_points, ring_points,
-                 center_point, number=None, clearance=None, mask=None):
+                 center_point, hole_radius, ring_radius, number=None,
+                 clearance=None, mask=None):
         super(Pin, self).__init__(object_manager, number, clearance, mask)
         self._hole_points = hole_points
         self._ring_points = ring_points
         self._center_point = center_point
+        # The hole and ring points are derived from the center point and
+        # these radius scalars.
+        self._hole_radius = hole_radius
+        self._ring_radius = ring_radius
 
     @classmethod
     def new(cls, object_manager, x, y, configuration, hr=20, rr=40,
@@ -579,7 +686,9 @@ class Pin(TileablePrimitive):
             Point.new(object_manager, x + rr/2, y),
             Point.new(object_manager, x, y + rr/2),
         ]
-        self = cls(object_manager, hole_points, ring_points, center_point)
+        self = cls(object_manager, hole_points, ring_points, center_point,
+                   object_manager.alloc_scalar(hr/2),
+                   object_manager.alloc_scalar(rr/2))
         object_manager.add_primitive(
             self,
             constraining=constraining,
@@ -628,11 +737,11 @@ class Pin(TileablePrimitive):
 
     @property
     def hole_r(self):
-        return self._hole_points[2].x - self._center_point.x
+        return self._object_manager.scalar_value(self._hole_radius)
 
     @property
     def ring_r(self):
-        return self._ring_points[2].x - self._center_point.x
+        return self._object_manager.scalar_value(self._ring_radius)
 
     def children(self):
         return self._hole_points + self._ring_points + [self._center_point]
@@ -654,10 +763,10 @@ class Pin(TileablePrimitive):
         else:
             return None
 
-    def constraints(self):
-        constraints = []
-        # Points in a row should be aligned horizontally; points in a column
-        # vertically.
+    def scalars(self):
+        return [self._hole_radius, self._ring_radius]
+
+    def derived_points(self):
         ring_points = (self._ring_points[:2]
                        + [self._center_point]
                        + self._ring_points[2:])
@@ -665,14 +774,15 @@ class Pin(TileablePrimitive):
                        + [self._center_point]
                        + self._hole_points[2:])
 
-        return constrain_ball(ring_points) + constrain_ball(hole_points)
+        derived = derive_ball(ring_points, self._ring_radius)
+        derived.update(derive_ball(hole_points, self._hole_radius))
+        return derived
 
     def secondary_constraints(self):
         return [
-            ([(self.rp(2),  1, 0),
-              (self.hp(2), -1, 0)], self.ring_r - self.hole_r),
-            ([(self.hp(2),  1, 0),
-              (self._center_point.point(), -1, 0)], self.hole_r),
+            ([(self._ring_radius,  1),
+              (self._hole_radius, -1)], self.ring_r - self.hole_r),
+            ([(self._hole_radius,  1)], self.hole_r),
         ]
 
     def drag_constraints(self, child):
@@ -701,12 +811,13 @@ class Pin(TileablePrimitive):
         cr.arc(self.x, self.y, self.hole_r, 0, 2 * math.pi)
         cr.fill()
         cr.restore()
-        if self.number() is not None:
-            extents = cr.text_extents(self.number())
+        number = self.number()
+        if number is not None:
+            extents = text_extents(cr, number)
             w, h = extents[2:4]
             cr.move_to(self.x - w / 2, self.y + h / 2)
             set_dampened_color(cr, 0, 0, 0, color_mult)
-            cr.show_text(self.number())
+            cr.show_text(number)
             cr.stroke()
 
     def drag(self, offs_x, offs_y):
@@ -718,15 +829,17 @@ class Pin(TileablePrimitive):
         # When in an array, we want the height and width of all pads
         # to be equal.
         return [
-            [(self.rp(2), multiplier, 0),
-             (self._center_point.point(), -multiplier, 0)],
-            [(self.hp(2), multiplier, 0),
-             (self._center_point.point(), -multiplier, 0)],
+            [(self._ring_radius, multiplier)],
+            [(self._hole_radius, multiplier)],
         ]
 
     def center_point(self):
         return self._center_point
 
+    def delete(self):
+        self._object_manager.free_scalar(self._hole_radius)
+        self._object_manager.free_scalar(self._ring_radius)
+
     def to_dict(self):
         hole_point_indices = [
             self._object_manager.primitive_idx(point)
@@ -741,6 +854,8 @@ class Pin(TileablePrimitive):
             hole_points=hole_point_indices,
             ring_points=ring_point_indices,
             center_point=center_point_index,
+            hole_radius=self._hole_radius,
+            ring_radius=self._ring_radius,
             deps=hole_point_indices + ring_point_indices + [center_point_index],
             number=self._number,
             clearance=self._clearance.to_dict() if self._clearance else None,
@@ -751,13 +866,26 @@ class Pin(TileablePrimitive):
     def from_dict(cls, object_manager, dictionary):
         clearance = dictionary['clearance']
         mask = dictionary['mask']
+        hole_points = [object_manager.primitives[idx]
+                       for idx in dictionary['hole_points']]
+        ring_points = [object_manager.primitives[idx]
+                       for idx in dictionary['ring_points']]
+        center_point = object_manager.primitives[dictionary['center_point']]
+        hole_radius = dictionary.get('hole_radius')
+        ring_radius = dictionary.get('ring_radius')
+        if hole_radius is None:
+            # Older files only have the points.
+            hole_radius = object_manager.alloc_scalar(
+                hole_points[2].x - center_point.x)
+            ring_radius = object_manager.alloc_scalar(
+                ring_points[2].x - center_point.x)
         return cls(
             object_manager,
-            [object_manager.primitives[idx]
-             for idx in dictionary['hole_points']],
-            [object_manager.primitives[idx]
-             for idx in dictionary['ring_points']],
-            object_manager.primitives[dictionary['center_point']],
+            hole_points,
+            ring_points,
+            center_point,
+            hole_radius,
+            ring_radius,
             dictionary['number'],
             UnitNumber.from_dict(clearance) if clearance else None,
             UnitNumber.from_dict(mask) if mask else None,
@@ -766,10 +894,13 @@ class Pin(TileablePrimitive):
 class Ball(TileablePrimitive):
     NAME = "Ball"
 
-    def __init__(self, object_manager, points, number=None,
+    def __init__(self, object_manager, points, radius, number=None,
                  clearance=None, mask=None, constraining=True):
         super(Ball, self).__init__(object_manager, number, clearance, mask)
         self.points = points
+        # Everything but the center point is derived from the center and
+        # this radius scalar.
+        self._radius = radius
 
     @classmethod
     def new(cls, object_manager, x, y, configuration, r=20,
@@ -783,7 +914,8 @@ class Ball(TileablePrimitive):
             Point.new(object_manager, x + r/2, y),
             Point.new(object_manager, x, y + r/2),
         ]
-        self = cls(object_manager, points)
+        radius = object_manager.alloc_scalar(r/2)
+        self = cls(object_manager, points, radius)
         object_manager.add_primitive(
             self,
             constraining=constraining,
@@ -832,7 +964,7 @@ class Ball(TileablePrimitive):
 
     @property
     def r(self):
-        return self.points[3].x - self.points[2].x
+        return self._object_manager.scalar_value(self._radius)
 
     def children(self):
         return self.points
@@ -851,13 +983,15 @@ class Ball(TileablePrimitive):
         else:
             return None
 
-    def constraints(self):
-        return constrain_ball(self.points)
+    def scalars(self):
+        return [self._radius]
+
+    def derived_points(self):
+        return derive_ball(self.points, self._radius)
 
     def secondary_constraints(self):
         return [
-            ([(self.p(2),  0,  1),
-              (self.p(0),  0, -1)], self.r),
+            ([(self._radius, 1)], self.r),
         ]
 
     def drag_constraints(self, child):
@@ -878,12 +1012,13 @@ class Ball(TileablePrimitive):
         cr.arc(self.x, self.y, self.r, 0, 2 * math.pi)
         cr.fill()
         cr.restore()
-        if self.number() is not None:
-            extents = cr.text_extents(self.number())
+        number = self.number()
+        if number is not None:
+            extents = text_extents(cr, number)
             w, h = extents[2:4]
             cr.move_to(self.x - w / 2, self.y + h / 2)
             set_dampened_color(cr, 0, 0, 0, color_mult)
-            cr.show_text(self.number())
+            cr.show_text(number)
             cr.stroke()
 
     def drag(self, offs_x, offs_y):
@@ -894,18 +1029,21 @@ class Ball(TileablePrimitive):
     def dimensions_to_constrain(self, multiplier=1):
         # When in an array, we want the height and width of all pads
         # to be equal.
-        return [[(self.p(3), multiplier, 0),
-                 (self.p(2), -multiplier, 0)]]
+        return [[(self._radius, multiplier)]]
 
     def center_point(self):
         return self.points[2]
 
+    def delete(self):
+        self._object_manager.free_scalar(self._radius)
+
     def to_dict(self):
         point_indices = [
             self._object_manager.primitive_idx(point)
             for point in self.points]
         return dict(
             points=point_indices,
+            radius=self._radius,
             deps=point_indices,
             number=self._number,
             clearance=self._clearance.to_dict() if self._clearance else None,
@@ -916,10 +1054,16 @@ class Ball(TileablePrimitive):
     def from_dict(cls, object_manager, dictionary):
         clearance = dictionary['clearance']
         mask = dictionary['mask']
+        points = [object_manager.primitives[idx]
+                  for idx in dictionary['points']]
+        radius = dictionary.get('radius')
+        if radius is None:
+            # Older files only have the points.
+            radius = object_manager.alloc_scalar(points[3].x - points[2].x)
         return cls(
             object_manager,
-            [object_manager.primitives[idx]
-             for idx in dictionary['points']],
+            points,
+            radius,
             dictionary['number'],
             UnitNumber.from_dict(clearance) if clearance else None,
             UnitNumber.from_dict(mask) if mask else None,
@@ -940,12 +1084,15 @@ class TwoPointConstraint(Primitive):
         self.p2 = p2
 
     @classmethod
-    def new(cls, object_manager, x, y, configuration):
+    def new(cls, object_manager, x, y, configuration,
+            check_overconstraints=True):
         objects = configuration['objects']
+        self = cls(object_manager, objects)
         object_manager.add_primitive(
-            cls(object_manager, objects),
-            check_overconstraints=True
+            self,
+            check_overconstraints=check_overconstraints
         )
+        return self
 
     @classmethod
     def configure(cls, objects):
@@ -985,6 +1132,10 @@ class Horizontal(TwoPointConstraint):
     def __init__(self, object_manager, objects):
         super(Horizontal, self).__init__(object_manager, objects)
 
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        return constrain_horiz(list(objects))
+
     def constraints(self):
         return constrain_horiz([self.p1, self.p2])
 
@@ -1026,6 +1177,10 @@ class Vertical(TwoPointConstraint):
     def __init__(self, object_manager, objects):
         super(Vertical, self).__init__(object_manager, objects)
 
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        return constrain_vert(list(objects))
+
     def constraints(self):
         return constrain_vert([self.p1, self.p2])
 
@@ -1064,18 +1219,24 @@ class DistanceConstraint(TwoPointConstraint):
         self.distance = dist
 
         self.label_distance = label_dist
+        # Cached result of label_layout, and what it was computed from.
+        self._layout_key = None
+        self._layout = None
 
     @classmethod
-    def new(cls, object_manager, x, y, configuration):
+    def new(cls, object_manager, x, y, configuration,
+            check_overconstraints=True):
         p1 = configuration['p1']
         p2 = configuration['p2']
         dist = configuration['dist']
         if cls.horiz and (p1.x > p2.x) or not cls.horiz and (p1.y > p2.y):
             p1, p2 = p2, p1
+        self = cls(object_manager, p1, p2, dist, 10)
         object_manager.add_primitive(
-            cls(object_manager, p1, p2, dist, 10),
-            check_overconstraints=True
+            self,
+            check_overconstraints=check_overconstraints
         )
+        return self
 
     @classmethod
     def configure(cls, objects):
@@ -1125,18 +1286,109 @@ class DistanceConstraint(TwoPointConstraint):
 
     def reconfigure(self, widget, other_widgets):
         (self.distance, ) = reconfigure(other_widgets)
+        self.invalidate_layout()
 
-    def constraints(self):
-        if self.horiz:
+    @classmethod
+    def _distance_constraints(cls, p1, p2, distance):
+        if cls.horiz:
             return [
-                ([(self.p2.point(), 1, 0), (self.p1.point(), -1, 0)],
-                 self.distance.to("iu"))
+                ([(p2.point(), 1, 0), (p1.point(), -1, 0)], distance)
             ]
         else:
             return [
-                ([(self.p2.point(), 0, 1), (self.p1.point(), 0, -1)],
-                 self.distance.to("iu"))
+                ([(p2.point(), 0, 1), (p1.point(), 0, -1)], distance)
+            ]
+
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        p1, p2 = objects
+        return cls._distance_constraints(p1, p2, 0)
+
+    def constraints(self):
+        return self._distance_constraints(self.p1, self.p2,
+                                          self.distance.to("iu"))
+
+    def label_layout(self, w, h):
+        '''
+        Work out where the extension lines, arrows and label go, given the
+        size of the label. Returns a tuple (lines, arrows, text_position),
+        where lines is a list of ((x1, y1), (x2, y2)) pairs and arrows is a
+        list of (arrow_function, args) pairs. For vertical constraints, the
+        text position is in the rotated coordinate system the label is
+        drawn in.
+
+        This only depends on our endpoints, label distance and label size,
+        so it's cached between frames.
+        '''
+        p1x, p1y = self.p1.x, self.p1.y
+        p2x, p2y = self.p2.x, self.p2.y
+        key = (p1x, p1y, p2x, p2y, self.label_distance, w, h)
+        if key == self._layout_key:
+            return self._layout
+
+        text_padding = 2
+        if self.horiz:
+            fits = (w < p2x - p1x - text_padding*2)
+        else:
+            fits = (w < p2y - p1y - text_padding*2)
+        arrow_dist = self.label_distance
+        if self.label_distance >= 0:
+            line_dist = self.label_distance + h/2
+            if fits:
+                text_dist = self.label_distance + h/2
+            else:
+                text_dist = self.label_distance + 3*h/2
+        else:
+            line_dist = self.label_distance - h/2
+            if fits:
+                text_dist = self.label_distance + h/2
+            else:
+                text_dist = self.label_distance - h/2
+
+        if self.horiz:
+            mid = (p1x + p2x) / 2
+            lines = [
+                ((p1x, p1y), (p1x, p1y + line_dist)),
+                # Note: the p1 here is not a bug.
+                ((p2x, p2y), (p2x, p1y + line_dist)),
+            ]
+            arrows = [
+                (horiz_arrow, (p1x,
+                               mid - w/2 - text_padding,
+                               p1y + arrow_dist,
+                               True, False, 2)),
+                (horiz_arrow, (mid + w/2 + text_padding,
+                               p2x,
+                               p1y + arrow_dist,
+                               False, True, 2)),
+            ]
+            text_position = (mid - w/2, p1y + text_dist)
+        else:
+            mid = (p1y + p2y) / 2
+            lines = [
+                ((p1x, p1y), (p1x + line_dist, p1y)),
+                # Note: the p1 here is not a bug.
+                ((p2x, p2y), (p1x + line_dist, p2y)),
+            ]
+            arrows = [
+                (vert_arrow, (p1x + arrow_dist,
+                              p1y,
+                              mid - w/2 - text_padding,
+                              True, False, 2)),
+                (vert_arrow, (p1x + arrow_dist,
+                              mid + w/2 + text_padding,
+                              p2y,
+                              False, True, 2)),
             ]
+            text_position = (mid - w/2, -(p1x + text_dist - h))
+
+        self._layout_key = key
+        self._layout = (lines, arrows, text_position)
+        return self._layout
+
+    def invalidate_layout(self):
+        self._layout_key = None
+        self._layout = None
 
     def draw(self, cr, active, selected):
         if selected:
@@ -1148,89 +1400,28 @@ class DistanceConstraint(TwoPointConstraint):
         cr.set_line_width(0.3)
 
         label = str(self.distance)
-        extents = cr.text_extents(label)
+        extents = text_extents(cr, label)
         w, h = extents[2:4]
-        text_padding = 2
+        lines, arrows, text_position = self.label_layout(w, h)
 
-        if self.horiz:
-            fits = (w < self.p2.x - self.p1.x - text_padding*2)
-            if self.label_distance >= 0:
-                line_dist = self.label_distance + h/2
-                arrow_dist = self.label_distance
-                if fits:
-                    text_dist = self.label_distance + h/2
-                else:
-                    text_dist = self.label_distance + 3*h/2
-            else:
-                line_dist = self.label_distance - h/2
-                arrow_dist = self.label_distance
-                if fits:
-                    text_dist = self.label_distance + h/2
-                else:
-                    text_dist = self.label_distance - h/2
-            cr.move_to(self.p1.x, self.p1.y)
-            cr.line_to(self.p1.x, self.p1.y + line_dist)
+        for (x1, y1), (x2, y2) in lines:
+            cr.move_to(x1, y1)
+            cr.line_to(x2, y2)
             cr.stroke()
-            cr.move_to(self.p2.x, self.p2.y)
-            # Note: the p1 here is not a bug.
-            cr.line_to(self.p2.x, self.p1.y + line_dist)
-            cr.stroke()
-            horiz_arrow(cr, self.p1.x,
-                        (self.p1.x + self.p2.x) / 2 - w/2 - text_padding,
-                        self.p1.y + arrow_dist,
-                        True, False, 2)
-            horiz_arrow(cr, (self.p1.x + self.p2.x) / 2 + w/2 + text_padding,
-                        self.p2.x,
-                        self.p1.y + arrow_dist,
-                        False, True, 2)
-            cr.move_to((self.p1.x + self.p2.x) / 2 - w/2,
-                       self.p1.y + text_dist)
+        for arrow, args in arrows:
+            arrow(cr, *args)
+        if self.horiz:
+            cr.move_to(*text_position)
             cr.show_text(label)
             cr.stroke()
         else:
-            fits = (w < self.p2.y - self.p1.y - text_padding*2)
-            if self.label_distance >= 0:
-                line_dist = self.label_distance + h/2
-                arrow_dist = self.label_distance
-                if fits:
-                    text_dist = self.label_distance + h/2
-                else:
-                    text_dist = self.label_distance + 3*h/2
-            else:
-                line_dist = self.label_distance - h/2
-                arrow_dist = self.label_distance
-                if fits:
-                    text_dist = self.label_distance + h/2
-                else:
-                    text_dist = self.label_distance - h/2
-            cr.move_to(self.p1.x, self.p1.y)
-            cr.line_to(self.p1.x + line_dist, self.p1.y)
-            cr.stroke()
-            cr.move_to(self.p2.x, self.p2.y)
-            # Note: the p1 here is not a bug.
-            cr.line_to(self.p1.x + line_dist, self.p2.y)
-            cr.stroke()
-            vert_arrow(cr,
-                       self.p1.x + arrow_dist,
-                       self.p1.y,
-                       (self.p1.y + self.p2.y) / 2 - w/2 - text_padding,
-                       True, False, 2)
-            vert_arrow(cr,
-                       self.p1.x + arrow_dist,
-                       (self.p1.y + self.p2.y) / 2 + w/2 + text_padding,
-                       self.p2.y,
-                       False, True, 2)
-            cr.move_to(self.p1.x + text_dist,
-                       (self.p1.y + self.p2.y) / 2)
             cr.save()
             cr.rotate(math.pi/2)
-            cr.move_to((self.p1.y + self.p2.y) / 2 - w/2,
-                       -(self.p1.x + text_dist - h))
+            cr.move_to(*text_position)
             cr.show_text(label)
             cr.restore()
             cr.stroke()
 
-
     def dist(self, p):
         if self.horiz:
             return line_dist(
@@ -1257,10 +1448,9 @@ class DistanceConstraint(TwoPointConstraint):
         #     )
 
     def drag(self, offs_x, offs_y):
-        if self.horiz:
-            self.label_distance += offs_y
-        else:
-            self.label_distance += offs_x
+        self._object_manager.set_attribute(
+            self, 'label_distance',
+            self.label_distance + (offs_y if self.horiz else offs_x))
         return False
 
     def to_dict(self):
@@ -1300,20 +1490,27 @@ class MeasuredDistance(TwoPointConstraint):
         self.label_distance = label_dist
 
     @classmethod
-    def new(cls, object_manager, x, y, configuration):
+    def new(cls, object_manager, x, y, configuration,
+            check_overconstraints=True):
         objects = list(configuration['objects'])
         p1 = objects[0]
         p2 = objects[1]
         if cls.horiz and (p1.x > p2.x) or not cls.horiz and (p1.y > p2.y):
             p1, p2 = p2, p1
+        self = cls(object_manager, p1, p2, 100)
         object_manager.add_primitive(
-            cls(object_manager, p1, p2, 100),
-            check_overconstraints=True
+            self,
+            check_overconstraints=check_overconstraints
         )
+        return self
 
     def reconfiguration_widget(self):
         return None
 
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        return []
+
     def constraints(self):
         return []
 
@@ -1396,10 +1593,9 @@ class MeasuredDistance(TwoPointConstraint):
                 p[0], p[1])
 
     def drag(self, offs_x, offs_y):
-        if self.horiz:
-            self.label_distance += offs_y
-        else:
-            self.label_distance += offs_x
+        self._object_manager.set_attribute(
+            self, 'label_distance',
+            self.label_distance + (offs_y if self.horiz else offs_x))
         return False
 
     def to_dict(self):
@@ -1445,115 +1641,106 @@ class SameDistance(Primitive):
 
     NAME = "Same distance constraint"
 
-    def __init__(self, object_manager, constrained_object, equiv_class_id,
-                 is_representative):
+    def __init__(self, object_manager, constrained_object):
         super(SameDistance, self).__init__(object_manager, [constrained_object])
         self._constrained_object = constrained_object
-        self._equiv_class_id = equiv_class_id
-        self._is_representative = is_representative
 
     @classmethod
-    def rename_class(cls, object_manager, from_class, to_class):
+    def _clsdata(cls, object_manager):
+        if cls not in object_manager.clsdata:
+            object_manager.journal(lambda: object_manager.clsdata.pop(cls))
+            object_manager.clsdata[cls] = dict(
+                # The equivalence classes of SameDistance primitives. The
+                # root of each class is its representative, and the class's
+                # label is what we draw.
+                classes=DisjointSet(),
+                # Map from each constrained object to its SameDistance.
+                by_object={},
+                # Map from class ids in a saved file to a primitive in that
+                # class; only used while loading (see finish_loading).
+                loaded_classes={},
+            )
         clsdata = object_manager.clsdata[cls]
-        for primitive in clsdata['samedist_primitives']:
-            if primitive._equiv_class_id == from_class:
-                primitive._equiv_class_id = to_class
-                if from_class != to_class:
-                    primitive._is_representative = False
-        classes = clsdata['equiv_classes']
-        classes.remove(from_class)
-        classes.add(to_class)
+        object_manager.share_journal(clsdata['classes'])
+        return clsdata
 
-    @classmethod
-    def squash_classes(cls, object_manager):
-        clsdata = object_manager.clsdata[cls]
-        classes = clsdata['equiv_classes']
-        numclasses = len(classes)
-        rename_dict = {}
-        for c in classes:
-            if c < numclasses:
-                rename_dict[c] = c
+    def _classes(self):
+        return self._object_manager.clsdata[type(self)]['classes']
 
-        for c in classes:
-            if c >= numclasses:
-                for i in xrange(numclasses):
-                    if i not in rename_dict:
-                        rename_dict[i] = c
+    def equiv_class_id(self):
+        return self._classes().label(self)
 
-        for to_class, from_class in rename_dict.iteritems():
-            cls.rename_class(object_manager, from_class, to_class)
+    def is_representative(self):
+        return self._classes().find(self) is self
 
     @classmethod
-    def new(cls, object_manager, x, y, configuration):
-        if cls not in object_manager.clsdata:
-            object_manager.clsdata[cls] = dict(
-                # Note: an optimization we could do here is have this be a
-                # map from the class number to the set of members, but that
-                # doesn't seem worthwhile.
-                equiv_classes=set(),
-                samedist_primitives=set()
-            )
-        clsdata = object_manager.clsdata[cls]
-        equiv_classes = clsdata['equiv_classes']
-        other_distance_primitives = clsdata['samedist_primitives']
-        # Copy the set of classes in case we need to roll everything back.
-        original_equiv_classes = set(equiv_classes)
-        original_class_assignments = {
-            primitive: (primitive._equiv_class_id, primitive._is_representative)
-            for primitive in other_distance_primitives
-        }
-
-        objects = set(configuration)
-
-        classes_to_merge = set()
-        for primitive in other_distance_primitives:
-            remove = False
-            for obj in objects:
-                if obj is primitive._constrained_object:
-                    classes_to_merge.add(primitive._equiv_class_id)
-                    remove = True
-                    break
-            if remove:
-                objects.remove(obj)
+    def preview_constraints(cls, object_manager, objects):
+        # This mustn't change anything, so don't use _clsdata: until the
+        # first SameDistance is made, every object is in a class of its own.
+        clsdata = object_manager.clsdata.get(cls)
+        by_object = clsdata['by_object'] if clsdata is not None else {}
+        # Making one object from each class (or on its own) the same as the
+        # rest constrains everything the merged class will.
+        roots = set()
+        merged = []
+        for obj in objects:
+            if obj in by_object:
+                root = clsdata['classes'].find(by_object[obj])
+            else:
+                root = obj
+            if root not in roots:
+                roots.add(root)
+                merged.append(obj)
+        if not merged:
+            return []
+        constraints = []
+        thesedims = merged[0].dimensions_to_constrain()
+        for obj in merged[1:]:
+            dims = obj.dimensions_to_constrain(multiplier=-1)
+            for (thiscons, othercons) in zip(thesedims, dims):
+                constraints.append((thiscons + othercons, 0))
+        return constraints
+
+    @classmethod
+    def new(cls, object_manager, x, y, configuration,
+            check_overconstraints=True):
+        if check_overconstraints \
+           and not object_manager.constraints_independent(
+               cls.preview_constraints(object_manager, configuration)):
+            ui_log.info("Same distance constraint would overconstrain")
+            return None
+
+        clsdata = cls._clsdata(object_manager)
+        classes = clsdata['classes']
+        by_object = clsdata['by_object']
+
+        # Merge the classes of any objects that already have one.
+        root = None
+        objects = []
+        for obj in configuration:
+            if obj in by_object:
+                if root is None:
+                    root = by_object[obj]
+                else:
+                    root = classes.union(root, by_object[obj])
+            elif obj not in objects:
+                objects.append(obj)
         # At this point, "objects" contains only those objects that
         # still need an equivalence class and weren't already part of one.
 
-        if len(classes_to_merge) == 0:
-            # No existing classes; we can assign a new one.
-            equiv_class = len(equiv_classes)
-            equiv_classes.add(equiv_class)
-            represented = False
-        elif len(classes_to_merge) >= 1:
-            equiv_class = min(classes_to_merge)
-            classes_to_merge.remove(equiv_class)
-            for from_class in classes_to_merge:
-                cls.rename_class(object_manager, from_class, equiv_class)
-            cls.squash_classes(object_manager)
-            represented = True
-
-        added_primitives = []
-
-        try:
-            if not objects:
-                object_manager.update_points()
-            for obj in objects:
-                sd = cls(object_manager, obj, equiv_class, not represented)
-                represented = True
-                other_distance_primitives.add(sd)
-                object_manager.add_primitive(sd, check_overconstraints=True)
-
-                added_primitives.append(sd)
-        except OverconstrainedException:
-            if objects:
-                other_distance_primitives.remove(sd)
-            for primitive in added_primitives:
-                object_manager.remove_primitive(primitive)
-                other_distance_primitives.remove(primitive)
-            clsdata['equiv_classes'] = original_equiv_classes
-            for (primitive, (primitive_class, is_representative)
-                 ) in original_class_assignments.iteritems():
-                primitive._equiv_class_id = primitive_class
-                primitive._is_representative = is_representative
+        for obj in objects:
+            sd = cls(object_manager, obj)
+            classes.add(sd)
+            if root is None:
+                root = sd
+            else:
+                root = classes.union(root, sd)
+            by_object[obj] = sd
+            object_manager.journal(lambda obj=obj: by_object.pop(obj))
+            # We've checked the whole class above; the constraints of the
+            # new primitive alone don't say what it adds.
+            object_manager.add_primitive(sd, check_overconstraints=False)
+        return root
 
     @classmethod
     def configure(cls, objects):
@@ -1568,25 +1755,23 @@ class SameDistance(Primitive):
         return [self._constrained_object]
 
     def delete(self):
-        clsdata = self._object_manager.clsdata[type(self)]
-        other_primitives = clsdata['samedist_primitives']
-        classes = clsdata['equiv_classes']
-        other_primitives.remove(self)
-
-        other_count = 0
-        other_primitive = None
-        for primitive in other_primitives:
-            if primitive._equiv_class_id == self._equiv_class_id:
-                other_count += 1
-                other_primitive = primitive
-        if other_count == 0:
-            classes.remove(self._equiv_class_id)
-            self.squash_classes(self._object_manager)
-        elif other_count == 1:
-            self._object_manager.delete_primitive(other_primitive)
-            # Note: the above deletion will also remove the class from the list.
-        elif self._is_representative:
-            other_primitive._is_representative = True
+        clsdata = self._clsdata(self._object_manager)
+        classes = clsdata['classes']
+        by_object = clsdata['by_object']
+        del by_object[self._constrained_object]
+        self._object_manager.journal(
+            lambda: by_object.__setitem__(self._constrained_object, self))
+
+        members = classes.members(self)
+        classes.remove(self)
+        if len(members) == 1:
+            # A class with one member doesn't constrain anything.
+            (other_primitive,) = members
+            # Unless it's being deleted along with us.
+            if self._object_manager.primitive_idx(other_primitive) \
+               is not None:
+                self._object_manager.delete_primitive(other_primitive)
+                # Note: the above deletion will also remove the class.
 
     @property
     def x(self):
@@ -1607,7 +1792,7 @@ class SameDistance(Primitive):
 
     def draw(self, cr, active, selected):
         obj = self._constrained_object
-        clsid = self._equiv_class_id
+        clsid = self.equiv_class_id()
         if selected:
             cr.set_source_rgb(0, 0, 1)
         elif active:
@@ -1627,15 +1812,13 @@ class SameDistance(Primitive):
             cr.stroke()
 
     def constraints(self):
-        if not self._is_representative:
+        if not self.is_representative():
             return []
 
-        clsdata = self._object_manager.clsdata[type(self)]
         constraints = []
         thesedims = self._constrained_object.dimensions_to_constrain()
-        for primitive in clsdata['samedist_primitives']:
-            if (primitive._equiv_class_id == self._equiv_class_id and
-                primitive is not self):
+        for primitive in self._classes().members(self):
+            if primitive is not self:
                 dims = primitive._constrained_object.dimensions_to_constrain(
                     multiplier=-1
                 )
@@ -1652,8 +1835,8 @@ class SameDistance(Primitive):
         )
         return dict(
             constrained_object=constrained_object_idx,
-            equiv_class_id=self._equiv_class_id,
-            is_representative=self._is_representative,
+            equiv_class_id=self.equiv_class_id(),
+            is_representative=self.is_representative(),
             deps=[constrained_object_idx],
         )
 
@@ -1662,22 +1845,24 @@ class SameDistance(Primitive):
         constrained_object = object_manager.primitives[
             dictionary['constrained_object']
         ]
-        self = cls(
-            object_manager,
-            constrained_object,
-            dictionary['equiv_class_id'],
-            dictionary['is_representative'],
-        )
-        if cls not in object_manager.clsdata:
-            object_manager.clsdata[cls] = dict(
-                equiv_classes=set(),
-                samedist_primitives=set()
-            )
-        clsdata = object_manager.clsdata[cls]
-        clsdata['equiv_classes'].add(self._equiv_class_id)
-        clsdata['samedist_primitives'].add(self)
+        self = cls(object_manager, constrained_object)
+        clsdata = cls._clsdata(object_manager)
+        classes = clsdata['classes']
+        classes.add(self)
+        clsdata['by_object'][constrained_object] = self
+        loaded_classes = clsdata['loaded_classes']
+        equiv_class_id = dictionary['equiv_class_id']
+        if equiv_class_id in loaded_classes:
+            classes.union(loaded_classes[equiv_class_id], self)
+        else:
+            loaded_classes[equiv_class_id] = self
         return self
 
+    @classmethod
+    def finish_loading(cls, object_manager):
+        # The ids were labels in the saved file; they mean nothing now.
+        object_manager.clsdata[cls]['loaded_classes'].clear()
+
     def drag(self, offs_x, offs_y):
         self._constrained_object.drag(offs_x, offs_y)
 
@@ -1687,6 +1872,10 @@ class Coincident(TwoPointConstraint):
     def __init__(self, object_manager, objects):
         super(Coincident, self).__init__(object_manager, objects)
 
+    @classmethod
+    def preview_constraints(cls, object_manager, objects):
+        return constrain_horiz(list(objects)) + constrain_vert(list(objects))
+
     def constraints(self):
         return (constrain_horiz([self.p1, self.p2]) +
                 constrain_vert([self.p1, self.p2]))
@@ -1723,11 +1912,14 @@ class DrawnLine(Primitive):
     VERTICAL = False
 
     def __init__(self, object_manager, p1points, p2points, centerpoints,
-                 thickness=None):
+                 radius, thickness=None):
         super(DrawnLine, self).__init__(object_manager)
         self._p1points = p1points
         self._p2points = p2points
         self._centerpoints = centerpoints
+        # Everything but the two endpoints is derived from the endpoints and
+        # this radius scalar (half of the line's thickness).
+        self._radius = radius
         self._thickness = thickness
 
     @classmethod
@@ -1738,7 +1930,11 @@ class DrawnLine(Primitive):
             thickness = specified_thickness.to("iu")
         else:
             thickness = 10
-        if cls.VERTICAL:
+        if 'offset' in configuration:
+            # The offset of the second end from (x, y); the first end is
+            # the same distance the other way.
+            xoffs, yoffs = configuration['offset']
+        elif cls.VERTICAL:
             xoffs = 0
             yoffs = 100
         else:
@@ -1783,11 +1979,14 @@ class DrawnLine(Primitive):
         else:
             centerpoints = []
 
+        self = cls(object_manager, p1points, p2points, centerpoints,
+                   object_manager.alloc_scalar(thickness),
+                   specified_thickness)
         object_manager.add_primitive(
-            cls(object_manager, p1points, p2points, centerpoints,
-                specified_thickness),
+            self,
             check_overconstraints=False
         )
+        return self
 
     @classmethod
     def exportable(cls):
@@ -1824,7 +2023,7 @@ class DrawnLine(Primitive):
         return result
 
     def reconfiguration_widget(self):
-        print self._thickness
+        ui_log.debug("Line thickness: %s", self._thickness)
         if self._thickness is not None:
             return configuration_widget(
                 [
@@ -1853,6 +2052,12 @@ class DrawnLine(Primitive):
         else:
             return self._p1points + self._p2points
 
+    def endpoints(self):
+        '''
+        The Points at the centers of our two ends.
+        '''
+        return self._p1points[2], self._p2points[2]
+
     @property
     def x1(self):
         return self._p1points[2].x
@@ -1871,7 +2076,7 @@ class DrawnLine(Primitive):
 
     @property
     def thickness(self):
-        return self._p1points[4].y - self._p1points[0].y
+        return 2 * self._object_manager.scalar_value(self._radius)
 
     def dist(self, p):
         res = line_dist(self.x1, self.y1, self.x2, self.y2, p[0], p[1])
@@ -1881,70 +2086,63 @@ class DrawnLine(Primitive):
         else:
             return res
 
+    def scalars(self):
+        return [self._radius]
+
+    def derived_points(self):
+        derived = derive_ball(self._p1points, self._radius)
+        derived.update(derive_ball(self._p2points, self._radius))
+
+        if self._centerpoints:
+            # The center points sit halfway between the endpoints, spread
+            # out across the line.
+            p1 = self._p1points[2].point()
+            p2 = self._p2points[2].point()
+            if self.HORIZONTAL:
+                dx, dy = 0, 1
+            else:
+                dx, dy = 1, 0
+            for point, side in zip(self._centerpoints, (-1, 0, 1)):
+                derived[point.point()] = (
+                    ([(p1, .5, 0), (p2, .5, 0), (self._radius, side * dx)], 0),
+                    ([(p1, 0, .5), (p2, 0, .5), (self._radius, side * dy)], 0),
+                )
+        return derived
+
     def constraints(self):
         constraints = []
-        constraints.extend(constrain_ball(self._p1points))
-        constraints.extend(constrain_ball(self._p2points))
 
         if self.HORIZONTAL:
             constraints.extend(
-                constrain_vert(self._centerpoints) +
-                equal_space_vert(self._centerpoints) +
-                constrain_horiz([self._p1points[0],
-                                 self._centerpoints[0]]) +
-                constrain_horiz([self._p1points[2],
-                                 self._centerpoints[1],
-                                 self._p2points[2]]) +
-                equal_space_horiz([self._p1points[2],
-                                   self._centerpoints[1],
-                                   self._p2points[2]])
-            )
+                constrain_horiz([self._p1points[2], self._p2points[2]]))
         elif self.VERTICAL:
             constraints.extend(
-                constrain_horiz(self._centerpoints) +
-                equal_space_horiz(self._centerpoints) +
-                constrain_vert([self._p1points[1],
-                                self._centerpoints[0]]) +
-                constrain_vert([self._p1points[2],
-                                 self._centerpoints[1],
-                                 self._p2points[2]]) +
-                equal_space_vert([self._p1points[2],
-                                   self._centerpoints[1],
-                                   self._p2points[2]])
-            )
-
-        # Equal radius
-        constraints.append(
-            ([(self._p1points[0].point(), 0, 1),
-              (self._p1points[2].point(), 0, -1),
-              (self._p2points[0].point(), 0, -1),
-              (self._p2points[2].point(), 0, 1)], 0)
-        )
+                constrain_vert([self._p1points[2], self._p2points[2]]))
 
         if self._thickness:
             constraints.append(
-                ([(self._p1points[2].point(), 0, 1),
-                  (self._p1points[0].point(), 0, -1)], self._thickness.to("iu"))
+                ([(self._radius, 1)], self._thickness.to("iu"))
             )
 
         return constraints
 
+    def _thickness_constraint(self):
+        return ([(self._radius, 1)],
+                self._object_manager.scalar_value(self._radius))
+
     def secondary_constraints(self):
         return [
-            ([(self._p1points[4].point(), 0,  1),
-              (self._p1points[0].point(), 0, -1)], self.thickness),
+            self._thickness_constraint(),
             ([(self._p1points[2].point(),  1,  0),
-              (self._p2points[2].point(), -1,  0)], self.x2 - self.x1),
+              (self._p2points[2].point(), -1,  0)], self.x1 - self.x2),
             ([(self._p1points[2].point(),  0,  1),
-              (self._p2points[2].point(),  0, -1)], self.y2 - self.y1),
+              (self._p2points[2].point(),  0, -1)], self.y1 - self.y2),
         ]
 
     def drag_constraints(self, child):
         if child == self._p1points[2] or child == self._p2points[2]:
             return (
-                [([(self._p1points[4].point(), 0,  1),
-                   (self._p1points[0].point(), 0, -1)],
-                  self.thickness)],
+                [self._thickness_constraint()],
                 [self._p1points[2].point() if child == self._p2points[2] else
                  self._p2points[2].point()]
             )
@@ -1977,6 +2175,9 @@ class DrawnLine(Primitive):
             point.drag(offs_x, offs_y)
         return True
 
+    def delete(self):
+        self._object_manager.free_scalar(self._radius)
+
     def to_dict(self):
         p1_indices, p2_indices = (
             [
@@ -1996,6 +2197,7 @@ class DrawnLine(Primitive):
             p1points=p1_indices,
             p2points=p2_indices,
             centerpoints=center_indices,
+            radius=self._radius,
             thickness=self._thickness.to_dict() if self._thickness else None,
             deps=deps,
         )
@@ -2016,7 +2218,12 @@ class DrawnLine(Primitive):
         ] if dictionary['centerpoints'] else None
         thickness = (UnitNumber.from_dict(dictionary['thickness'])
                      if dictionary['thickness'] else None)
-        return cls(object_manager, p1points, p2points, centerpoints, thickness)
+        radius = dictionary.get('radius')
+        if radius is None:
+            # Older files only have the points.
+            radius = object_manager.alloc_scalar(p1points[2].y - p1points[0].y)
+        return cls(object_manager, p1points, p2points, centerpoints, radius,
+                   thickness)
 
 class HorizontalDrawnLine(DrawnLine):
     HORIZONTAL = True
@@ -2042,10 +2249,12 @@ class MarkedLine(Primitive):
                       y)
             for i in xrange(3)
         ]
+        self = cls(object_manager, points, configuration)
         object_manager.add_primitive(
-            cls(object_manager, points, configuration),
+            self,
             check_overconstraints=False
         )
+        return self
 
     @classmethod
     def configure(cls, objects):
@@ -2168,26 +2377,52 @@ class Array(Primitive):
     ZORDER = 3
 
     def __init__(self, object_manager, elements, nx, ny, centerpoint,
-                 numbering=None):
+                 numbering=None, lattice=False):
         super(Array, self).__init__(object_manager)
         self.elements = elements
         self.nx = nx
         self.ny = ny
+        # In a lattice array, only the first element and the centers of the
+        # elements next to it are solved for; every other element is a copy
+        # of the first, offset by a whole number of pitches.
+        self.lattice = lattice
+        self._derived_cache = None
+        # Map from each element to its (i, j) position in the array.
+        self._positions = dict(
+            (element, (idx // ny, idx % ny))
+            for idx, element in enumerate(elements[:nx * ny])
+        )
         self.numbering = numbering
         self.centerpoint = centerpoint
 
+    @property
+    def numbering(self):
+        return self._numbering
+
+    @numbering.setter
+    def numbering(self, numbering):
+        self._numbering = numbering
+        # Map from elements to their numbers under this numbering, filled in
+        # as they're looked up.
+        self._numbers = {}
+        self.invalidate_attributes()
+
     @classmethod
     def new(cls, object_manager, x, y, configuration,
             draw=True, constraining=True, check_overconstraints=False):
         nx = configuration['nx']
         ny = configuration['ny']
-        elemcfg = cls.ELEMTYPE.configure([])
+        lattice = configuration.get('lattice', False)
+        # Where to start the elements off; nothing holds them there.
+        pitch_x = configuration.get('pitch_x', 30)
+        pitch_y = configuration.get('pitch_y', 30)
+        elemcfg = cls.element_configuration(configuration)
         elements = []
         for i in range(nx):
             for j in range(ny):
                 p = cls.ELEMTYPE.new(object_manager,
-                                     x + (i - nx/2) * 30,
-                                     y + (j - ny/2) * 30,
+                                     x + (i - nx/2) * pitch_x,
+                                     y + (j - ny/2) * pitch_y,
                                      elemcfg,
                                      constraining=False)
 
@@ -2200,10 +2435,20 @@ class Array(Primitive):
         else:
             centerpoint = None
 
+        self = cls(object_manager, elements, nx, ny, centerpoint,
+                   lattice=lattice)
         object_manager.add_primitive(
-            cls(object_manager, elements, nx, ny, centerpoint),
+            self,
             check_overconstraints=False,
         )
+        return self
+
+    @classmethod
+    def element_configuration(cls, configuration):
+        '''
+        The configuration to make each element with, given ours.
+        '''
+        return cls.ELEMTYPE.configure([])
 
     @classmethod
     def exportable(cls):
@@ -2224,6 +2469,7 @@ class Array(Primitive):
                 ("# of elements (y)",
                  NumberEntry(int, allow_neg=False, allow_zero=False),
                  None),
+                ("Regular lattice", BoolEntry(), True),
             ]
         )
         dialog.get_content_area().add(widget)
@@ -2234,12 +2480,13 @@ class Array(Primitive):
             if result == 1:
                 if not all(widget.valid() for widget in entry_widgets):
                     continue
-                entry1, entry2 = tuple(entry_widgets)
+                entry1, entry2, entry3 = tuple(entry_widgets)
                 x = entry1.val()
                 y = entry2.val()
                 result = dict(
                     nx=x,
                     ny=y,
+                    lattice=entry3.val(),
                 )
             else:
                 result = False
@@ -2333,7 +2580,8 @@ class Array(Primitive):
         combobox, ALL_NUMBERINGS, reconf_widgetlist = other_widgets
         idx = combobox.get_active()
         numbering_class, (_, widgetlist) = ALL_NUMBERINGS[idx]
-        print numbering_class, widgetlist
+        ui_log.debug("Numbering %s from %r", numbering_class.__name__,
+                     widgetlist)
         vals = [
             widget.val() for widget in widgetlist
         ]
@@ -2358,6 +2606,9 @@ class Array(Primitive):
         return self.elements[j + self.ny * i]
 
     def constraints(self):
+        if self.lattice:
+            return self._lattice_constraints()
+
         all_constraints = []
         for child in self.children():
             all_constraints.extend(child.constraints())
@@ -2396,6 +2647,26 @@ class Array(Primitive):
                         (p0dims + pdims, 0),
                     )
 
+        all_constraints.extend(self._centerpoint_constraints())
+        return all_constraints
+
+    def _lattice_constraints(self):
+        # Everything else follows from derived_points.
+        all_constraints = list(self.p(0, 0).constraints())
+        if self.centerpoint is not None:
+            all_constraints.extend(self.centerpoint.constraints())
+        origin = self.p(0, 0).center_point()
+        if self.nx > 1:
+            all_constraints.extend(
+                constrain_horiz([origin, self.p(1, 0).center_point()]))
+        if self.ny > 1:
+            all_constraints.extend(
+                constrain_vert([origin, self.p(0, 1).center_point()]))
+        all_constraints.extend(self._centerpoint_constraints())
+        return all_constraints
+
+    def _centerpoint_constraints(self):
+        all_constraints = []
         if self.centerpoint is not None:
             if self.nx > 1:
                 all_constraints.extend(
@@ -2433,7 +2704,11 @@ class Array(Primitive):
 
     def secondary_constraints(self):
         all_constraints = []
-        for child in self.children():
+        if self.lattice:
+            children = [self.p(0, 0)]
+        else:
+            children = self.children()
+        for child in children:
             all_constraints.extend(child.secondary_constraints())
         if self.ny > 1:
             all_constraints.append(
@@ -2449,6 +2724,69 @@ class Array(Primitive):
             )
         return all_constraints
 
+    def derived_points(self):
+        return self._derived()[0]
+
+    def derived_scalars(self):
+        return self._derived()[1]
+
+    def _derived(self):
+        # Our elements never change, so this only needs working out once.
+        if self._derived_cache is None:
+            points = {}
+            scalars = {}
+            for child in self.children():
+                points.update(child.derived_points())
+                scalars.update(child.derived_scalars())
+            if self.lattice:
+                self._add_lattice(points, scalars)
+            self._derived_cache = (points, scalars)
+        return self._derived_cache
+
+    def _add_lattice(self, points, scalars):
+        '''
+        Add the derived points and scalars that make every element a copy
+        of the first one.
+        '''
+        template = self.p(0, 0)
+        origin = template.center_point().point()
+        if self.nx > 1:
+            pitch_x = self.p(1, 0).center_point().point()
+        if self.ny > 1:
+            pitch_y = self.p(0, 1).center_point().point()
+        template_points = [child.point() for child in template.children()]
+        for i in xrange(self.nx):
+            for j in xrange(self.ny):
+                if i == j == 0:
+                    continue
+                element = self.p(i, j)
+                for (base, child) in zip(template_points, element.children()):
+                    if child.point() in points:
+                        # The element already derives this point itself.
+                        continue
+                    # element point = template point
+                    #     + i * (pitch_x - origin) + j * (pitch_y - origin)
+                    weights = defaultdict(int)
+                    weights[base] += 1
+                    if i:
+                        weights[pitch_x] += i
+                        weights[origin] -= i
+                    if j:
+                        weights[pitch_y] += j
+                        weights[origin] -= j
+                    weights = [(pt, weight) for pt, weight in weights.iteritems()
+                               if weight]
+                    if weights == [(child.point(), 1)]:
+                        # This is one of the pitch points itself.
+                        continue
+                    points[child.point()] = (
+                        ([(pt, weight, 0) for pt, weight in weights], 0),
+                        ([(pt, 0, weight) for pt, weight in weights], 0),
+                    )
+                for (base, scalar) in zip(template.scalars(),
+                                          element.scalars()):
+                    scalars[scalar] = ([(base, 1)], 0)
+
     def drag_constraints(self, child):
         # TODO: better constraints here.
         return ([], [])
@@ -2479,6 +2817,7 @@ class Array(Primitive):
             numbering=self.numbering.to_dict() if self.numbering else None,
             centerpoint=(self._object_manager.primitive_idx(self.centerpoint)
                          if self.centerpoint is not None else None),
+            lattice=self.lattice,
         )
 
     @classmethod
@@ -2489,29 +2828,39 @@ class Array(Primitive):
         centerpoint_idx = dictionary['centerpoint']
         return cls(
             object_manager,
+            # Our children are the elements and then the center point.
             [object_manager.primitives[child]
-             for child in dictionary['children']],
+             for child in dictionary['children']
+             if child != centerpoint_idx],
             dictionary['nx'],
             dictionary['ny'],
             (object_manager.primitives[centerpoint_idx]
              if centerpoint_idx is not None else None),
             numbering_cls.from_dict(dictionary['numbering'])
                 if numbering_cls else None,
+            dictionary.get('lattice', False),
         )
 
     def number_of(self, child):
-        # TODO: find some better way to accomplish this.
         if not self.numbering:
             return None
-        for i in xrange(self.nx):
-            for j in xrange(self.ny):
-                if child == self.p(i, j):
-                    return self.numbering.number_of(i, j)
+        if child not in self._numbers:
+            position = self._positions.get(child)
+            self._numbers[child] = (self.numbering.number_of(*position)
+                                    if position is not None else None)
+        return self._numbers[child]
 
 class PadArray(Array):
     NAME = "Pad array"
     ELEMTYPE = Pad
 
+    @classmethod
+    def element_configuration(cls, configuration):
+        # The pads' size can be given as w and h.
+        return Pad.configure([], **dict((key, configuration[key])
+                                        for key in ('w', 'h')
+                                        if key in configuration))
+
 class PinArray(Array):
     NAME = "Pin array"
     ELEMTYPE = Pin
@@ -2520,6 +2869,193 @@ class BallArray(Array):
     NAME = "Ball array"
     ELEMTYPE = Ball
 
+class RigidGroup(Primitive):
+    '''
+    Locks a set of primitives together, so that they can only move as a
+    whole.
+
+    Every point of the members and their children is derived from our
+    anchor point plus a fixed offset, and every scalar is fixed at the value
+    it had when the group was made. The whole group is then just the two
+    coordinates of the anchor as far as the solver is concerned, and the
+    members' own constraints hold automatically.
+
+    Points that some other primitive already derives (such as the edges of
+    a ball, which follow from its center and radius) are left to it; see
+    ObjectManager._gather_constraints. So groups can't overlap: only one of
+    them would hold the shared points. A group can contain another, since
+    that only derives the inner group's anchor.
+    '''
+    NAME = "Rigid group"
+    ZORDER = 1
+    # How far outside the members' points we draw our outline.
+    MARGIN = 10
+
+    def __init__(self, object_manager, members, anchor, offsets,
+                 scalar_values):
+        super(RigidGroup, self).__init__(object_manager)
+        self._members = list(members)
+        self._anchor = anchor
+        # Map from point indices to their (x, y) offsets from the anchor.
+        self._offsets = offsets
+        # Map from scalar indices to their fixed values.
+        self._scalar_values = scalar_values
+
+    @staticmethod
+    def _contents(members):
+        '''
+        Return the indices of all points and scalars of the given primitives
+        and their descendants.
+        '''
+        seen = set()
+        points = []
+        scalars = []
+        stack = list(members)
+        while stack:
+            primitive = stack.pop()
+            if primitive in seen:
+                continue
+            seen.add(primitive)
+            if isinstance(primitive, Point):
+                points.append(primitive.point())
+            scalars.extend(primitive.scalars())
+            stack.extend(primitive.children())
+        return points, scalars
+
+    @staticmethod
+    def _overlapping(object_manager, points, scalars):
+        '''
+        Return the existing groups that already hold any of the given points
+        or scalars.
+        '''
+        points = set(points)
+        scalars = set(scalars)
+        return [primitive for primitive in object_manager.primitives
+                if isinstance(primitive, RigidGroup)
+                and (not points.isdisjoint(primitive._offsets)
+                     or not scalars.isdisjoint(primitive._scalar_values))]
+
+    @classmethod
+    def new(cls, object_manager, x, y, configuration):
+        members = list(configuration)
+        points, scalars = cls._contents(members)
+        overlapping = cls._overlapping(object_manager, points, scalars)
+        if overlapping:
+            ui_log.info("Members are already in another rigid group")
+            raise OverconstrainedException(overlapping)
+        xs = [object_manager.point_x(point) for point in points]
+        ys = [object_manager.point_y(point) for point in points]
+        # Constraints that tie the members to things outside the group may
+        # conflict, and there's no way to tell without solving; if they do,
+        # the transaction takes the anchor and the group away again.
+        with object_manager.transaction():
+            anchor = Point.new(object_manager,
+                               (min(xs) + max(xs)) / 2.,
+                               (min(ys) + max(ys)) / 2.)
+            offsets = dict(
+                (point, (object_manager.point_x(point) - anchor.x,
+                         object_manager.point_y(point) - anchor.y))
+                for point in points)
+            scalar_values = dict(
+                (scalar, object_manager.scalar_value(scalar))
+                for scalar in scalars)
+            self = cls(object_manager, members, anchor, offsets,
+                       scalar_values)
+            object_manager.add_primitive(self, check_overconstraints=False)
+            object_manager.update_points()
+        return self
+
+    @classmethod
+    def configure(cls, objects):
+        return list(objects)
+
+    @classmethod
+    def can_create(cls, objects):
+        points, scalars = cls._contents(objects)
+        if not points:
+            return False
+        object_manager = next(iter(objects))._object_manager
+        return not cls._overlapping(object_manager, points, scalars)
+
+    def dependencies(self):
+        return list(self._members)
+
+    def children(self):
+        return [self._anchor]
+
+    def derived_points(self):
+        anchor = self._anchor.point()
+        return dict(
+            (point, (([(anchor, 1, 0)], dx), ([(anchor, 0, 1)], dy)))
+            for point, (dx, dy) in self._offsets.iteritems())
+
+    def derived_scalars(self):
+        return dict((scalar, ([], value))
+                    for scalar, value in self._scalar_values.iteritems())
+
+    def _bounds(self):
+        x, y = self._anchor.x, self._anchor.y
+        xs = [x + dx for dx, dy in self._offsets.itervalues()]
+        ys = [y + dy for dx, dy in self._offsets.itervalues()]
+        return (min(xs) - self.MARGIN, min(ys) - self.MARGIN,
+                max(xs) + self.MARGIN, max(ys) + self.MARGIN)
+
+    def dist(self, p):
+        # Only the outline counts, so that the members inside are still
+        # easy to get at.
+        x0, y0, x1, y1 = self._bounds()
+        x, y = p
+        if x0 <= x <= x1 and y0 <= y <= y1:
+            d = min(x - x0, x1 - x, y - y0, y1 - y)
+        else:
+            d = point_dist(p, (min(max(x, x0), x1), min(max(y, y0), y1)))
+        if d > 5:
+            return None
+        return 20 + d
+
+    def draw(self, cr, active, selected):
+        if selected:
+            cr.set_source_rgb(0, 0, 1)
+        elif active:
+            cr.set_source_rgb(1, 0, 0)
+        else:
+            cr.set_source_rgb(0.5, 0.5, 0.5)
+        x0, y0, x1, y1 = self._bounds()
+        cr.set_line_width(0.5)
+        cr.set_dash([4, 2])
+        cr.rectangle(x0, y0, x1 - x0, y1 - y0)
+        cr.stroke()
+
+    def drag(self, offs_x, offs_y):
+        return self._anchor.drag(offs_x, offs_y)
+
+    def to_dict(self):
+        member_indices = [self._object_manager.primitive_idx(member)
+                          for member in self._members]
+        anchor_idx = self._object_manager.primitive_idx(self._anchor)
+        return dict(
+            members=member_indices,
+            anchor=anchor_idx,
+            offsets=[[point, dx, dy]
+                     for point, (dx, dy) in self._offsets.iteritems()],
+            scalar_values=[[scalar, value] for scalar, value
+                           in self._scalar_values.iteritems()],
+            deps=member_indices + [anchor_idx],
+        )
+
+    @classmethod
+    def from_dict(cls, object_manager, dictionary):
+        return cls(
+            object_manager,
+            [object_manager.primitives[idx]
+             for idx in dictionary['members']],
+            object_manager.primitives[dictionary['anchor']],
+            dict((point, (dx, dy))
+                 for point, dx, dy in dictionary['offsets']),
+            dict((scalar, value)
+                 for scalar, value in dictionary['scalar_values']),
+        )
+
 PRIMITIVE_TYPES = [
     None,
     Point,
@@ -2542,4 +3078,5 @@ PRIMITIVE_TYPES = [
     MeasuredHorizDistance,
     MeasuredVertDistance,
     SameDistance,
+    RigidGroup,
 ]
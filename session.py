@@ -0,0 +1,480 @@
+# Recording editing sessions, and replaying them without the GUI to see how
+# long each operation takes.
+#
+# While recording (see FPArea.start_recording), FPArea reports what the user
+# does to a SessionRecorder: key presses, clicks and releases, pointer motion
+# and what was entered in dialogs. A recording is saved as JSON:
+#
+#   {"version": 1, "footprint": {...}, "cursor": [x, y],
+#    "events": [[t, kind, args...], ...]}
+#
+# footprint is the footprint when recording started (as saved by
+# ObjectManager.to_dict) and cursor is where the pointer was, in internal
+# units. Each event has the time in seconds since recording started, one of
+# the kinds below, and the kind's arguments. Primitives are identified by
+# their index in the ObjectManager.
+#
+# A Replayer drives an ObjectManager through the same operations the editor
+# would have carried out, solving synchronously instead of in the
+# background, and times each one. The results make a benchmark of real
+# editing; see benchmark.py --session.
+#
+# Usage:
+#   python session.py [--repeat N] SESSION...
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+
+from exceptiontypes import OverconstrainedException
+from geda_out import GedaOut
+from object_manager import ObjectManager
+from primitives import (
+    PRIMITIVE_TYPES,
+    HorizDistance,
+    Horizontal,
+    Pad,
+    Primitive,
+    Vertical,
+)
+from units import UnitNumber
+
+SESSION_VERSION = 1
+
+# Event kinds, and their arguments.
+KEY = 'key'            # key name, active primitive
+CLICK = 'click'        # button, active primitive
+RELEASE = 'release'    # button
+MOTION = 'motion'      # dx, dy
+DIALOG = 'dialog'      # the configuration entered, or false if cancelled
+ADD = 'add'            # primitive type, from a button
+SELECT = 'select'      # primitive chosen from the "select other" menu
+UNDO = 'undo'
+REDO = 'redo'
+LOAD = 'load'          # footprint
+SETTINGS = 'settings'  # footprint name, clearance, mask
+
+# What Replayer._take_dialog returns when no dialog was shown.
+NO_DIALOG = object()
+
+# Keys that create primitives from the selection; see
+# FPArea.key_press_event.
+KEY_PRIMITIVES = {
+    'h': Horizontal,
+    'v': Vertical,
+    'd': HorizDistance,
+}
+
+def encode_value(object_manager, value):
+    '''
+    Turn value, the result of a configuration dialog, into something that
+    can be saved as JSON.
+    '''
+    if isinstance(value, Primitive):
+        return dict(primitive=object_manager.primitive_idx(value))
+    if isinstance(value, UnitNumber):
+        return dict(unit_number=value.to_dict())
+    if isinstance(value, (set, frozenset)):
+        return dict(set=[encode_value(object_manager, item)
+                         for item in value])
+    if isinstance(value, tuple):
+        return dict(tuple=[encode_value(object_manager, item)
+                           for item in value])
+    if isinstance(value, list):
+        return [encode_value(object_manager, item) for item in value]
+    if isinstance(value, dict):
+        return dict(dict={key: encode_value(object_manager, item)
+                          for key, item in value.iteritems()})
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    raise ValueError("Can't record %r" % (value,))
+
+def decode_value(object_manager, value):
+    '''
+    The inverse of encode_value.
+    '''
+    if isinstance(value, list):
+        return [decode_value(object_manager, item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    (tag, contents), = value.items()
+    if tag == 'primitive':
+        return object_manager.primitives[contents]
+    if tag == 'unit_number':
+        return UnitNumber.from_dict(contents)
+    if tag == 'set':
+        return set(decode_value(object_manager, item) for item in contents)
+    if tag == 'tuple':
+        return tuple(decode_value(object_manager, item) for item in contents)
+    if tag == 'dict':
+        return {str(key): decode_value(object_manager, item)
+                for key, item in contents.iteritems()}
+    raise ValueError("Unknown recorded value: %r" % (value,))
+
+class SessionRecorder(object):
+    '''
+    Collects the events of an editing session. FPArea keeps object_manager
+    up to date when it switches to another one.
+    '''
+    def __init__(self, object_manager, cursor=(0, 0)):
+        self.object_manager = object_manager
+        self.footprint = object_manager.to_dict()
+        self.cursor = cursor
+        self.events = []
+        self._start = time.time()
+
+    def _record(self, kind, *args):
+        self.events.append([round(time.time() - self._start, 3), kind]
+                           + list(args))
+
+    def _idx(self, primitive):
+        if primitive is None:
+            return None
+        return self.object_manager.primitive_idx(primitive)
+
+    def key(self, keyname, active):
+        self._record(KEY, keyname, self._idx(active))
+
+    def click(self, button, active):
+        self._record(CLICK, button, self._idx(active))
+
+    def release(self, button):
+        self._record(RELEASE, button)
+
+    def motion(self, dx, dy):
+        # Thousandths of a mil are plenty.
+        self._record(MOTION, round(dx, 3), round(dy, 3))
+
+    def dialog(self, result):
+        self._record(DIALOG, encode_value(self.object_manager, result))
+
+    def reconfigured(self, result):
+        '''
+        Record the result of a reconfiguration dialog. What changed depends
+        on the primitive's widgets, so this records the whole footprint as
+        it is afterwards.
+        '''
+        self._record(DIALOG, self.object_manager.to_dict() if result
+                             else False)
+
+    def add(self, primitive_type):
+        self._record(ADD, primitive_type.TYPE())
+
+    def select(self, primitive):
+        self._record(SELECT, self._idx(primitive))
+
+    def undo(self):
+        self._record(UNDO)
+
+    def redo(self):
+        self._record(REDO)
+
+    def load(self, object_manager):
+        self.object_manager = object_manager
+        self._record(LOAD, object_manager.to_dict())
+
+    def settings(self, fp_name, clearance, mask):
+        self._record(SETTINGS, fp_name, clearance.to_dict(),
+                     mask.to_dict() if mask is not None else None)
+
+    def to_dict(self):
+        return dict(
+            version=SESSION_VERSION,
+            footprint=self.footprint,
+            cursor=list(self.cursor),
+            events=self.events,
+        )
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+
+def load_session(filename):
+    with open(filename) as f:
+        session = json.load(f)
+    if session.get('version') != SESSION_VERSION:
+        raise ValueError("%s: unsupported session version %r" %
+                         (filename, session.get('version')))
+    return session
+
+class Replayer(object):
+    '''
+    Replays a session (as loaded by load_session) against an ObjectManager,
+    doing what FPArea would have done for each event. timings maps the
+    name of each kind of operation to a list of how long each took, in
+    seconds.
+    '''
+    def __init__(self, session):
+        self.object_manager = ObjectManager.from_dict(session['footprint'])
+        self.x, self.y = session.get('cursor', (0, 0))
+        self._events = session['events']
+        self._next_event = 0
+        self.active_object = None
+        self.dragging_object = None
+        self._undo_list = [session['footprint']]
+        self._redo_list = []
+        self.timings = defaultdict(list)
+        # Solves that failed because the footprint was overconstrained.
+        self.overconstrained = 0
+
+    def _time(self, operation, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.timings[operation].append(time.time() - start)
+        return result
+
+    def _primitive(self, idx):
+        if idx is None:
+            return None
+        return self.object_manager.primitives[idx]
+
+    def _take_dialog(self):
+        '''
+        The result of the dialog shown for the current event, or NO_DIALOG
+        if there wasn't one.
+        '''
+        if self._next_event < len(self._events) and \
+           self._events[self._next_event][1] == DIALOG:
+            event = self._events[self._next_event]
+            self._next_event += 1
+            return event[2]
+        return NO_DIALOG
+
+    def _solve(self):
+        try:
+            self.object_manager.update_points(self.dragging_object)
+        except OverconstrainedException:
+            self.overconstrained += 1
+
+    def _snapshot(self):
+        self._undo_list.append(self.object_manager.to_dict())
+        del self._redo_list[:]
+
+    def _set_object_manager(self, object_manager):
+        self.object_manager = object_manager
+        self.active_object = None
+        self._solve()
+
+    def run(self):
+        handlers = {
+            KEY: self._key,
+            CLICK: self._click,
+            RELEASE: self._release,
+            MOTION: self._motion,
+            ADD: self._add,
+            SELECT: self._select,
+            UNDO: self._undo,
+            REDO: self._redo,
+            LOAD: self._load,
+            SETTINGS: self._settings,
+            # Dialogs are taken by the event that showed them; one that's
+            # left over has nothing to do.
+            DIALOG: lambda: None,
+        }
+        while self._next_event < len(self._events):
+            event = self._events[self._next_event]
+            self._next_event += 1
+            handlers[event[1]](*event[2:])
+        return self.timings
+
+    def _key(self, keyname, active):
+        self.active_object = self._primitive(active)
+        object_manager = self.object_manager
+        if keyname == 'a':
+            config = self._take_dialog()
+            if config is not NO_DIALOG and config is not False:
+                def add_pad():
+                    Pad.new(object_manager, self.x, self.y,
+                            decode_value(object_manager, config))
+                    self._solve()
+                self._time("add " + Pad.NAME, add_pad)
+        elif keyname == 'Delete':
+            def delete():
+                if self.active_object is not None:
+                    object_manager.delete_primitive(self.active_object)
+                self.active_object = None
+                self._solve()
+                self._snapshot()
+            self._time("delete", delete)
+        elif keyname == 'w':
+            self._time("export", GedaOut.format, object_manager)
+        elif keyname == 'r':
+            footprint = self._take_dialog()
+            if footprint is not NO_DIALOG and footprint:
+                # The footprint as the dialog left it; only the solve that
+                # followed is timed.
+                self.object_manager = ObjectManager.from_dict(footprint)
+                def reconfigure():
+                    self._solve()
+                    self._snapshot()
+                self._time("reconfigure", reconfigure)
+        elif keyname == 'Tab':
+            obj = self.active_object
+            while obj:
+                if obj.exportable():
+                    def suppress():
+                        object_manager.toggle_suppressed(obj)
+                        self._snapshot()
+                    self._time("suppress", suppress)
+                    break
+                obj = obj.parent()
+        elif keyname in ('space', 'q'):
+            pass
+        else:
+            cls = KEY_PRIMITIVES.get(keyname)
+            config = self._take_dialog() if cls else NO_DIALOG
+            if config is NO_DIALOG:
+                config = None
+            def create():
+                if config:
+                    cls.new(object_manager, 0, 0,
+                            decode_value(object_manager, config))
+                self._solve()
+            self._time("add " + cls.NAME if config else "solve", create)
+
+    def _click(self, button, active):
+        self.active_object = self._primitive(active)
+        if button != 1:
+            return
+        if self.active_object is None:
+            self.dragging_object = None
+            return
+        self.dragging_object = self.active_object
+        def start_drag():
+            if self.dragging_object.drag(0, 0):
+                self._solve()
+        self._time("drag start", start_drag)
+
+    def _release(self, button):
+        if button == 1 and self.dragging_object is not None:
+            self._time("drag end", self._snapshot)
+        if button == 1:
+            self.dragging_object = None
+
+    def _motion(self, dx, dy):
+        self.x += dx
+        self.y += dy
+        object_manager = self.object_manager
+        if self.dragging_object is not None:
+            def drag():
+                if self.dragging_object.drag(dx, dy):
+                    object_manager.update_all_point_coords()
+            self._time("drag", drag)
+        self._time("hover", object_manager.closest, self.x, self.y)
+
+    def _add(self, type_id):
+        cls = PRIMITIVE_TYPES[type_id]
+        config = self._take_dialog()
+        if config is NO_DIALOG:
+            # The selection didn't allow it, so there was no dialog.
+            self._time("solve", self._solve)
+            return
+        object_manager = self.object_manager
+        def add():
+            snapshot = False
+            if config is not False:
+                try:
+                    cls.new(object_manager, 0, 0,
+                            decode_value(object_manager, config))
+                except OverconstrainedException:
+                    self.overconstrained += 1
+                else:
+                    snapshot = True
+            self._solve()
+            if snapshot:
+                self._snapshot()
+        self._time("add " + cls.NAME, add)
+
+    def _select(self, idx):
+        self.active_object = self._primitive(idx)
+
+    def _undo(self):
+        def undo():
+            self._redo_list.append(self._undo_list.pop())
+            self._set_object_manager(
+                ObjectManager.from_dict(self._undo_list[-1]))
+        self._time("undo", undo)
+
+    def _redo(self):
+        def redo():
+            footprint = self._redo_list.pop()
+            self._undo_list.append(footprint)
+            self._set_object_manager(ObjectManager.from_dict(footprint))
+        self._time("redo", redo)
+
+    def _load(self, footprint):
+        def load():
+            self._set_object_manager(ObjectManager.from_dict(footprint))
+            self._undo_list = [self.object_manager.to_dict()]
+            del self._redo_list[:]
+        self._time("load", load)
+
+    def _settings(self, fp_name, clearance, mask):
+        object_manager = self.object_manager
+        object_manager.fp_name = fp_name
+        object_manager.default_clearance = UnitNumber.from_dict(clearance)
+        if mask is not None:
+            object_manager.default_mask = UnitNumber.from_dict(mask)
+
+def percentile(sorted_times, p):
+    '''
+    The pth percentile of sorted_times, by the nearest-rank method.
+    '''
+    rank = int(-(-p * len(sorted_times) // 100))
+    return sorted_times[max(rank, 1) - 1]
+
+def summarize(timings):
+    '''
+    Map each operation in timings to its count and latency percentiles.
+    '''
+    summary = {}
+    for operation, times in timings.iteritems():
+        times = sorted(times)
+        summary[operation] = dict(
+            runs=len(times),
+            min=times[0],
+            median=percentile(times, 50),
+            p90=percentile(times, 90),
+            p99=percentile(times, 99),
+            max=times[-1],
+        )
+    return summary
+
+def replay(session, repeat=1):
+    '''
+    Replay session repeat times, and return the summarized timings of all
+    of the runs together.
+    '''
+    timings = defaultdict(list)
+    for _ in xrange(repeat):
+        for operation, times in Replayer(session).run().iteritems():
+            timings[operation].extend(times)
+    return summarize(timings)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="replay recorded fpgen sessions")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="times to replay each session")
+    parser.add_argument('sessions', nargs='+')
+    args = parser.parse_args(argv)
+
+    for filename in args.sessions:
+        summary = replay(load_session(filename), args.repeat)
+        print(filename)
+        print("  %-36s %6s %9s %9s %9s %9s" % (
+            "operation", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for operation, stats in sorted(summary.iteritems()):
+            print("  %-36s %6d %9.2f %9.2f %9.2f %9.2f" % (
+                operation, stats['runs'], stats['median'] * 1000,
+                stats['p90'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
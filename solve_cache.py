@@ -0,0 +1,197 @@
+# A cache of solver results, so that solving the same system again (after
+# opening a file, undoing, redoing, or just re-exporting) doesn't run the
+# solver at all.
+#
+# Results are keyed by a hash of everything in a SolveRequest that the
+# solution map depends on: the constraints and their targets, the derived
+# columns, which points are pinned and in what order, and so on, along with
+# solver.SOLVER_VERSION so that a changed solver doesn't see old results.
+# Point coordinates aren't part of the key. The solution map expresses
+# every column in terms of the current values of the columns that were held
+# in place, so the same map is right wherever the points happen to be, and
+# new coordinates are computed from it as usual.
+
+import hashlib
+import marshal
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from logging_utils import solver_log
+from solver import SOLVER_VERSION, SolveResult, solve
+
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_DISK_ENTRIES = 1024
+
+# The marshal format version to hash; fixed so that keys on disk stay valid.
+MARSHAL_VERSION = 2
+
+def request_key(request):
+    '''
+    Return a hex digest identifying everything the solution of request
+    depends on.
+
+    This uses marshal, which is exact for floats and much quicker than
+    repr on big footprints. Equal requests whose dictionaries were built in
+    a different order can get different keys; that only costs a cache miss.
+    '''
+    sha = hashlib.sha1()
+    sha.update(marshal.dumps((
+        SOLVER_VERSION,
+        request.pivot_rule,
+        request.constraints,
+        request.secondary_constraints,
+        sorted(request.derived.iteritems()),
+        request.points,
+        request.dragging_point,
+        sorted(request.all_points),
+        request.point_lru,
+        request.all_scalars,
+    ), MARSHAL_VERSION))
+    if request.target_keys is not None:
+        sha.update(repr(request.target_keys).encode('utf-8'))
+    return sha.hexdigest()
+
+class SolveCache(object):
+    '''
+    A size-bounded LRU cache of SolveResults, optionally backed by a
+    directory of pickled results that persists between runs.
+
+    It's safe to use from several threads at once.
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, directory=None,
+                 max_disk_entries=DEFAULT_MAX_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        # Map from keys to SolveResults, least recently used first.
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key):
+        '''
+        Return the cached SolveResult for key, or None.
+        '''
+        with self._lock:
+            result = self._entries.pop(key, None)
+            if result is not None:
+                self._entries[key] = result
+                return result
+        result = self._load(key)
+        if result is not None:
+            self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        self._store(key, result)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def solve(self, request, cancelled=None):
+        '''
+        Like solver.solve, but return a cached result if there is one.
+        Results that are overconstrained aren't cached.
+        '''
+        key = request_key(request)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            request.cache_hit = True
+            return result
+        self.misses += 1
+        result = solve(request, cancelled)
+        if result is not None:
+            self.put(key, result)
+        return result
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # Including pickles of classes that have since changed or gone.
+            solver_log.warning("Ignoring unreadable cached solve %s", path)
+            return None
+        if not isinstance(result, SolveResult) or not all(
+                hasattr(result, name)
+                for name in ('matrix', 'degrees_of_freedom', 'primary')):
+            solver_log.warning("Ignoring out of date cached solve %s", path)
+            return None
+        try:
+            # Keep the disk cache in least recently used order too.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def _store(self, key, result):
+        if self.directory is None:
+            return
+        # Write to a temporary file and rename it into place, so that a
+        # reader (perhaps in another process) never sees half a file.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                         suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self._path(key))
+        except (IOError, OSError):
+            solver_log.warning("Couldn't write cached solve to %s",
+                               self.directory)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        paths = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory)
+                 if name.endswith(".pickle")]
+        if len(paths) <= self.max_disk_entries:
+            return
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:len(paths) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def cached_solve(request, cancelled=None):
+    '''
+    Solve request with request.cache if it has one, and otherwise with
+    solver.solve.
+    '''
+    if request.cache is not None:
+        return request.cache.solve(request, cancelled)
+    return solve(request, cancelled)
@@ -0,0 +1,118 @@
+# Command line client for solve_server.py. This deliberately imports nothing
+# from the rest of fpgen, so it starts quickly.
+#
+# Usage:
+#   python solve_client.py [--socket PATH] METHOD [PARAMS]
+#   python solve_client.py [--socket PATH] --batch < requests
+#
+# PARAMS is a JSON object, for example
+#   python solve_client.py load '{"path": "soic8.fpg"}'
+#   python solve_client.py export \
+#       '{"name": "soic8.fpg", "targets": [["kicad_mod", "soic8.kicad_mod"]]}'
+# and the result is printed as JSON. With --batch, requests are read from
+# stdin, one JSON object per line as the server expects them, and sent over
+# a single connection; the responses are printed one per line.
+#
+# The exit status is 1 if any request failed or went unanswered.
+
+from __future__ import print_function
+
+import argparse
+import json
+import socket
+import sys
+import threading
+
+from defaults import DEFAULT_SOLVE_SOCKET
+
+class SolveClient(object):
+    def __init__(self, socket_path=DEFAULT_SOLVE_SOCKET):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._rfile = self._socket.makefile('r')
+        self._wfile = self._socket.makefile('w')
+        self._next_id = 0
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._socket.close()
+
+    def send(self, request):
+        self._wfile.write(json.dumps(request) + "\n")
+        self._wfile.flush()
+
+    def receive(self):
+        line = self._rfile.readline()
+        if not line:
+            raise IOError("The server closed the connection")
+        return json.loads(line)
+
+    def call(self, method, params):
+        '''
+        Make one request and return the server's response.
+        '''
+        self._next_id += 1
+        self.send(dict(id=self._next_id, method=method, params=params))
+        return self.receive()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="fpgen solve client")
+    parser.add_argument('--socket', default=DEFAULT_SOLVE_SOCKET,
+                        help="Unix socket the server is listening on")
+    parser.add_argument('--batch', action='store_true',
+                        help="read requests from stdin")
+    parser.add_argument('method', nargs='?')
+    parser.add_argument('params', nargs='?', default='{}')
+    args = parser.parse_args(argv)
+    if not args.batch and args.method is None:
+        parser.error("give a method, or --batch")
+
+    client = SolveClient(args.socket)
+    failed = False
+    try:
+        if args.batch:
+            # Requests are sent without waiting for the responses to the
+            # ones before them; those are read on another thread, so
+            # neither end waits on the other with a full buffer.
+            requests = [json.loads(line) for line in sys.stdin
+                        if line.strip()]
+            responses = []
+            errors = []
+            def read():
+                try:
+                    for _ in requests:
+                        responses.append(client.receive())
+                except (IOError, ValueError) as e:
+                    errors.append(e)
+            reader = threading.Thread(target=read)
+            reader.start()
+            try:
+                for request in requests:
+                    client.send(request)
+            except IOError as e:
+                errors.append(e)
+            reader.join()
+            for response in responses:
+                failed = failed or 'error' in response
+                print(json.dumps(response))
+            if len(responses) < len(requests):
+                failed = True
+                print("Only %d of %d requests were answered: %s"
+                      % (len(responses), len(requests),
+                         errors[0] if errors else "no reason given"),
+                      file=sys.stderr)
+        else:
+            response = client.call(args.method, json.loads(args.params))
+            if 'error' in response:
+                failed = True
+                print(json.dumps(response['error'], indent=2),
+                      file=sys.stderr)
+            else:
+                print(json.dumps(response['result'], indent=2))
+    finally:
+        client.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
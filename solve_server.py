@@ -0,0 +1,517 @@
+# A long-running, headless fpgen that solves and exports footprints on
+# request, so that a build can work through a whole library without starting
+# a new interpreter (and loading every module) for each footprint.
+#
+# The server listens on a Unix socket. Each request is one line of JSON:
+#
+#   {"id": 1, "method": "load", "params": {"path": "soic8.fpg"}}
+#
+# and gets one line of JSON back, carrying the same id:
+#
+#   {"id": 1, "result": {"name": "soic8.fpg", ...}}
+#   {"id": 1, "error": {"type": "OverconstrainedException", ...}}
+#
+# Loaded footprints are kept in a pool, each under a name (its path, unless
+# the request gives another), and the least recently used ones are dropped
+# when the pool is full. Every connection is handled on its own thread, so
+# several clients can work at once; requests for the same footprint take
+# turns. See METHODS for what can be requested, and solve_client.py for a
+# command line client.
+#
+# Usage:
+#   python solve_server.py [--socket PATH] [--pool-size N] [--cache-dir DIR]
+
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+from collections import OrderedDict
+
+from autosave import atomic_write
+from defaults import DEFAULT_SOLVE_SOCKET
+from exceptiontypes import OverconstrainedException
+from export import EMITTERS, export_object_manager
+from logging_utils import configure as configure_logging, io_log
+from object_manager import ObjectManager
+from solve_cache import SolveCache
+from sweep import ParameterSweep
+from units import UnitNumber
+
+DEFAULT_POOL_SIZE = 32
+
+class RequestError(Exception):
+    '''
+    Raised for requests that are malformed or refer to things that don't
+    exist. The message is passed back to the client.
+    '''
+
+class ServerRunning(Exception):
+    '''
+    Raised when another server is already listening on our socket.
+    '''
+
+class PooledFootprint(object):
+    '''
+    A loaded footprint, and what we've worked out about it so far.
+    '''
+    def __init__(self, name, object_manager, path=None, mtime=None):
+        self.name = name
+        self.object_manager = object_manager
+        # The file it was loaded from, and that file's modification time
+        # then, so that a later load of a changed file reloads it.
+        self.path = path
+        self.mtime = mtime
+        # Held while a request works on this footprint.
+        self.lock = threading.Lock()
+        # ParameterSweeps, keyed by the indices of the swept primitives.
+        # They're factored on first use, so keeping them around makes
+        # later sweeps of the same dimensions almost free.
+        self.sweeps = {}
+
+    def primitive(self, idx):
+        primitives = self.object_manager.primitives
+        if not isinstance(idx, int) or not 0 <= idx < len(primitives):
+            raise RequestError("No primitive %r in %s" % (idx, self.name))
+        return primitives[idx]
+
+    def changed(self):
+        self.sweeps.clear()
+
+    def summary(self):
+        object_manager = self.object_manager
+        return dict(
+            name=self.name,
+            fp_name=object_manager.fp_name,
+            primitives=len(object_manager.primitives),
+            degrees_of_freedom=object_manager.degrees_of_freedom,
+        )
+
+class FootprintPool(object):
+    '''
+    A size-bounded LRU pool of PooledFootprints, keyed by name. It's safe
+    to use from several threads at once.
+    '''
+    def __init__(self, max_entries=DEFAULT_POOL_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Least recently used first.
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                raise RequestError("No footprint named %r is loaded" %
+                                   (name,))
+            self._entries[name] = entry
+            return entry
+
+    def peek(self, name):
+        with self._lock:
+            return self._entries.get(name)
+
+    def put(self, entry):
+        with self._lock:
+            self._entries.pop(entry.name, None)
+            self._entries[entry.name] = entry
+            while len(self._entries) > self.max_entries:
+                name, _ = self._entries.popitem(last=False)
+                io_log.info("Dropped %s from the pool", name)
+
+    def remove(self, name):
+        with self._lock:
+            return self._entries.pop(name, None) is not None
+
+    def names(self):
+        with self._lock:
+            return list(self._entries)
+
+def _distance(value):
+    '''
+    A distance from a request: a number in internal units, or a string
+    such as "0.65 mm".
+    '''
+    if isinstance(value, (int, float)):
+        return UnitNumber(value, "iu")
+    try:
+        return UnitNumber.from_str(value, "iu")
+    except (ValueError, AttributeError):
+        raise RequestError("Bad distance: %r" % (value,))
+
+def _targets(params):
+    targets = params.get('targets')
+    if not targets:
+        raise RequestError("No export targets given")
+    targets = [tuple(target) for target in targets]
+    for fmt, _ in targets:
+        if fmt not in EMITTERS:
+            raise RequestError("Unknown export format: %s" % fmt)
+    return targets
+
+class SolveService(object):
+    '''
+    Carries out requests (see handle) against a FootprintPool.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+
+    def handle(self, request):
+        '''
+        Carry out one decoded request, returning the response to send.
+        '''
+        request_id = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise RequestError("A request must be a JSON object")
+            method = METHODS.get(request.get('method'))
+            if method is None:
+                raise RequestError("Unknown method: %r" %
+                                   (request.get('method'),))
+            params = request.get('params') or {}
+            if not isinstance(params, dict):
+                raise RequestError("params must be a JSON object")
+            result = method(self, params)
+        except OverconstrainedException as e:
+            return dict(id=request_id, error=dict(
+                type='OverconstrainedException',
+                message="Overconstrained",
+                conflicting=self._indices(request, e.conflicting_primitives),
+            ))
+        except (RequestError, IOError, OSError, ValueError, KeyError) as e:
+            return dict(id=request_id, error=dict(
+                type=type(e).__name__,
+                message=str(e),
+            ))
+        except Exception as e:
+            io_log.exception("Request %r failed", request)
+            return dict(id=request_id, error=dict(
+                type=type(e).__name__,
+                message=str(e),
+            ))
+        return dict(id=request_id, result=result)
+
+    def _indices(self, request, primitives):
+        entry = self.pool.peek((request.get('params') or {}).get('name'))
+        if entry is None:
+            return []
+        indices = [entry.object_manager.primitive_idx(primitive)
+                   for primitive in primitives]
+        return [idx for idx in indices if idx is not None]
+
+    def _entry(self, params):
+        name = params.get('name')
+        if name is None:
+            raise RequestError("No footprint name given")
+        return self.pool.get(name)
+
+    def load(self, params):
+        '''
+        Load a footprint, from a file (params "path") or from the
+        dictionary saved in one (params "footprint"), and solve it. It's
+        kept under params "name", or its path. A file that's already loaded
+        and hasn't changed since isn't loaded again.
+        '''
+        path = params.get('path')
+        footprint = params.get('footprint')
+        name = params.get('name', path)
+        if name is None:
+            raise RequestError("No footprint name given")
+        if footprint is None:
+            if path is None:
+                raise RequestError("Give a path or a footprint to load")
+            mtime = os.path.getmtime(path)
+            entry = self.pool.peek(name)
+            if entry is not None and entry.path == path \
+               and entry.mtime == mtime:
+                self.pool.get(name)
+                result = entry.summary()
+                result['reloaded'] = False
+                return result
+            with open(path) as f:
+                footprint = json.load(f)
+            io_log.info("Loaded %s", path)
+        else:
+            path = mtime = None
+        entry = PooledFootprint(name, ObjectManager.from_dict(footprint),
+                                path, mtime)
+        self.pool.put(entry)
+        result = entry.summary()
+        result['reloaded'] = True
+        return result
+
+    def unload(self, params):
+        return dict(unloaded=self.pool.remove(params.get('name')))
+
+    def names(self, params):
+        return dict(names=self.pool.names())
+
+    def edit(self, params):
+        '''
+        Apply params "edits", a list of edits (see EDITS) that each refer to
+        primitives by their index in the saved footprint, then solve. If
+        any edit fails, the transaction puts the footprint back as it was.
+        '''
+        edits = params.get('edits')
+        if not isinstance(edits, list):
+            raise RequestError("edits must be a list")
+        entry = self._entry(params)
+        with entry.lock:
+            try:
+                with entry.object_manager.transaction():
+                    for edit in edits:
+                        op = EDITS.get(edit.get('op'))
+                        if op is None:
+                            raise RequestError("Unknown edit: %r" %
+                                               (edit.get('op'),))
+                        op(entry, edit)
+                    entry.object_manager.update_points()
+            finally:
+                entry.changed()
+            return entry.summary()
+
+    def solve(self, params):
+        entry = self._entry(params)
+        with entry.lock:
+            entry.object_manager.update_points()
+            return entry.summary()
+
+    def save(self, params):
+        '''
+        Save the footprint to params "path", or where it was loaded from.
+        '''
+        entry = self._entry(params)
+        with entry.lock:
+            path = params.get('path', entry.path)
+            if path is None:
+                raise RequestError("No path to save %s to" % entry.name)
+            atomic_write(path, json.dumps(entry.object_manager.to_dict()))
+            io_log.info("Saved %s", path)
+            if path == entry.path:
+                entry.mtime = os.path.getmtime(path)
+            return dict(path=path)
+
+    def export(self, params):
+        '''
+        Export the footprint to params "targets", a list of
+        [format, filename] pairs. The text of targets whose filename is
+        null is sent back instead of being written.
+        '''
+        targets = _targets(params)
+        entry = self._entry(params)
+        with entry.lock:
+            results = export_object_manager(entry.object_manager, targets,
+                                            params.get('concurrent', False))
+        return dict(texts=[
+            dict(format=fmt, text=results[fmt, filename])
+            for fmt, filename in targets if filename is None
+        ])
+
+    def sweep(self, params):
+        '''
+        Export a variant of the footprint for each row of params "table",
+        with the distances of params "primitives" (a list of indices) set
+        to the row's values. params "targets" are as for export, with
+        "{index}" in a filename replaced by the row's index. The footprint
+        itself isn't changed.
+        '''
+        targets = _targets(params)
+        table = [[_distance(value) for value in row]
+                 for row in params.get('table', [])]
+        entry = self._entry(params)
+        with entry.lock:
+            indices = tuple(params.get('primitives', ()))
+            sweep = entry.sweeps.get(indices)
+            if sweep is None:
+                sweep = ParameterSweep(entry.object_manager,
+                                       [entry.primitive(idx)
+                                        for idx in indices])
+                entry.sweeps[indices] = sweep
+            texts = []
+            for i, _ in enumerate(sweep.variants(table)):
+                variant_targets = [
+                    (fmt, filename.format(index=i)
+                          if filename is not None else None)
+                    for fmt, filename in targets
+                ]
+                results = export_object_manager(
+                    entry.object_manager, variant_targets,
+                    params.get('concurrent', False))
+                texts.extend(
+                    dict(index=i, format=fmt, text=results[fmt, None])
+                    for fmt, filename in variant_targets if filename is None
+                )
+        return dict(variants=len(table), texts=texts)
+
+    def stats(self, params):
+        cache = ObjectManager.solve_cache
+        result = dict(footprints=len(self.pool))
+        if cache is not None:
+            result.update(cache_entries=len(cache),
+                          cache_hits=cache.hits,
+                          cache_misses=cache.misses)
+        return result
+
+def _edit_set_distance(entry, edit):
+    primitive = entry.primitive(edit.get('primitive'))
+    if not hasattr(primitive, 'distance'):
+        raise RequestError("%s has no distance" % primitive.NAME)
+    entry.object_manager.set_attribute(primitive, 'distance',
+                                       _distance(edit.get('value')))
+    if hasattr(primitive, 'invalidate_layout'):
+        primitive.invalidate_layout()
+
+def _edit_drag(entry, edit):
+    '''
+    Drag a primitive by (dx, dy), as if with the mouse.
+    '''
+    object_manager = entry.object_manager
+    primitive = entry.primitive(edit.get('primitive'))
+    if primitive.drag(0, 0):
+        object_manager.update_points(primitive)
+    if primitive.drag(edit.get('dx', 0), edit.get('dy', 0)):
+        object_manager.update_all_point_coords()
+
+def _edit_delete(entry, edit):
+    entry.object_manager.delete_primitive(
+        entry.primitive(edit.get('primitive')))
+
+def _edit_suppress(entry, edit):
+    primitive = entry.primitive(edit.get('primitive'))
+    if not primitive.exportable():
+        raise RequestError("%s can't be suppressed" % primitive.NAME)
+    if entry.object_manager.is_suppressed(primitive) != \
+       edit.get('suppressed', True):
+        entry.object_manager.toggle_suppressed(primitive)
+
+def _edit_rename(entry, edit):
+    entry.object_manager.set_attribute(entry.object_manager, 'fp_name',
+                                       edit.get('fp_name', ""))
+
+# Edits, by the "op" in the request.
+EDITS = {
+    'set_distance': _edit_set_distance,
+    'drag': _edit_drag,
+    'delete': _edit_delete,
+    'suppress': _edit_suppress,
+    'rename': _edit_rename,
+}
+
+# Requests, by the "method" in the request. shutdown is handled by the
+# connection handler.
+METHODS = {
+    'load': SolveService.load,
+    'unload': SolveService.unload,
+    'names': SolveService.names,
+    'edit': SolveService.edit,
+    'solve': SolveService.solve,
+    'save': SolveService.save,
+    'export': SolveService.export,
+    'sweep': SolveService.sweep,
+    'stats': SolveService.stats,
+}
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = dict(id=None, error=dict(type='ValueError',
+                                                    message=str(e)))
+            else:
+                if isinstance(request, dict) and \
+                   request.get('method') == 'shutdown':
+                    self._reply(dict(id=request.get('id'), result={}))
+                    # shutdown waits for serve_forever to return, so it
+                    # can't be called from the thread handling a request.
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+                response = self.server.service.handle(request)
+            self._reply(response)
+
+    def _reply(self, response):
+        self.wfile.write(json.dumps(response) + "\n")
+        self.wfile.flush()
+
+class SolveServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        _remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _Handler)
+        self.socket_path = socket_path
+        self.service = service
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+def _remove_stale_socket(socket_path):
+    '''
+    Remove the socket at socket_path if it was left behind by a server that
+    didn't exit cleanly. Raises ServerRunning if a server is listening on
+    it.
+    '''
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+    else:
+        raise ServerRunning("A server is already listening on %s"
+                            % socket_path)
+    finally:
+        probe.close()
+    try:
+        os.remove(socket_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="fpgen solve server")
+    parser.add_argument('--socket', default=DEFAULT_SOLVE_SOCKET,
+                        help="Unix socket to listen on")
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help="how many footprints to keep loaded")
+    parser.add_argument('--cache-dir',
+                        help="directory to keep solver results in between "
+                             "runs")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    ObjectManager.solve_cache = SolveCache(directory=args.cache_dir)
+    try:
+        server = SolveServer(args.socket,
+                             SolveService(FootprintPool(args.pool_size)))
+    except ServerRunning as e:
+        print(e, file=sys.stderr)
+        return 1
+    io_log.info("Listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
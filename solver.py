@@ -0,0 +1,535 @@
+# The core constraint solver.
+#
+# The ObjectManager compiles the constraints of all of its primitives into a
+# SolveRequest. A request contains everything needed to solve the system and
+# nothing that refers back to the ObjectManager, so it can be solved on a
+# different thread while the ObjectManager keeps being used.
+#
+# Internally, every unknown is a column: point p has columns 2 * p (x) and
+# 2 * p + 1 (y), and scalar s has column -1 - s.
+
+from collections import defaultdict
+
+from logging_utils import solver_log
+
+class SolveCancelled(Exception):
+    pass
+
+# Rules for choosing pivots; see Elimination.
+#   lowest: the lowest-numbered column in the row.
+#   markowitz: the column in the fewest other rows, so that adding the row
+#       changes as few others as possible. Primary constraints are also
+#       eliminated sparsest first.
+PIVOT_LOWEST = 'lowest'
+PIVOT_MARKOWITZ = 'markowitz'
+
+# With the Markowitz rule, we only pivot on entries at least this fraction
+# of the largest entry in their row, so that we don't divide by something
+# tiny.
+PIVOT_THRESHOLD = 0.1
+
+# Part of every solve_cache key. Change this whenever a change to the solver
+# can give a different SolveResult for the same SolveRequest, or changes
+# what's in a SolveResult, so that results cached on disk by the old
+# solver aren't used.
+SOLVER_VERSION = 1
+
+class SolveRequest(object):
+    def __init__(self, constraints, secondary_constraints, points,
+                 dragging_point, all_points, point_lru, generation,
+                 derived=None, all_scalars=None):
+        # Constraints that must hold; see Primitive.constraints for the
+        # format.
+        self.constraints = constraints
+        # Constraints that should hold if possible.
+        self.secondary_constraints = secondary_constraints
+        # Points that should stay where they are if possible.
+        self.points = points
+        # The point being dragged, if any.
+        self.dragging_point = dragging_point
+        # All points, and the order in which we should try to keep them in
+        # place.
+        self.all_points = all_points
+        self.point_lru = point_lru
+        # All scalars. These are held in place after all points.
+        self.all_scalars = all_scalars or []
+        # The ObjectManager's solve generation at the time of the request.
+        # A result can only be applied if this still matches.
+        self.generation = generation
+        # Columns that aren't unknowns of their own, but follow from other
+        # columns; see expand_derived.
+        self.derived = derived or {}
+        # How to choose pivots: PIVOT_MARKOWITZ or PIVOT_LOWEST.
+        self.pivot_rule = PIVOT_MARKOWITZ
+        # If given, an Elimination of exactly these constraints (with these
+        # derived columns), from an earlier SolveResult. It isn't modified,
+        # and is only used if it was made with pivot_rule.
+        self.primary = None
+        # An instrumentation.SolveProbe to record measurements in, or None.
+        self.probe = None
+        # If the constraints turn out to be overconstrained, solve sets
+        # this to the indices in constraints of a small set of constraints
+        # that can't all hold.
+        self.conflicting_constraints = None
+        # If given, a list parallel to constraints. Where an entry isn't
+        # None, that constraint's target is left as a symbol: the entry is
+        # used as a key in the solution, in place of the target's value.
+        # Such a result can't be applied directly; see sweep.py.
+        self.target_keys = None
+        # A solve_cache.SolveCache to look the result up in, or None.
+        self.cache = None
+        # Set by the cache if the result came from it, so the solver didn't
+        # run (and the probe, if any, has nothing in it).
+        self.cache_hit = False
+
+class SolveResult(object):
+    def __init__(self, matrix, degrees_of_freedom, primary):
+        # Maps each column to a row expressing it in terms of the columns
+        # that were held in place.
+        self.matrix = matrix
+        self.degrees_of_freedom = degrees_of_freedom
+        # The Elimination of the explicit constraints alone.
+        self.primary = primary
+
+def scalar_column(scalar):
+    return -1 - scalar
+
+def terms_to_columns(terms):
+    '''
+    Convert a list of terms, in the format used by Primitive.constraints,
+    to a map from columns to coefficients.
+    '''
+    columns = defaultdict(int)
+    for term in terms:
+        if len(term) == 2:
+            scalar, coeff = term
+            columns[scalar_column(scalar)] += coeff
+        else:
+            pt, coeffx, coeffy = term
+            columns[2 * pt] += coeffx
+            columns[2 * pt + 1] += coeffy
+    return columns
+
+def expression_to_columns(expression):
+    '''
+    Convert a (terms, constant) pair, as returned by
+    Primitive.derived_points, to a map from columns (or None, for the
+    constant) to coefficients.
+    '''
+    terms, constant = expression
+    columns = terms_to_columns(terms)
+    if constant:
+        columns[None] = constant
+    return columns
+
+def expand_derived(derived):
+    '''
+    Given a map from derived columns to maps from columns (or None, for a
+    constant) to coefficients, return the same map with every column
+    expressed only in terms of columns that aren't themselves derived.
+    '''
+    expanded = {}
+
+    def expand(col, visiting):
+        if col in expanded:
+            return expanded[col]
+        assert col not in visiting, "Circular derived column %r" % col
+        visiting.add(col)
+        row = defaultdict(int)
+        for base, coeff in derived[col].iteritems():
+            if base is not None and base in derived:
+                for other, other_coeff in expand(base, visiting).iteritems():
+                    row[other] += coeff * other_coeff
+            else:
+                row[base] += coeff
+        visiting.remove(col)
+        expanded[col] = dict((base, coeff) for base, coeff in row.iteritems()
+                             if coeff)
+        return expanded[col]
+
+    for col in derived:
+        expand(col, set())
+    return expanded
+
+def constraint_to_row(coeffs, target, derived):
+    '''
+    Convert a constraint, in the format used by Primitive.constraints, to
+    a (row, target) pair for Elimination.add, with derived columns (from
+    expand_derived) replaced by what they're derived from.
+    '''
+    columns = terms_to_columns(coeffs)
+    row = {}
+    for col, coeff in columns.iteritems():
+        if col in derived:
+            for base, base_coeff in derived[col].iteritems():
+                if base is None:
+                    target -= coeff * base_coeff
+                else:
+                    row[base] = row.get(base, 0) + coeff * base_coeff
+        else:
+            row[col] = row.get(col, 0) + coeff
+    return dict((col, coeff) for col, coeff in row.iteritems() if coeff), target
+
+def factor_constraints(rows, pivot_rule=PIVOT_MARKOWITZ, check_cancelled=None,
+                       probe=None):
+    '''
+    Eliminate a list of (row, target) pairs from constraint_to_row. A
+    target can also be a map from keys (or None, for a constant) to
+    coefficients, as for Elimination.add.
+
+    Returns (elimination, conflict). If the rows are independent, conflict
+    is None. Otherwise elimination is None, and conflict is a list of
+    indices into rows of some rows that are dependent on each other.
+    '''
+    elimination = Elimination(pivot_rule, probe, track_origins=True)
+    order = list(range(len(rows)))
+    if pivot_rule == PIVOT_MARKOWITZ:
+        # Sparse rows first: they're cheap to eliminate, and the denser
+        # rows that come later have less left to pivot on.
+        order.sort(key=lambda i: len(rows[i][0]))
+    for i in order:
+        if check_cancelled is not None:
+            check_cancelled()
+        row, target = rows[i]
+        if not isinstance(target, dict):
+            target = {None: target}
+        if not row and all(round(v, 4) == 0 for v in target.itervalues()):
+            # Everything in the constraint is derived, and it already
+            # holds (say, between two points of a RigidGroup).
+            continue
+        if not elimination.add(dict(row), target, i):
+            return None, elimination.dependency
+    elimination.probe = None
+    return elimination, None
+
+def _subtract(dest, source, factor, skip=None):
+    '''
+    Subtract factor times the map source from the map dest, dropping
+    anything that becomes (close to) zero. Returns the keys that were
+    added to and removed from dest.
+    '''
+    added = []
+    removed = []
+    for key, v in source.iteritems():
+        if key == skip:
+            continue
+        value = dest.get(key, 0) - v * factor
+        if round(value, 4) == 0:
+            if key in dest:
+                del dest[key]
+                removed.append(key)
+        else:
+            if key not in dest:
+                added.append(key)
+            dest[key] = value
+    return added, removed
+
+class Elimination(object):
+    '''
+    Gauss-Jordan elimination, one row at a time.
+
+    Every row has a pivot column, with coefficient 1, that appears in no
+    other row. Alongside each row we keep its inverse: what the row is equal
+    to, as a map from columns (or None for a constant) to coefficients, in
+    terms of the targets of the rows that were added.
+
+    We also index which rows each column appears in, so that adding a row
+    only touches the rows that contain its pivot.
+
+    If track_origins is set, each row added can be given an origin (any
+    hashable label), and we keep track of which of them each row is a
+    combination of. When a row turns out to be dependent, dependency is
+    then the list of origins of the rows it depends on, including its own.
+    '''
+    def __init__(self, pivot_rule=PIVOT_MARKOWITZ, probe=None,
+                 track_origins=False):
+        self.pivot_rule = pivot_rule
+        self.probe = probe
+        # List of maps from column indices to coefficients.
+        self.rows = []
+        # Same as rows; the inverse of each row.
+        self.inv = []
+        # Map from each pivot column to the index of its row.
+        self.pivots = {}
+        # Map from each column to the set of indices of rows it appears in.
+        self._column_rows = defaultdict(set)
+        # If we're tracking origins, a list with a map from origins to
+        # coefficients for each row.
+        self.origins = [] if track_origins else None
+        # The origins involved in the last dependent row, if we're
+        # tracking them.
+        self.dependency = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def copy(self, probe=None):
+        '''
+        Return a copy that can be added to without changing this one. The
+        copy doesn't track origins.
+        '''
+        other = Elimination(self.pivot_rule, probe)
+        other.rows = [dict(row) for row in self.rows]
+        other.inv = [defaultdict(int, row) for row in self.inv]
+        other.pivots = dict(self.pivots)
+        other._column_rows = defaultdict(set)
+        for col, rows in self._column_rows.iteritems():
+            other._column_rows[col] = set(rows)
+        return other
+
+    def independent(self, rows):
+        '''
+        Whether the given rows (maps from column indices to coefficients)
+        could all be added, i.e. are independent of each other and of the
+        existing rows. Nothing is changed.
+        '''
+        return self.find_dependency(rows) is None
+
+    def find_dependency(self, rows):
+        '''
+        If the given rows could all be added, return None. Otherwise, return
+        (origins, indices): the origins of existing rows and the indices
+        into rows of new rows that are dependent on each other. Origins are
+        only known if we're tracking them. Nothing is changed.
+        '''
+        extra = Elimination(self.pivot_rule, track_origins=True)
+        for i, row in enumerate(rows):
+            new = dict(row)
+            origin = {('new', i): 1}
+            self._reduce(new, origin=origin)
+            if not extra._add(new, {}, origin):
+                dependency = extra.dependency
+                return ([o for o in dependency if not isinstance(o, tuple)],
+                        [o[1] for o in dependency if isinstance(o, tuple)])
+        return None
+
+    def _reduce(self, new, targets=None, origin=None):
+        '''
+        Eliminate the existing pivots from new, which is modified. Returns
+        the inverse of the result, unless targets is None. If origin is
+        given, it's updated with the origins of the rows we used.
+        '''
+        if targets is not None:
+            new_inv = defaultdict(int)
+            new_inv.update(targets)
+        else:
+            new_inv = None
+        if self.origins is None:
+            origin = None
+        # Rows only contain their own pivot, so this can't add pivots to new.
+        for x in [x for x in new if x in self.pivots]:
+            i = self.pivots[x]
+            factor = new.pop(x)
+            for y, v in self.rows[i].iteritems():
+                if y != x:
+                    new[y] = new.get(y, 0) - v * factor
+            if new_inv is not None:
+                for y, v in self.inv[i].iteritems():
+                    new_inv[y] -= v * factor
+            if origin is not None:
+                _subtract(origin, self.origins[i], factor)
+
+        for x in list(new):
+            if round(new[x], 4) == 0:
+                del new[x]
+        return new_inv
+
+    def _choose_pivot(self, new):
+        if self.pivot_rule == PIVOT_LOWEST:
+            return min(new)
+        largest = max(abs(v) for v in new.itervalues())
+        column_rows = self._column_rows
+        return min((x for x, v in new.iteritems()
+                    if abs(v) >= PIVOT_THRESHOLD * largest),
+                   key=lambda x: (len(column_rows.get(x, ())), x))
+
+    def add(self, new, targets, origin=None):
+        '''
+        Add a row. new is a map from column indices to coefficients, and is
+        modified; targets is what it's equal to, as a map from column
+        indices (or None for a constant) to coefficients. origin labels the
+        row if we're tracking origins.
+
+        Returns False, and adds nothing, if the row is dependent on the
+        existing rows.
+        '''
+        if self.origins is not None:
+            return self._add(new, targets, {origin: 1})
+        return self._add(new, targets, None)
+
+    def _add(self, new, targets, origin):
+        if self.origins is None:
+            origin = None
+        new_inv = self._reduce(new, targets, origin)
+        if not new:
+            # Row is all zeros.
+            if origin is not None:
+                self.dependency = list(origin)
+            return False
+
+        j = self._choose_pivot(new)
+        v = float(new[j])
+        for x in new:
+            new[x] /= v
+        for x in new_inv:
+            new_inv[x] /= v
+        new[j] = 1
+        if origin is not None:
+            for x in origin:
+                origin[x] /= v
+
+        for x in list(new_inv):
+            if new_inv[x] == 0:
+                del new_inv[x]
+
+        column_rows = self._column_rows
+        count = 0
+        for idx in column_rows.pop(j, ()):
+            count += 1
+            row = self.rows[idx]
+            factor = row.pop(j)
+            added, removed = _subtract(row, new, factor, skip=j)
+            for y in added:
+                column_rows[y].add(idx)
+            for y in removed:
+                column_rows[y].discard(idx)
+            inv_row = self.inv[idx]
+            for y, v in new_inv.iteritems():
+                value = inv_row.get(y, 0) - v * factor
+                if value == 0:
+                    inv_row.pop(y, None)
+                else:
+                    inv_row[y] = value
+            if origin is not None:
+                _subtract(self.origins[idx], origin, factor)
+
+        idx = len(self.rows)
+        self.pivots[j] = idx
+        self.rows.append(new)
+        self.inv.append(new_inv)
+        if origin is not None:
+            self.origins.append(origin)
+        for x in new:
+            column_rows[x].add(idx)
+
+        if self.probe is not None:
+            self.probe.row_updates += count
+
+        return True
+
+def solve(request, cancelled=None):
+    '''
+    Solve the given SolveRequest. Returns a SolveResult, or None if the
+    constraints are overconstrained, in which case the request's
+    conflicting_constraints says which.
+
+    cancelled, if given, is called every so often; if it returns True, we
+    give up and raise SolveCancelled.
+    '''
+    probe = request.probe
+    derived = request.derived
+
+    def check_cancelled():
+        if cancelled is not None and cancelled():
+            raise SolveCancelled()
+
+    def constrain_column(col, elimination):
+        rowdict = {}
+        targets = {col: 1}
+        if col in derived:
+            # Hold the combination of columns this one is derived from
+            # where it is now.
+            for base, coeff in derived[col].iteritems():
+                if base is None:
+                    targets[None] = -coeff
+                else:
+                    rowdict[base] = coeff
+        else:
+            rowdict[col] = 1
+
+        if not elimination.add(rowdict, targets) and probe is not None:
+            probe.dependent_rows += 1
+
+    def constrain_point(pt, elimination):
+        for col in (2 * pt, 2 * pt + 1):
+            constrain_column(col, elimination)
+
+    # Derived columns aren't unknowns.
+    unknowns = (sum(1 for pt in request.all_points
+                    for col in (2 * pt, 2 * pt + 1) if col not in derived)
+                + sum(1 for scalar in request.all_scalars
+                      if scalar_column(scalar) not in derived))
+
+    if probe is not None:
+        probe.start('primary')
+    primary = request.primary
+    # An Elimination made with another pivot rule would do, but the caller
+    # may be comparing the rules (see benchmark.py), so don't use it.
+    if primary is None or primary.pivot_rule != request.pivot_rule:
+        rows = []
+        target_keys = request.target_keys
+        for i, (coeffs, target) in enumerate(request.constraints):
+            check_cancelled()
+            if target_keys is not None and target_keys[i] is not None:
+                # Whatever the target turns out to be, derived constants
+                # move to the other side just the same.
+                row, constant = constraint_to_row(coeffs, 0, derived)
+                rows.append((row, {target_keys[i]: 1, None: constant}))
+            else:
+                rows.append(constraint_to_row(coeffs, target, derived))
+        if probe is not None:
+            probe.rows += len(rows)
+            probe.input_nonzeros += sum(len(row) for row, target in rows)
+        primary, conflict = factor_constraints(rows, request.pivot_rule,
+                                               check_cancelled, probe)
+        if primary is None:
+            request.conflicting_constraints = sorted(conflict)
+            if probe is not None:
+                probe.stop()
+            return None
+    # We now have a matrix with all explicit constraints.
+    degrees_of_freedom = (unknowns - len(primary))
+    solver_log.debug("Degrees of freedom: %d", degrees_of_freedom)
+
+    if probe is not None:
+        probe.factor_nonzeros = sum(len(row) for row in primary.rows)
+        probe.start('secondary')
+    elimination = primary.copy(probe)
+    if request.dragging_point is not None:
+        constrain_point(request.dragging_point, elimination)
+
+    for (coeffs, target) in request.secondary_constraints:
+        check_cancelled()
+        rowdict, target = constraint_to_row(coeffs, target, derived)
+        if probe is not None:
+            probe.rows += 1
+        if (not elimination.add(rowdict, {None: target})
+            and probe is not None):
+            probe.dependent_rows += 1
+
+    for pt in request.points + request.point_lru:
+        if len(elimination) == unknowns:
+            break
+        check_cancelled()
+        constrain_point(pt, elimination)
+
+    for scalar in request.all_scalars:
+        if len(elimination) == unknowns:
+            break
+        col = scalar_column(scalar)
+        if col not in derived:
+            constrain_column(col, elimination)
+
+    if probe is not None:
+        probe.start('inverse')
+    new_inv = {}
+    for col, row_idx in elimination.pivots.iteritems():
+        new_inv[col] = elimination.inv[row_idx]
+
+    if probe is not None:
+        probe.stop()
+        probe.pivots = len(elimination)
+        probe.inverse_nonzeros = sum(len(row) for row in elimination.inv)
+        probe.degrees_of_freedom = degrees_of_freedom
+
+    return SolveResult(new_inv, degrees_of_freedom, primary)
@@ -0,0 +1,159 @@
+'''
+Evaluate one footprint at many values of some of its distance constraints,
+for a family of packages that only differ in their dimensions.
+
+    sweep = ParameterSweep(object_manager, [pitch, span])
+    for snapshot in sweep.snapshots([(UnitNumber(0.5, 'mm'),
+                                      UnitNumber(4, 'mm')),
+                                     (UnitNumber(0.65, 'mm'),
+                                      UnitNumber(5, 'mm'))]):
+        ...
+
+The constraints are only factored and solved once. The swept constraints'
+targets are left as symbols in the solution, so each variant is just the
+solution with its values substituted; only the coordinates that depend on
+the swept targets are recomputed. Every variant comes out exactly as if the
+distances had been set and the footprint solved again from its current
+position.
+'''
+
+from exceptiontypes import OverconstrainedException
+from export import GeometrySnapshot, export
+from solver import solve
+from units import UnitNumber
+
+class SweepKey(object):
+    '''
+    Stands for the target of one constraint in a solution.
+    '''
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return "SweepKey(%d)" % self.index
+
+class ParameterSweep(object):
+    def __init__(self, object_manager, swept):
+        '''
+        swept is a list of the DistanceConstraints (or anything else with
+        a distance) to vary. object_manager shouldn't be changed while the
+        sweep is being used.
+        '''
+        self.object_manager = object_manager
+        self.swept = list(swept)
+        self._matrix = None
+        self._derived = None
+        # Map from each SweepKey to its swept primitive and the index of the
+        # constraint in that primitive's constraints.
+        self._keys = {}
+        # Columns whose solution rows involve a SweepKey, split into the
+        # row without them and a list of (key, coefficient).
+        self._symbolic = {}
+
+    def _factor(self):
+        if self._matrix is not None:
+            return
+        object_manager = self.object_manager
+        request = object_manager.solve_request()
+        # A cached factorization has the current targets built in.
+        request.primary = None
+        request.target_keys = [None] * len(request.constraints)
+        for primitive in self.swept:
+            indices = object_manager.constraint_indices(primitive)
+            if not indices:
+                raise ValueError("%r has no constraints to sweep" %
+                                 (primitive,))
+            for n, index in enumerate(indices):
+                key = SweepKey(index)
+                request.target_keys[index] = key
+                self._keys[key] = (primitive, n)
+        result = solve(request)
+        if result is None:
+            raise OverconstrainedException(
+                object_manager.conflicting_primitives(request))
+        for col, row in result.matrix.iteritems():
+            terms = [(key, coeff) for key, coeff in row.iteritems()
+                     if isinstance(key, SweepKey)]
+            if terms:
+                base = dict(row)
+                for key, _ in terms:
+                    del base[key]
+                self._symbolic[col] = (base, terms)
+        self._matrix = result.matrix
+        self._derived = request.derived
+
+    def _targets(self, values):
+        '''
+        Map from SweepKeys to the targets of the swept constraints when
+        their distances are the given values.
+        '''
+        targets = {}
+        by_primitive = {}
+        for primitive, value in zip(self.swept, values):
+            if not isinstance(value, UnitNumber):
+                value = UnitNumber(value, "iu")
+            old_distance = primitive.distance
+            primitive.distance = value
+            try:
+                by_primitive[primitive] = primitive.constraints()
+            finally:
+                primitive.distance = old_distance
+        for key, (primitive, n) in self._keys.iteritems():
+            targets[key] = by_primitive[primitive][n][1]
+        return targets
+
+    def matrix(self, values):
+        '''
+        Return the solution map (as in SolveResult) for one variant. values
+        are the distances of the swept constraints, in order, as UnitNumbers
+        or numbers in internal units.
+        '''
+        if len(values) != len(self.swept):
+            raise ValueError("Expected %d values, got %d" %
+                             (len(self.swept), len(values)))
+        self._factor()
+        targets = self._targets(values)
+        # Rows that don't depend on the swept targets are shared.
+        matrix = dict(self._matrix)
+        for col, (base, terms) in self._symbolic.iteritems():
+            row = dict(base)
+            row[None] = row.get(None, 0) + sum(targets[key] * coeff
+                                               for key, coeff in terms)
+            matrix[col] = row
+        return matrix
+
+    def variants(self, table):
+        '''
+        For each row of values in table (see matrix), move the footprint's
+        points to that variant and yield the row. Everything is put back
+        afterwards, including if the caller stops early.
+        '''
+        self._factor()
+        object_manager = self.object_manager
+        saved = object_manager.save_solution()
+        try:
+            for values in table:
+                object_manager.set_solution_map(self.matrix(values),
+                                                self._derived)
+                yield values
+        finally:
+            object_manager.restore_solution(saved)
+
+    def snapshots(self, table):
+        '''
+        Return a list with an export.GeometrySnapshot of each variant.
+        '''
+        return [GeometrySnapshot.new(self.object_manager)
+                for _ in self.variants(table)]
+
+    def export(self, table, targets, concurrent=False):
+        '''
+        Export every variant. targets(i, values) returns the
+        (format, filename) pairs to write the ith variant to; see
+        export.export.
+        '''
+        for i, values in enumerate(self.variants(table)):
+            export(GeometrySnapshot.new(self.object_manager),
+                   targets(i, values), concurrent)
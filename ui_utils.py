@@ -2,10 +2,19 @@ import pygtk
 pygtk.require('2.0')
 import gtk
 
+from logging_utils import ui_log
 from units import UnitNumber
 
 ERROR_COLOR = gtk.gdk.Color(65535, 0, 0)
 
+# Text extents of labels we've drawn, keyed by the text, the font face, the
+# font matrix (which holds the font size) and the linear part of the current
+# transformation (that is, the scale). Labels are redrawn every frame, but
+# their extents only change if one of those does.
+_TEXT_EXTENTS_CACHE = {}
+# When the cache grows past this many entries, it's simply cleared.
+_TEXT_EXTENTS_CACHE_SIZE = 4096
+
 class ValidatingInput(object):
     def mark_invalid(self):
         self.modify_base(gtk.STATE_NORMAL, ERROR_COLOR)
@@ -169,10 +178,10 @@ def reconfigure(other_widgets):
     return tuple(widget.val() for widget in other_widgets)
 
 def do_configuration(primitive):
-    print("Reconfigure %r" % primitive)
+    ui_log.debug("Reconfigure %r", primitive)
     dialog = gtk.Dialog("Configure")
     widget_info = primitive.reconfiguration_widget()
-    print widget_info
+    ui_log.debug("Reconfiguration widget: %r", widget_info)
     if not widget_info:
         return False
     ((widget, widgets), validator) = widget_info
@@ -192,6 +201,7 @@ def do_configuration(primitive):
             if not validator():
                 continue
             primitive.reconfigure(widget, widgets)
+            primitive.invalidate_attributes()
             ret = True
         dialog.destroy()
         if result == 3:
@@ -245,6 +255,31 @@ def vert_arrow(cr, x, y1, y2, t_arrowhead=False, b_arrowhead=True,
 
     cr.stroke()
 
+def text_extents(cr, text):
+    '''
+    Like cr.text_extents(text), but cached.
+    '''
+    key = (text, _font_face_key(cr.get_font_face()),
+           tuple(cr.get_font_matrix()), tuple(cr.get_matrix())[:4])
+    extents = _TEXT_EXTENTS_CACHE.get(key)
+    if extents is None:
+        if len(_TEXT_EXTENTS_CACHE) >= _TEXT_EXTENTS_CACHE_SIZE:
+            _TEXT_EXTENTS_CACHE.clear()
+        extents = cr.text_extents(text)
+        _TEXT_EXTENTS_CACHE[key] = extents
+    return extents
+
+def _font_face_key(face):
+    '''
+    Something hashable that's the same for equal font faces. Each call to
+    get_font_face can give a new object, so for the toy faces that
+    select_font_face makes, use what they were made from.
+    '''
+    try:
+        return (face.get_family(), face.get_slant(), face.get_weight())
+    except AttributeError:
+        return face
+
 def set_dampened_color(cr, r, g, b, dampening):
     cr.set_source_rgb(
         r * (1 - dampening) + dampening,